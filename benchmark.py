@@ -0,0 +1,196 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+# the benchmark runs without display
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import numpy as np
+from PyQt5.QtGui import QImage
+from PyQt5.QtWidgets import QApplication
+
+import main
+
+
+def generate_images(folder, num_images, width, height, seed=0):
+    """
+    Generates folder with synthetic JPEG images (smooth gradient plus noise, so they compress like photos)
+    """
+    main.make_folder(folder)
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+
+    for i in range(num_images):
+        pixels = gradient + rng.normal(0, 25, (height, width, 3)).astype(np.float32) + (i * 37) % 255
+        pixels = np.ascontiguousarray(np.clip(pixels % 256, 0, 255).astype(np.uint8))
+        image = QImage(pixels.data, width, height, 3 * width, QImage.Format_RGB888)
+        image.save(os.path.join(folder, f'img_{i:07d}.jpg'), 'JPG', 90)
+
+
+def timed(func, *args, **kwargs):
+    """
+    :return: (result of the function, elapsed seconds)
+    """
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def summarize(latencies):
+    """
+    :return: dict with statistics of latencies in milliseconds
+    """
+    if not latencies:
+        return {}
+    ms = sorted(latency * 1000 for latency in latencies)
+    return {
+        'count': len(ms),
+        'mean_ms': statistics.fmean(ms),
+        'p50_ms': ms[len(ms) // 2],
+        'p95_ms': ms[min(len(ms) - 1, int(len(ms) * 0.95))],
+        'max_ms': ms[-1],
+    }
+
+
+def wait_for_file_ops(app, window, timeout=600):
+    start = time.perf_counter()
+    while window.file_ops is not None and window.file_ops.num_pending and time.perf_counter() - start < timeout:
+        app.processEvents()
+        time.sleep(0.001)
+    return time.perf_counter() - start
+
+
+def bench_mode(app, source_folder, work_folder, labels, mode, num_navigations):
+    """
+    Runs the labeler on a fresh copy of the dataset in given mode
+    """
+    if os.path.exists(work_folder):
+        shutil.rmtree(work_folder)
+    shutil.copytree(source_folder, work_folder)
+    results = {}
+
+    _, results['get_img_paths_s'] = timed(main.get_img_paths, work_folder, recursive=True)
+
+    _, results['setup_window_s'] = timed(main.SetupWindow)
+
+    window, results['labeler_window_s'] = timed(main.LabelerWindow, labels, work_folder, mode)
+    window.scan_worker.wait()
+    app.processEvents()
+    # reported by the window once the event loop painted the first image
+    results['time_to_first_image_s'] = window.time_to_first_image
+    _, results['populate_file_list_s'] = timed(window.populate_file_list)
+
+    # navigation: first pass decodes on demand or uses prefetched images, second pass is served from the cache
+    for pass_name in ('first_pass', 'second_pass'):
+        window.counter = 0
+        window.show_current_image()
+        latencies = []
+        for _ in range(min(num_navigations, window.num_images - 1)):
+            _, latency = timed(window.show_next_image)
+            latencies.append(latency)
+            # give prefetch results a chance to arrive, like the event loop between key presses does
+            app.processEvents()
+        results[f'navigation_{pass_name}'] = summarize(latencies)
+    results['cache_hits'] = window.cache_hits
+    results['cache_misses'] = window.cache_misses
+
+    # labeling: every image gets a label, the UI call and the background file operations are measured separately
+    window.counter = 0
+    window.show_current_image()
+    latencies = []
+    for i in range(min(num_navigations, window.num_images)):
+        window.counter = i
+        _, latency = timed(window.set_label, labels[i % len(labels)])
+        latencies.append(latency)
+    results['set_label'] = summarize(latencies)
+    results['file_ops_drain_s'] = wait_for_file_ops(app, window)
+    if window.materializer is not None:
+        # 'deferred' mode places the images only by commit, the second commit has nothing to do
+        window.materializer.set_mode(window.commit_mode_combo.currentText())
+        failed, results['commit_s'] = timed(window.materializer.commit, dict(window.assigned_labels))
+        results['commit_failed'] = len(failed)
+        _, results['recommit_s'] = timed(window.materializer.commit, dict(window.assigned_labels))
+
+    _, results['generate_csv_s'] = timed(window.generate_csv, 'benchmark')
+    csv_file_path = os.path.join(work_folder, 'output', 'benchmark.csv')
+    _, results['csv_to_xlsx_s'] = timed(window.csv_to_xlsx, csv_file_path)
+
+    window.close()
+    app.processEvents()
+    return results
+
+
+def compare(results, baseline_path):
+    """
+    Prints ratios of timings against results of previous run
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+
+    def walk(current, previous, prefix=''):
+        for key, value in current.items():
+            if key not in previous:
+                continue
+            if isinstance(value, dict):
+                walk(value, previous[key], f'{prefix}{key}.')
+            elif (key.endswith('_s') or key.endswith('_ms')) and previous[key]:
+                print(f'{prefix}{key}: {previous[key]:.4f} -> {value:.4f} ({value / previous[key]:.2f}x)')
+
+    walk(results, baseline)
+
+
+def main_benchmark(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark of scanning, startup, navigation, labeling and export.')
+    parser.add_argument('--images', type=int, default=500, help='number of synthetic images')
+    parser.add_argument('--width', type=int, default=1920, help='width of synthetic images')
+    parser.add_argument('--height', type=int, default=1080, help='height of synthetic images')
+    parser.add_argument('--labels', type=int, default=10, help='number of labels')
+    parser.add_argument('--navigations', type=int, default=100, help='number of measured navigations and labels')
+    parser.add_argument('--modes', nargs='+', default=['csv', 'copy', 'move', 'link', 'deferred'],
+                        choices=['csv', 'copy', 'move', 'link', 'deferred'])
+    parser.add_argument('--workdir', help='folder for generated images (default: temporary folder)')
+    parser.add_argument('--out', default='bench_output.json', help='path of JSON file with results')
+    parser.add_argument('--compare', help='JSON results of previous run to compare with')
+    args = parser.parse_args(argv)
+
+    app = QApplication.instance() or QApplication(sys.argv)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='annotation-benchmark-')
+    source_folder = os.path.join(workdir, f'source_{args.images}_{args.width}x{args.height}')
+    labels = [f'label_{i}' for i in range(args.labels)]
+
+    if not os.path.exists(source_folder):
+        _, elapsed = timed(generate_images, source_folder, args.images, args.width, args.height)
+        print(f'generated {args.images} images in {elapsed:.1f} s')
+
+    results = {}
+    for mode in args.modes:
+        print(f'benchmarking mode {mode}..')
+        results[mode] = bench_mode(app, source_folder, os.path.join(workdir, f'work_{mode}'), labels, mode,
+                                   args.navigations)
+
+    report = {
+        'config': vars(args),
+        'system': {'python': platform.python_version(), 'platform': platform.platform(),
+                   'cpu_count': os.cpu_count()},
+        'results': results,
+    }
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'results saved to: {args.out}')
+
+    if args.compare:
+        compare(results, args.compare)
+
+    if args.workdir is None:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_benchmark())
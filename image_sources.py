@@ -0,0 +1,299 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tarfile
+import threading
+import zipfile
+import zlib
+
+# archives whose images are labeled without extracting them (tar must not be compressed, so it can be memory-mapped)
+ARCHIVE_EXTENSIONS = ('.tar', '.zip')
+
+# archive path -> ImageArchive, archives are opened on first access
+_archives = {}
+_lock = threading.Lock()
+_index_folder = None
+# indexes of older versions are built again (version 2 skips unsafe member names)
+INDEX_VERSION = 2
+
+
+def set_index_folder(folder):
+    """
+    Sets folder where indexes of archives are cached. It's also used as initializer of worker processes,
+    so they read the indexes instead of building them again.
+    """
+    global _index_folder
+    _index_folder = folder
+
+
+def get_index_folder():
+    return _index_folder
+
+
+def is_archive(filename):
+    return filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def safe_member_name(name):
+    """
+    :return: normalized name of the member, None if it's absolute or contains '..' (it would be extracted
+    outside of the label folder)
+    """
+    name = name.replace('\\', '/')
+    parts = [part for part in name.split('/') if part not in ('', '.')]
+    if not parts or name.startswith('/') or '..' in parts or ':' in parts[0]:
+        return None
+    return '/'.join(parts)
+
+
+class ImageArchive:
+    """
+    Tar or zip archive of images. Offsets of members are indexed once (the index is cached on disk),
+    the archive is memory-mapped and members are read as bytes without extracting them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        stat = os.stat(path)
+        self.stamp = [stat.st_mtime_ns, stat.st_size]
+
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size else b''
+        # archive is closed when it's replaced by its newer version
+        self.closed = False
+
+        # member name -> (offset of data, size of data, compression method of zip, 0 for stored data)
+        self.members = self.load_index()
+        if self.members is None:
+            self.members = self.build_index()
+            self.save_index()
+
+    def index_path(self):
+        if _index_folder is None:
+            return None
+        key = hashlib.sha1(os.path.abspath(self.path).encode('utf8')).hexdigest()[:20]
+        return os.path.join(_index_folder, key + '.json')
+
+    def load_index(self):
+        index_path = self.index_path()
+        if index_path is None or not os.path.exists(index_path):
+            return None
+        try:
+            with open(index_path, encoding='utf8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # index is valid only for the same version of the archive (and the same version of the index)
+        if saved.get('stamp') != self.stamp or saved.get('version') != INDEX_VERSION:
+            return None
+        return {name: (offset, size, method) for name, offset, size, method in saved['members']}
+
+    def save_index(self):
+        index_path = self.index_path()
+        if index_path is None:
+            return
+        os.makedirs(_index_folder, exist_ok=True)
+        tmp_path = f'{index_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump({'version': INDEX_VERSION, 'path': self.path, 'stamp': self.stamp,
+                       'members': [[name, *entry] for name, entry in self.members.items()]}, f)
+        os.replace(tmp_path, index_path)
+
+    def build_index(self):
+        if self.path.lower().endswith('.zip'):
+            return self._index_zip()
+        return self._index_tar()
+
+    def _index_tar(self):
+        members = {}
+        try:
+            # 'r:' refuses compressed archives, their members can't be read from the memory map
+            with tarfile.open(self.path, 'r:') as tar:
+                for member in tar:
+                    name = safe_member_name(member.name)
+                    if member.isfile() and name is not None:
+                        members[name] = (member.offset_data, member.size, 0)
+        except tarfile.ReadError as e:
+            raise ValueError(f'{self.path} is not an uncompressed tar archive: {e}')
+        return members
+
+    def _index_zip(self):
+        members = {}
+        try:
+            with zipfile.ZipFile(self.path) as archive:
+                infos = archive.infolist()
+        except zipfile.BadZipFile as e:
+            raise ValueError(f'{self.path} is not a zip archive: {e}')
+
+        for info in infos:
+            name = safe_member_name(info.filename)
+            if info.is_dir() or info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED) or name is None:
+                continue
+            # data starts after the local header, whose extra field can differ from the central directory
+            header = self._map[info.header_offset:info.header_offset + 30]
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            offset = info.header_offset + 30 + name_length + extra_length
+            members[name] = (offset, info.compress_size, info.compress_type)
+        return members
+
+    def read(self, member):
+        """
+        :return: bytes of the member
+        """
+        if member not in self.members:
+            raise FileNotFoundError(f'{member} is not in {self.path}')
+        offset, size, method = self.members[member]
+        data = self._map[offset:offset + size]
+        if method == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(data, -15)
+        return data
+
+    def member_path(self, member):
+        return self.path + os.sep + member.replace('/', os.sep)
+
+    def close(self):
+        self.closed = True
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+
+def open_archive(path):
+    """
+    :return: ImageArchive of the path. Archive which changed since it was opened is opened again,
+    removed archive stays available with its last index (so its images can be listed as removed).
+    """
+    with _lock:
+        archive = _archives.get(path)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        if archive is not None:
+            return archive
+        raise
+    if archive is None or archive.stamp != [stat.st_mtime_ns, stat.st_size]:
+        opened = ImageArchive(path)
+        with _lock:
+            current = _archives.get(path)
+            if current is not None and current.stamp == opened.stamp:
+                # another thread opened the same version in the meantime
+                archive = current
+                replaced = opened
+            else:
+                archive = _archives[path] = opened
+                replaced = current
+            # the file and the memory map of the replaced version are released
+            if replaced is not None:
+                replaced.close()
+    return archive
+
+
+def member_paths(archive_path, extensions):
+    """
+    :return: sorted paths of images in the archive (archive path followed by name of the member)
+    """
+    archive = open_archive(archive_path)
+    return sorted(archive.member_path(member) for member in archive.members
+                  if member.lower().endswith(extensions))
+
+
+def archive_changed(path):
+    """
+    :return: True if the archive wasn't opened yet (e.g. it couldn't be read while it was being copied in)
+    or if it was rewritten since it was opened
+    """
+    with _lock:
+        archive = _archives.get(path)
+    if archive is None:
+        return True
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return archive.stamp != [stat.st_mtime_ns, stat.st_size]
+
+
+def opened_member_paths(archive_path, extensions):
+    """
+    :return: paths of images in the archive as it was opened last time (it's not opened again),
+    empty list if it wasn't opened
+    """
+    with _lock:
+        archive = _archives.get(archive_path)
+    if archive is None:
+        return []
+    return sorted(archive.member_path(member) for member in archive.members
+                  if member.lower().endswith(extensions))
+
+
+def split_member_path(path):
+    """
+    :return: (archive path, member name) if the path points into an archive, otherwise (None, None)
+    """
+    lower = path.lower()
+    for extension in ARCHIVE_EXTENSIONS:
+        end = lower.find(extension + os.sep)
+        while end >= 0:
+            archive_path = path[:end + len(extension)]
+            # a folder can also be named like an archive
+            if archive_path in _archives or os.path.isfile(archive_path):
+                return archive_path, path[end + len(extension) + 1:].replace(os.sep, '/')
+            end = lower.find(extension + os.sep, end + 1)
+    return None, None
+
+
+def is_member(path):
+    return split_member_path(path)[0] is not None
+
+
+def read_member(path):
+    """
+    :return: bytes of the image in an archive, None if the path is not in an archive
+    """
+    archive_path, member = split_member_path(path)
+    if archive_path is None:
+        return None
+    with _lock:
+        archive = _archives.get(archive_path)
+    if archive is None or archive.closed:
+        archive = open_archive(archive_path)
+    return archive.read(member)
+
+
+def stat(path):
+    """
+    :return: (mtime in ns, size) of the image, images in archives have mtime of the archive
+    """
+    archive_path, member = split_member_path(path)
+    if archive_path is None:
+        stat_result = os.stat(path)
+        return stat_result.st_mtime_ns, stat_result.st_size
+    archive = open_archive(archive_path)
+    if member not in archive.members:
+        raise FileNotFoundError(f'{member} is not in {archive_path}')
+    return archive.stamp[0], archive.members[member][1]
+
+
+def exists(path):
+    archive_path, member = split_member_path(path)
+    if archive_path is None:
+        return os.path.exists(path)
+    return os.path.exists(archive_path) and member in open_archive(archive_path).members
+
+
+def extract(path, dst_path, folder):
+    """
+    Writes the image from an archive to a file (its folder is created)
+    :param folder: label folder, the file is never written outside of it
+    """
+    real_folder = os.path.realpath(folder)
+    if os.path.commonpath([real_folder, os.path.realpath(dst_path)]) != real_folder:
+        raise OSError(f'{dst_path} is outside of {folder}')
+    data = read_member(path)
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    tmp_path = f'{dst_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, dst_path)
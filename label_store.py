@@ -0,0 +1,1801 @@
+import argparse
+import csv
+import fnmatch
+import hashlib
+import importlib.util
+import itertools
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import zipfile
+from collections import Counter
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import image_sources
+
+
+def lazy_import(name):
+    """
+    Imports the module on first access to its attributes (importlib.util.LazyLoader), so modules which are
+    not needed to show the first image don't slow down the start
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+np = lazy_import('numpy')
+
+
+def make_folder(directory):
+    """
+    Make folder if it doesn't already exist
+    :param directory: The folder destination path
+    """
+    # several workers can create the same label folder at once
+    os.makedirs(directory, exist_ok=True)
+
+
+# ioctl request number of Linux FICLONE (reflink whole file)
+FICLONE = 0x40049409
+
+
+def reflink_file(src, dst):
+    """
+    Creates copy-on-write clone of the file (btrfs, XFS, ...). Raises OSError if the filesystem doesn't support it.
+    """
+    import fcntl
+
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            dst_file.close()
+            os.remove(dst)
+            raise
+
+
+def link_file(src, dst):
+    """
+    Places the file to dst without copying its data. Hardlink is tried first, then reflink (Linux only)
+    and finally symlink (e.g. when the label folder is on another filesystem).
+    :return: kind of created link ('hardlink', 'reflink' or 'symlink')
+    """
+    try:
+        os.link(src, dst)
+        return 'hardlink'
+    except OSError:
+        pass
+
+    if sys.platform.startswith('linux'):
+        try:
+            reflink_file(src, dst)
+            return 'reflink'
+        except OSError:
+            pass
+
+    os.symlink(os.path.abspath(src), dst)
+    return 'symlink'
+
+
+def label_folder(input_folder, label):
+    """
+    :return: folder of the label (the input folder if label is None)
+    """
+    return input_folder if label is None else os.path.join(input_folder, label)
+
+
+def locate_image(input_folder, labels, img_name, candidates=()):
+    """
+    :param candidates: labels whose folders are searched first (None for the input folder)
+    :return: label folder the image is in (None for the input folder)
+    """
+    for label in list(candidates) + [None] + list(labels):
+        if os.path.exists(os.path.join(label_folder(input_folder, label), img_name)):
+            return label
+    raise FileNotFoundError(f"Can't find {img_name} in {input_folder} or its label folders")
+
+
+def place_image(input_folder, labels, img_name, label, placed, mode):
+    """
+    Places the image into the folder of its label, the same way for the labeler's file operations
+    and for Materializer. It can be repeated (e.g. after a crash), the image is found where it is now.
+    :param label: target label, None if the image should not be in any label folder
+    :param placed: label folder the image was placed into so far (None for the input folder)
+    :param mode: 'move', 'copy' or 'link'
+    """
+    # images in archives are extracted into label folders in every mode, the archive is never modified
+    in_archive = image_sources.is_member(os.path.join(input_folder, img_name))
+    if mode == 'move' and not in_archive:
+        current = locate_image(input_folder, labels, img_name, [placed, label])
+        if current != label:
+            dst_path = os.path.join(label_folder(input_folder, label), img_name)
+            # images from subfolders keep their relative path inside the label folder
+            make_folder(os.path.dirname(dst_path))
+            shutil.move(os.path.join(label_folder(input_folder, current), img_name), dst_path)
+        return
+
+    # copy/link: lexists, so broken symlinks are also replaced
+    if placed is not None and placed != label:
+        placed_path = os.path.join(label_folder(input_folder, placed), img_name)
+        if os.path.lexists(placed_path):
+            os.remove(placed_path)
+    if label is not None:
+        placed_path = os.path.join(label_folder(input_folder, label), img_name)
+        if in_archive and not os.path.lexists(placed_path):
+            image_sources.extract(os.path.join(input_folder, img_name), placed_path, label_folder(input_folder, label))
+        elif not os.path.lexists(placed_path):
+            make_folder(os.path.dirname(placed_path))
+            if mode == 'copy':
+                shutil.copy(os.path.join(input_folder, img_name), placed_path)
+            else:
+                link_file(os.path.join(input_folder, img_name), placed_path)
+
+
+class LabelJournal:
+    """
+    Append-only log of assigned labels, so a crashed session can be resumed.
+
+    Every label change is appended as one line (image name, label). An empty label means the label
+    was removed. Writes are flushed immediately and fsync-ed in batches. When the journal grows
+    much bigger than the number of labeled images, it is compacted into a snapshot of current labels.
+    Only the process which holds the lock of the journal writes and compacts it, other processes only read it.
+    """
+
+    def __init__(self, path, sync_every=64, sync_interval=1.0, compact_min_records=10000):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_min_records = compact_min_records
+
+        self.num_records = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._file = None
+        self._lock_file = None
+
+    def lock(self):
+        """
+        Takes exclusive lock of the journal (lock file next to it), so a journal which is appended to by one process
+        is never compacted by another one. The lock is released on close or by the OS when the process exits.
+        """
+        self._lock_file = open(self.path + '.lock', 'a')
+        try:
+            if sys.platform == 'win32':
+                import msvcrt
+                msvcrt.locking(self._lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            self._lock_file = None
+            raise ValueError(f'{self.path} is open in another process (e.g. the labeler), '
+                             f'close it first')
+
+    def replay(self):
+        """
+        Reads the journal
+        :return: dict of image name -> label
+        """
+        assigned_labels = {}
+        self.num_records = 0
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf8') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break  # last line was not written completely
+                    img_name, _, label = line[:-1].partition('\t')
+                    if label:
+                        assigned_labels[img_name] = label
+                    else:
+                        assigned_labels.pop(img_name, None)
+                    self.num_records += 1
+        return assigned_labels
+
+    def open(self):
+        self._file = open(self.path, 'a', encoding='utf8')
+
+    def append(self, img_name, label, assigned_labels):
+        """
+        Appends label change to the journal
+        :param img_name: name of the image
+        :param label: new label or None if the label was removed
+        :param assigned_labels: all current labels, used for compaction
+        """
+        self.append_many([img_name], label, assigned_labels)
+
+    def append_many(self, img_names, label, assigned_labels):
+        """
+        Appends the same label change of many images with one write
+        """
+        self.write(''.join(f'{img_name}\t{label or ""}\n' for img_name in img_names), len(img_names),
+                   assigned_labels)
+
+    def write(self, records, num_records, assigned_labels):
+        """
+        Writes lines with records, then the journal is compacted or fsync-ed if it's needed
+        :param assigned_labels: all current labels, used for compaction
+        """
+        self._file.write(records)
+        self._file.flush()
+        self.num_records += num_records
+        self._unsynced += num_records
+
+        if self.needs_compaction(self.snapshot_size(assigned_labels)):
+            self.compact(assigned_labels)
+        elif self._unsynced >= self.sync_every or time.monotonic() - self._last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        """
+        fsync pending records to disk
+        """
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def needs_compaction(self, num_labels):
+        return self.num_records > max(self.compact_min_records, 2 * num_labels)
+
+    def snapshot_size(self, assigned_labels):
+        """
+        :return: number of records in the snapshot of current labels
+        """
+        return len(assigned_labels)
+
+    def snapshot_records(self, assigned_labels):
+        """
+        :return: lines of the snapshot of current labels
+        """
+        return (f'{img_name}\t{label}\n' for img_name, label in assigned_labels.items())
+
+    def compact(self, assigned_labels):
+        """
+        Replaces the journal by snapshot of current labels (atomically, using os.replace)
+        """
+        tmp_path = self.path + '.tmp'
+        num_records = 0
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            for record in self.snapshot_records(assigned_labels):
+                f.write(record)
+                num_records += 1
+            f.flush()
+            os.fsync(f.fileno())
+
+        if self._file is not None:
+            self._file.close()
+        os.replace(tmp_path, self.path)
+        self.num_records = num_records
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        if self._file is not None:
+            self.open()
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+
+class LabelStore:
+    """
+    Labels of one labeling session, independent of the GUI.
+    Labels are kept in memory (image name -> label) and every change is written to LabelJournal.
+    Session metadata (list of labels) is saved next to the journal, so the session can be loaded
+    and exported later without any other input.
+    """
+
+    def __init__(self, labels, output_folder=None, read_only=False):
+        """
+        :param labels: list of all labels (defines order of columns in exports)
+        :param output_folder: folder with the journal. If None, labels are kept only in memory.
+        :param read_only: if True, the journal is only read (it can be open in the labeler at the same time)
+        """
+        self.labels = list(labels)
+        self.output_folder = output_folder
+        self.assigned_labels = {}
+        self.journal = None
+        self.read_only = read_only
+        # mode of the labeler which saved the session (default mode when the session is opened again)
+        self.mode = self.load_session_mode(output_folder) if output_folder is not None else None
+
+        if output_folder is not None:
+            self.journal = LabelJournal(os.path.join(output_folder, 'labels.journal'))
+            if not read_only:
+                make_folder(output_folder)
+                self.journal.lock()
+            self.assigned_labels = self.journal.replay()
+            if not read_only:
+                if self.journal.needs_compaction(len(self.assigned_labels)):
+                    self.journal.compact(self.assigned_labels)
+                self.journal.open()
+
+    @classmethod
+    def open(cls, input_folder, labels=None, read_only=False):
+        """
+        Loads session of the folder with images
+        :param input_folder: folder with images (labels are in its 'output' subfolder)
+        :param labels: list of labels. If None, labels saved with the session are used.
+        :param read_only: if True, the session is only read (it can be open in the labeler at the same time)
+        """
+        output_folder = os.path.join(input_folder, 'output')
+        if labels is None:
+            labels = cls.load_session_labels(output_folder)
+        store = cls(labels or [], output_folder, read_only)
+
+        if not labels:
+            # no saved labels, use the assigned ones
+            store.labels = sorted(set(store.assigned_labels.values()))
+        elif not read_only:
+            store.save_session()
+        return store
+
+    @staticmethod
+    def load_session_labels(output_folder):
+        session_path = os.path.join(output_folder, 'session.json')
+        if not os.path.exists(session_path):
+            return None
+        with open(session_path, encoding='utf8') as f:
+            return json.load(f).get('labels')
+
+    @staticmethod
+    def load_session_multi_label(output_folder):
+        """
+        :return: True for multi-label session, False for single-label session, None if there is no session yet
+        """
+        session_path = os.path.join(output_folder, 'session.json')
+        if not os.path.exists(session_path):
+            return None
+        with open(session_path, encoding='utf8') as f:
+            return json.load(f).get('multi_label', False)
+
+    @staticmethod
+    def load_session_mode(output_folder):
+        """
+        :return: mode of the labeler which saved the session, None if there is no session or it has no mode
+        """
+        session_path = os.path.join(output_folder, 'session.json')
+        if not os.path.exists(session_path):
+            return None
+        with open(session_path, encoding='utf8') as f:
+            return json.load(f).get('mode')
+
+    def save_session(self):
+        if self.output_folder is None:
+            return
+        session_path = os.path.join(self.output_folder, 'session.json')
+        tmp_path = session_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            session = {'labels': self.labels}
+            if self.mode is not None:
+                session['mode'] = self.mode
+            json.dump(session, f)
+        os.replace(tmp_path, session_path)
+
+    def get(self, img_name):
+        """
+        :return: label of the image or None
+        """
+        return self.assigned_labels.get(img_name)
+
+    def set_label(self, img_name, label):
+        """
+        :param label: new label or None to remove the label
+        """
+        self.set_labels([img_name], label)
+
+    def set_labels(self, img_names, label):
+        """
+        Assigns the same label to many images (journaled with one write)
+        :param label: new label or None to remove the labels
+        """
+        if label is None:
+            for img_name in img_names:
+                self.assigned_labels.pop(img_name, None)
+        else:
+            for img_name in img_names:
+                self.assigned_labels[img_name] = label
+
+        if self.journal is not None:
+            self.journal.append_many(img_names, label, self.assigned_labels)
+
+    def __len__(self):
+        return len(self.assigned_labels)
+
+    def count_by_label(self):
+        """
+        :return: dict label -> number of images (all labels of the session are included)
+        """
+        counts = dict.fromkeys(self.labels, 0)
+        for label in self.assigned_labels.values():
+            counts[label] = counts.get(label, 0) + 1
+        return counts
+
+    def filter(self, label=None, pattern=None):
+        """
+        :param label: keep only images with this label
+        :param pattern: keep only images whose names match the glob pattern
+        :return: list of (image name, label) tuples
+        """
+        return [(img_name, img_label) for img_name, img_label in self.assigned_labels.items()
+                if (label is None or img_label == label)
+                and (pattern is None or fnmatch.fnmatch(img_name, pattern))]
+
+    def merge(self, other):
+        """
+        Adds labels of another store. Labels already in this store win.
+        :return: list of conflicts (image name, label in this store, label in the other store)
+        """
+        conflicts = []
+        new_names = {}
+        for img_name, label in other.assigned_labels.items():
+            current = self.assigned_labels.get(img_name)
+            if current is None:
+                new_names.setdefault(label, []).append(img_name)
+            elif current != label:
+                conflicts.append((img_name, current, label))
+
+        for label, img_names in new_names.items():
+            if label not in self.labels:
+                self.labels.append(label)
+            self.set_labels(img_names, label)
+        return conflicts
+
+    def reconcile(self, folder_labels, csv_labels=()):
+        """
+        Restores labels which are missing in the journal (e.g. it was deleted or the images were labeled by an older
+        version) from label folders and from csv saved by a previous session. The journal wins over label folders
+        and label folders win over the csv.
+        :param folder_labels: iterable of (image name, label folder the image was found in)
+        :param csv_labels: iterable of (image name, label) read from the csv
+        :return: (number of labels restored from label folders, number of labels restored from the csv,
+        list of conflicts (image name, label, label folder the image was found in))
+        """
+        restored = {}
+        conflicts = []
+        for img_name, label in folder_labels:
+            current = self.assigned_labels.get(img_name) or restored.get(img_name)
+            if current is None:
+                restored[img_name] = label
+            elif current != label:
+                conflicts.append((img_name, current, label))
+        num_from_folders = len(restored)
+
+        for img_name, label in csv_labels:
+            if img_name not in self.assigned_labels and img_name not in restored:
+                restored[img_name] = label
+
+        new_names = {}
+        for img_name, label in restored.items():
+            new_names.setdefault(label, []).append(img_name)
+        for label, img_names in new_names.items():
+            if label not in self.labels:
+                self.labels.append(label)
+            self.set_labels(img_names, label)
+        return num_from_folders, len(restored) - num_from_folders, conflicts
+
+    def labels_to_zero_one(self, label):
+        """
+        change the label to one-hot vector
+        """
+        label_to_int = dict((c, i) for i, c in enumerate(self.labels))
+        zero_one_arr = np.zeros([len(self.labels)], dtype=int)
+        if label in label_to_int:
+            zero_one_arr[label_to_int[label]] = 1
+        return zero_one_arr
+
+    def label_codes(self):
+        """
+        Encodes assigned labels as integers (index in self.labels, -1 for unknown labels) in one pass
+        :return: (list of image names, int32 array of label codes)
+        """
+        label_to_int = {label: i for i, label in enumerate(self.labels)}
+        img_names = list(self.assigned_labels.keys())
+        codes = np.fromiter((label_to_int.get(label, -1) for label in self.assigned_labels.values()),
+                            dtype=np.int32, count=len(img_names))
+        return img_names, codes
+
+    def one_hot_matrix(self, codes):
+        """
+        :param codes: label codes from label_codes()
+        :return: uint8 matrix (images x labels), rows of unknown labels are all zeros
+        """
+        # extra last row of the identity matrix is zero, code -1 selects it
+        eye = np.eye(len(self.labels) + 1, len(self.labels), dtype=np.uint8)
+        return eye[codes]
+
+    def export_csv(self, csv_file_path, chunk_size=65536):
+        """
+        Saves csv file with assigned labels. Assigned label is represented as one-hot vector.
+        Rows are built from precomputed one-hot strings of each label and written in chunks.
+        """
+        img_names, codes = self.label_codes()
+
+        # one-hot part of the row for every label code, the last one is for unknown labels (code -1)
+        num_labels = len(self.labels)
+        row_ends = [',' + ','.join('1' if i == code else '0' for i in range(num_labels)) if num_labels else ''
+                    for code in range(num_labels + 1)]
+        row_ends = [row_end + '\r\n' for row_end in row_ends]
+        codes = codes.tolist()
+
+        with open(csv_file_path, "w", newline='', buffering=1024 * 1024) as csv_file:
+            # write header
+            csv.writer(csv_file, delimiter=',').writerow(['img'] + self.labels)
+
+            # write one-hot labels
+            for start in range(0, len(img_names), chunk_size):
+                csv_file.write(''.join(csv_field(img_name) + row_ends[code]
+                                       for img_name, code in zip(img_names[start:start + chunk_size],
+                                                                 codes[start:start + chunk_size])))
+
+    def export_npz(self, npz_file_path):
+        """
+        Saves labels to .npz file with arrays 'img' (image names), 'labels' (label names),
+        'codes' (label index of every image) and 'one_hot' (images x labels uint8 matrix)
+        """
+        img_names, codes = self.label_codes()
+        np.savez(npz_file_path, img=np.array(img_names, dtype=str), labels=np.array(self.labels, dtype=str),
+                 codes=codes, one_hot=self.one_hot_matrix(codes))
+
+    def export_npy(self, path_prefix):
+        """
+        Saves labels to separate .npy files which can be memory-mapped with np.load(path, mmap_mode='r'):
+        <prefix>_one_hot.npy, <prefix>_codes.npy and <prefix>_img.txt/<prefix>_labels.txt with names
+        (one per line, in the order of rows/columns)
+        """
+        img_names, codes = self.label_codes()
+        np.save(path_prefix + '_codes.npy', codes)
+        np.save(path_prefix + '_one_hot.npy', self.one_hot_matrix(codes))
+        with open(path_prefix + '_img.txt', 'w', encoding='utf8') as f:
+            f.write(''.join(img_name + '\n' for img_name in img_names))
+        with open(path_prefix + '_labels.txt', 'w', encoding='utf8') as f:
+            f.write(''.join(label + '\n' for label in self.labels))
+
+    def export_xlsx(self, xlsx_file_path):
+        """
+        Saves xlsx file with assigned labels (same content as csv). Rows are streamed straight from
+        the labels using XlsxWriter constant memory mode, so memory use doesn't grow with the number of rows.
+        """
+        img_names, codes = self.label_codes()
+        if len(img_names) + 1 > XLSX_MAX_ROWS:
+            raise ValueError(f'xlsx supports at most {XLSX_MAX_ROWS - 1} labeled images, '
+                             f'session has {len(img_names)}. Use csv or npz export.')
+
+        # one-hot row for every label code, the last one is for unknown labels (code -1)
+        num_labels = len(self.labels)
+        rows = [[int(i == code) for i in range(num_labels)] for code in range(num_labels + 1)]
+
+        from xlsxwriter.workbook import Workbook
+
+        workbook = Workbook(xlsx_file_path, {'constant_memory': True})
+        try:
+            worksheet = workbook.add_worksheet()
+            worksheet.write_row(0, 0, ['img'] + self.labels)
+            for r, (img_name, code) in enumerate(zip(img_names, codes.tolist()), 1):
+                worksheet.write_string(r, 0, img_name)
+                worksheet.write_row(r, 1, rows[code])
+        finally:
+            workbook.close()
+
+    def sync(self):
+        if self.journal is not None:
+            self.journal.sync()
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+
+
+class MultiLabelJournal(LabelJournal):
+    """
+    LabelJournal of a multi-label session. Every line adds ('+label') or removes ('-label') one label
+    of an image, the snapshot has one line for every label of every image.
+    """
+
+    def replay(self):
+        """
+        Reads the journal
+        :return: generator of (image name, label, True if the label was added or False if it was removed)
+        """
+        self.num_records = 0
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf8') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break  # last line was not written completely
+                img_name, _, change = line[:-1].partition('\t')
+                self.num_records += 1
+                yield img_name, change[1:], change[:1] == '+'
+
+    def append_many(self, img_names, label, added, store):
+        """
+        Appends the same label change of many images with one write
+        :param added: True if the label was added, False if it was removed
+        :param store: MultiLabelStore with all current labels, used for compaction
+        """
+        sign = '+' if added else '-'
+        self.write(''.join(f'{img_name}\t{sign}{label}\n' for img_name in img_names), len(img_names), store)
+
+    def snapshot_size(self, store):
+        return store.num_assignments
+
+    def snapshot_records(self, store):
+        return (f'{img_name}\t+{label}\n' for img_name, label in store.items())
+
+
+class FirstLabels(Mapping):
+    """
+    Read-only dict image name -> first label of the image (in order of labels) of MultiLabelStore, so parts of
+    the labeler which show one label per image (colors in the navigator, navigation filters) work unchanged
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, img_name):
+        row = self.store.find_row(img_name)
+        code = -1 if row is None else self.store.first_codes[row]
+        if code < 0:
+            raise KeyError(img_name)
+        return self.store.labels[code]
+
+    def __iter__(self):
+        for img_names, _ in self.store.labeled_rows():
+            yield from img_names
+
+    def __len__(self):
+        return self.store.num_labeled
+
+
+class MultiLabelStore:
+    """
+    Labels of a multi-label session, where every image can have any number of labels.
+    Labels are kept in a packed bit matrix (images x labels, one bit per label in np.packbits layout) and names
+    of images in a NumPy bytes array searched by binary search, so no Python object is kept per image
+    (a million images with 300 labels take about 80 MB). Every change is written to MultiLabelJournal.
+    The interface follows LabelStore, assigned_labels maps labeled images to their first label.
+    """
+
+    def __init__(self, labels, output_folder=None, capacity=1024, read_only=False):
+        """
+        :param labels: list of all labels (defines order of columns in exports)
+        :param output_folder: folder with the journal. If None, labels are kept only in memory.
+        :param capacity: initial number of rows of the bit matrix (it grows by half when it's full)
+        :param read_only: if True, the journal is only read (it can be open in the labeler at the same time)
+        """
+        self.labels = []
+        self._codes_of = {}
+        self.output_folder = output_folder
+        self.mode = LabelStore.load_session_mode(output_folder) if output_folder is not None else None
+        # rows of the bit matrix are added in order of first labels of images (rows are not freed,
+        # unlabeled images just have no bits set)
+        self.num_rows = 0
+        self.bits = np.zeros((max(1, capacity), 0), dtype=np.uint8)
+        # code of the first label of every row, -1 for unlabeled images
+        self.first_codes = np.full(len(self.bits), -1, dtype=np.int32)
+        # sorted utf8 names of images (for binary search) and their rows, names of rows added since
+        # the last sort are kept in a dict until there are many of them
+        self._sorted_names = np.zeros(0, dtype='S1')
+        self._sorted_rows = np.zeros(0, dtype=np.int32)
+        self._new_rows = {}
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.num_assignments = 0
+        self.num_labeled = 0
+        for label in labels:
+            self.code(label)
+        self.assigned_labels = FirstLabels(self)
+        self.journal = None
+        self.read_only = read_only
+
+        if output_folder is not None:
+            self.journal = MultiLabelJournal(os.path.join(output_folder, 'multilabels.journal'))
+            if not read_only:
+                make_folder(output_folder)
+                self.journal.lock()
+            records = self.journal.replay()
+            # rows of a chunk of records are found at once
+            for chunk in iter(lambda: list(itertools.islice(records, 65536)), []):
+                rows = self._rows([img_name for img_name, _, _ in chunk], add=True)
+                for row, (_, label, added) in zip(rows.tolist(), chunk):
+                    code = self.code(label)
+                    if added:
+                        self.bits[row, code >> 3] |= 0x80 >> (code & 7)
+                    else:
+                        self.bits[row, code >> 3] &= ~(0x80 >> (code & 7)) & 0xff
+            self._sort_rows()
+            self._recount()
+            if not read_only:
+                if self.journal.needs_compaction(self.num_assignments):
+                    self.journal.compact(self)
+                self.journal.open()
+
+    @classmethod
+    def open(cls, input_folder, labels=None, read_only=False):
+        """
+        Loads multi-label session of the folder with images
+        :param labels: list of labels. If None, labels saved with the session are used.
+        :param read_only: if True, the session is only read (it can be open in the labeler at the same time)
+        """
+        output_folder = os.path.join(input_folder, 'output')
+        if labels is None:
+            labels = LabelStore.load_session_labels(output_folder)
+        store = cls(labels or [], output_folder, read_only=read_only)
+        if store.labels and not read_only:
+            store.save_session()
+        return store
+
+    def save_session(self):
+        if self.output_folder is None:
+            return
+        session_path = os.path.join(self.output_folder, 'session.json')
+        tmp_path = session_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            session = {'labels': self.labels, 'multi_label': True}
+            if self.mode is not None:
+                session['mode'] = self.mode
+            json.dump(session, f)
+        os.replace(tmp_path, session_path)
+
+    def code(self, label):
+        """
+        :return: column of the label, labels which are not known yet are added
+        """
+        code = self._codes_of.get(label)
+        if code is None:
+            code = self._codes_of[label] = len(self.labels)
+            self.labels.append(label)
+            self.counts = np.append(self.counts, 0)
+            if len(self.labels) > 8 * self.bits.shape[1]:
+                self.bits = np.pad(self.bits, ((0, 0), (0, 1)))
+        return code
+
+    def _rows(self, img_names, add=False):
+        """
+        :param img_names: list of image names
+        :param add: if True, images which have no row yet are added
+        :return: int64 array of rows of the images, -1 for images which have no row
+        """
+        rows = np.full(len(img_names), -1, dtype=np.int64)
+        if not len(img_names):
+            return rows
+        if len(self._sorted_names):
+            keys = np.array([img_name.encode('utf8') for img_name in img_names])
+            # keys are cut to the width of names (a longer name can't match), so names are not cast to keys
+            positions = np.searchsorted(self._sorted_names, keys.astype(self._sorted_names.dtype))
+            positions = np.minimum(positions, len(self._sorted_names) - 1)
+            found = self._sorted_names[positions] == keys
+            rows[found] = self._sorted_rows[positions[found]]
+        if self._new_rows or add:
+            for i in np.flatnonzero(rows < 0).tolist():
+                row = self._new_rows.get(img_names[i], -1)
+                if row < 0 and add:
+                    row = self._add_row(img_names[i])
+                rows[i] = row
+            if len(self._new_rows) > max(4096, len(self._sorted_names) // 8):
+                self._sort_rows()
+        return rows
+
+    def _add_row(self, img_name):
+        row = self._new_rows[img_name] = self.num_rows
+        self.num_rows += 1
+        if row == len(self.bits):
+            # arrays grow in place, instead of being copied to larger ones while the old ones are kept
+            capacity = row + max(1024, row // 4)
+            self.bits.resize((capacity, self.bits.shape[1]), refcheck=False)
+            self.first_codes.resize(capacity, refcheck=False)
+            self.first_codes[row:] = -1
+        return row
+
+    def _sort_rows(self):
+        """
+        Merges names of rows added since the last sort to the sorted names
+        """
+        if not self._new_rows:
+            return
+        names = np.concatenate([self._sorted_names,
+                                np.array([img_name.encode('utf8') for img_name in self._new_rows])])
+        rows = np.concatenate([self._sorted_rows, np.fromiter(self._new_rows.values(), dtype=np.int32)])
+        self._new_rows = {}
+        order = np.argsort(names, kind='stable')
+        self._sorted_names, self._sorted_rows = names[order], rows[order]
+
+    def find_row(self, img_name):
+        """
+        :return: row of the image, None if it has no row
+        """
+        row = int(self._rows([img_name])[0])
+        return None if row < 0 else row
+
+    def _unpack(self, rows):
+        """
+        :return: uint8 multi-hot matrix (rows x labels)
+        """
+        return np.unpackbits(self.bits[rows], axis=1, count=len(self.labels))
+
+    def _first_codes(self, multi_hot):
+        return np.where(multi_hot.any(axis=1), multi_hot.argmax(axis=1), -1).astype(np.int32)
+
+    def _recount(self, chunk_size=65536):
+        """
+        Computes counts of labels and first labels of all rows from the bit matrix
+        """
+        self.counts = np.zeros(len(self.labels), dtype=np.int64)
+        for start in range(0, self.num_rows, chunk_size):
+            multi_hot = self._unpack(slice(start, min(start + chunk_size, self.num_rows)))
+            self.counts += multi_hot.sum(axis=0, dtype=np.int64)
+            self.first_codes[start:start + len(multi_hot)] = self._first_codes(multi_hot)
+        self.num_assignments = int(self.counts.sum())
+        self.num_labeled = int(np.count_nonzero(self.first_codes[:self.num_rows] >= 0))
+
+    def labeled_rows(self, chunk_size=65536):
+        """
+        :return: generator of (image names, array of rows) of images with at least one label in chunks,
+        in order of image names
+        """
+        self._sort_rows()
+        labeled = np.flatnonzero(self.first_codes[self._sorted_rows] >= 0)
+        for start in range(0, len(labeled), chunk_size):
+            positions = labeled[start:start + chunk_size]
+            yield ([name.decode('utf8') for name in self._sorted_names[positions].tolist()],
+                   self._sorted_rows[positions])
+
+    def get(self, img_name):
+        """
+        :return: list of labels of the image (empty if it has none)
+        """
+        row = self.find_row(img_name)
+        if row is None or self.first_codes[row] < 0:
+            return []
+        return [self.labels[code] for code in np.flatnonzero(self._unpack([row])[0]).tolist()]
+
+    def has_label(self, img_name, label):
+        row = self.find_row(img_name)
+        code = self._codes_of.get(label)
+        return row is not None and code is not None and bool(self.bits[row, code >> 3] & (0x80 >> (code & 7)))
+
+    def set_label(self, img_name, label, value=True):
+        self.set_labels([img_name], label, value)
+
+    def set_labels(self, img_names, label, value=True):
+        """
+        Adds the label to many images or removes it from them (journaled with one write)
+        :param label: label to add or remove, None removes all labels of the images
+        :param value: True to add the label, False to remove it
+        :return: names of images whose labels changed
+        """
+        if label is None:
+            return self.clear(img_names)
+        # first position of every row in img_names (names of changed images are taken from it)
+        rows, positions = np.unique(self._rows(img_names, add=value), return_index=True)
+        rows, positions = rows[rows >= 0], positions[rows >= 0]
+        code = self.code(label)
+        column, mask = code >> 3, np.uint8(0x80 >> (code & 7))
+        is_changed = ((self.bits[rows, column] & mask) != 0) != value
+        changed = rows[is_changed]
+        if not len(changed):
+            return []
+
+        first_codes = self.first_codes[changed]
+        if value:
+            self.bits[changed, column] |= mask
+            self.num_labeled += int(np.count_nonzero(first_codes < 0))
+            self.first_codes[changed] = np.where((first_codes < 0) | (code < first_codes), code, first_codes)
+        else:
+            self.bits[changed, column] &= ~mask
+            # only rows which lost their first label need the next one
+            lost_first = changed[first_codes == code]
+            self.first_codes[lost_first] = self._first_codes(self._unpack(lost_first))
+            self.num_labeled -= int(np.count_nonzero(self.first_codes[lost_first] < 0))
+        self.counts[code] += len(changed) if value else -len(changed)
+        self.num_assignments += len(changed) if value else -len(changed)
+
+        changed_names = [img_names[i] for i in positions[is_changed].tolist()]
+        if self.journal is not None:
+            self.journal.append_many(changed_names, label, value, self)
+        return changed_names
+
+    def toggle(self, img_names, label):
+        """
+        Adds the label to the images, or removes it if all of them already have it
+        :return: True if the label was added, False if it was removed
+        """
+        rows = self._rows(img_names)
+        code = self._codes_of.get(label)
+        value = code is None or bool((rows < 0).any()) or \
+            not (self.bits[rows, code >> 3] & (0x80 >> (code & 7))).all()
+        self.set_labels(img_names, label, value)
+        return value
+
+    def clear(self, img_names):
+        """
+        Removes all labels of the images
+        :return: names of images whose labels changed
+        """
+        rows = self._rows(img_names)
+        found = np.flatnonzero(rows >= 0)
+        multi_hot = self._unpack(rows[found])
+        changed = set()
+        for code in np.flatnonzero(multi_hot.any(axis=0)).tolist():
+            changed.update(self.set_labels([img_names[i] for i in found[multi_hot[:, code] != 0].tolist()],
+                                           self.labels[code], False))
+        return list(changed)
+
+    def __len__(self):
+        return self.num_labeled
+
+    def count_by_label(self):
+        """
+        :return: dict label -> number of images (all labels of the session are included)
+        """
+        return dict(zip(self.labels, self.counts.tolist()))
+
+    def multi_hot_rows(self, chunk_size=65536):
+        """
+        :return: generator of (image names, uint8 multi-hot matrix) of labeled images in chunks, so the whole
+        matrix is never unpacked at once
+        """
+        for img_names, rows in self.labeled_rows(chunk_size):
+            yield img_names, self._unpack(rows)
+
+    def items(self):
+        """
+        :return: generator of (image name, label) for every label of every image
+        """
+        for img_names, multi_hot in self.multi_hot_rows():
+            rows, codes = np.nonzero(multi_hot)
+            for row, code in zip(rows.tolist(), codes.tolist()):
+                yield img_names[row], self.labels[code]
+
+    def filter(self, label=None, pattern=None):
+        """
+        :param label: keep only images with this label
+        :param pattern: keep only images whose names match the glob pattern
+        :return: list of (image name, list of labels) tuples
+        """
+        code = self._codes_of.get(label)
+        if label is not None and code is None:
+            return []
+        filtered = []
+        for img_names, multi_hot in self.multi_hot_rows():
+            for img_name, row in zip(img_names, multi_hot):
+                if (code is None or row[code]) and (pattern is None or fnmatch.fnmatch(img_name, pattern)):
+                    filtered.append((img_name, [self.labels[i] for i in np.flatnonzero(row).tolist()]))
+        return filtered
+
+    def merge(self, other):
+        """
+        Adds labels of another session (LabelStore or MultiLabelStore), images get union of their labels
+        :return: list of conflicts (always empty, any set of labels is valid)
+        """
+        pairs = other.items() if isinstance(other, MultiLabelStore) else other.assigned_labels.items()
+        new_names = {}
+        for img_name, label in pairs:
+            new_names.setdefault(label, []).append(img_name)
+        # set_labels changes only images which don't have the label yet
+        for label, img_names in new_names.items():
+            self.set_labels(img_names, label)
+        return []
+
+    def reconcile(self, folder_labels, csv_labels=()):
+        """
+        Restores labels of images which have no labels in the journal (e.g. it was deleted) from label folders
+        and from csv saved by a previous session. Labels of images found in label folders are not taken from the csv.
+        :param folder_labels: iterable of (image name, label folder the image was found in)
+        :param csv_labels: iterable of (image name, label) read from the csv
+        :return: (number of labels restored from label folders, number of labels restored from the csv,
+        list of conflicts (always empty, any set of labels is valid))
+        """
+        restored = {}
+        folder_labels = list(folder_labels)
+        for (img_name, label), unlabeled in zip(folder_labels, self._unlabeled(folder_labels)):
+            if unlabeled:
+                restored.setdefault(label, set()).add(img_name)
+        in_folders = set().union(*restored.values())
+        num_from_folders = sum(len(img_names) for img_names in restored.values())
+
+        num_from_csv = 0
+        csv_labels = list(csv_labels)
+        for (img_name, label), unlabeled in zip(csv_labels, self._unlabeled(csv_labels)):
+            if unlabeled and img_name not in in_folders:
+                restored.setdefault(label, set()).add(img_name)
+                num_from_csv += 1
+
+        for label, img_names in restored.items():
+            self.set_labels(sorted(img_names), label)
+        return num_from_folders, num_from_csv, []
+
+    def _unlabeled(self, pairs):
+        """
+        :param pairs: list of (image name, label)
+        :return: list of True for images which have no labels
+        """
+        rows = self._rows([img_name for img_name, _ in pairs])
+        return ((rows < 0) | (self.first_codes[rows] < 0)).tolist()
+
+    def labels_to_zero_one(self, labels):
+        """
+        change the labels to multi-hot vector
+        :param labels: label or list of labels
+        """
+        if isinstance(labels, str):
+            labels = [labels]
+        zero_one_arr = np.zeros([len(self.labels)], dtype=int)
+        for label in labels:
+            if label in self._codes_of:
+                zero_one_arr[self._codes_of[label]] = 1
+        return zero_one_arr
+
+    def export_csv(self, csv_file_path, chunk_size=65536):
+        """
+        Saves csv file with assigned labels as multi-hot vectors. Digits and commas of a chunk of rows are
+        built as one byte array from the unpacked bits.
+        """
+        width = 2 * len(self.labels)
+        with open(csv_file_path, "w", newline='', buffering=1024 * 1024) as csv_file:
+            # write header
+            csv.writer(csv_file, delimiter=',').writerow(['img'] + self.labels)
+
+            # write multi-hot labels
+            for img_names, multi_hot in self.multi_hot_rows(chunk_size):
+                chars = np.full((len(img_names), width), ord(','), dtype=np.uint8)
+                chars[:, 1::2] = multi_hot + ord('0')
+                text = chars.tobytes().decode('ascii')
+                csv_file.write(''.join(csv_field(img_name) + text[i * width:(i + 1) * width] + '\r\n'
+                                       for i, img_name in enumerate(img_names)))
+
+    def export_npz(self, npz_file_path):
+        """
+        Saves labels to .npz file with arrays 'img' (image names), 'labels' (label names), 'multi_hot'
+        (images x labels uint8 matrix) and 'packed' (the same matrix packed by np.packbits along rows).
+        The multi-hot matrix is written in chunks, so it's never unpacked whole in memory.
+        """
+        chunks = list(self.labeled_rows())
+        arrays = {
+            'img': np.array([img_name for img_names, _ in chunks for img_name in img_names], dtype=str),
+            'labels': np.array(self.labels, dtype=str),
+            'packed': self.bits[np.concatenate([rows for _, rows in chunks] + [np.zeros(0, dtype=np.int32)])],
+        }
+        # the same layout as np.savez (uncompressed zip of .npy files)
+        with zipfile.ZipFile(npz_file_path, 'w', allowZip64=True) as npz:
+            for name, array in arrays.items():
+                with npz.open(name + '.npy', 'w', force_zip64=True) as f:
+                    np.lib.format.write_array(f, array)
+            with npz.open('multi_hot.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array_header_1_0(f, {'descr': '|u1', 'fortran_order': False,
+                                                         'shape': (self.num_labeled, len(self.labels))})
+                for _, multi_hot in self.multi_hot_rows():
+                    f.write(multi_hot.tobytes())
+
+    def export_npy(self, path_prefix):
+        """
+        Saves labels to separate .npy files which can be memory-mapped with np.load(path, mmap_mode='r'):
+        <prefix>_multi_hot.npy, <prefix>_packed.npy and <prefix>_img.txt/<prefix>_labels.txt with names
+        """
+        rows = [rows for _, rows in self.labeled_rows()] + [np.zeros(0, dtype=np.int32)]
+        np.save(path_prefix + '_packed.npy', self.bits[np.concatenate(rows)])
+        multi_hot_file = np.lib.format.open_memmap(path_prefix + '_multi_hot.npy', 'w+', np.uint8,
+                                                   (self.num_labeled, len(self.labels)))
+        start = 0
+        with open(path_prefix + '_img.txt', 'w', encoding='utf8') as f:
+            for img_names, multi_hot in self.multi_hot_rows():
+                multi_hot_file[start:start + len(multi_hot)] = multi_hot
+                start += len(multi_hot)
+                f.write(''.join(img_name + '\n' for img_name in img_names))
+        multi_hot_file.flush()
+        del multi_hot_file
+        with open(path_prefix + '_labels.txt', 'w', encoding='utf8') as f:
+            f.write(''.join(label + '\n' for label in self.labels))
+
+    def export_xlsx(self, xlsx_file_path):
+        """
+        Saves xlsx file with assigned labels (same content as csv) using XlsxWriter constant memory mode
+        """
+        if self.num_labeled + 1 > XLSX_MAX_ROWS:
+            raise ValueError(f'xlsx supports at most {XLSX_MAX_ROWS - 1} labeled images, '
+                             f'session has {self.num_labeled}. Use csv or npz export.')
+
+        from xlsxwriter.workbook import Workbook
+
+        workbook = Workbook(xlsx_file_path, {'constant_memory': True})
+        try:
+            worksheet = workbook.add_worksheet()
+            worksheet.write_row(0, 0, ['img'] + self.labels)
+            r = 1
+            for img_names, multi_hot in self.multi_hot_rows():
+                for img_name, row in zip(img_names, multi_hot.tolist()):
+                    worksheet.write_string(r, 0, img_name)
+                    worksheet.write_row(r, 1, row)
+                    r += 1
+        finally:
+            workbook.close()
+
+    def sync(self):
+        if self.journal is not None:
+            self.journal.sync()
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+
+
+def open_label_store(input_folder, labels=None, read_only=False):
+    """
+    Loads session of the folder with images as LabelStore or as MultiLabelStore if it's a multi-label session
+    :param read_only: if True, the session is only read (it can be open in the labeler at the same time)
+    """
+    multi_label = LabelStore.load_session_multi_label(os.path.join(input_folder, 'output'))
+    return (MultiLabelStore if multi_label else LabelStore).open(input_folder, labels, read_only)
+
+
+class LabelIndex:
+    """
+    Labels of images by their position in navigation order, so counts of labels and the next or previous
+    image with a label (or without any) are found without going through all images.
+    Label of every position is kept as a small integer in a NumPy array and images of every label are
+    counted in blocks of positions. Counts are O(1) and search skips whole blocks without the label,
+    so both stay well under a millisecond with millions of images. Inserted and removed images only change
+    counts of their blocks and shift starts of later blocks, blocks are split evenly again when some of them
+    grow to twice their size (or most of them are empty).
+    """
+
+    def __init__(self, labels, block_size=4096):
+        self.labels = list(labels)
+        self._codes_of = {label: code for code, label in enumerate(self.labels)}
+        self.block_size = block_size
+        # code of the label of every position, -1 for unlabeled images
+        self.codes = np.zeros(0, dtype=np.int32)
+        # first position of every block, a block ends where the next one starts
+        self.block_starts = np.zeros(1, dtype=np.int64)
+        # [code + 1, block] -> number of images with the label in the block
+        self.block_counts = np.zeros((len(self.labels) + 1, 1), dtype=np.int64)
+        self.counts = np.zeros(len(self.labels) + 1, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def code(self, label):
+        """
+        :return: code of the label (-1 for None), labels which are not known yet are added
+        """
+        if label is None:
+            return -1
+        code = self._codes_of.get(label)
+        if code is None:
+            code = self._codes_of[label] = len(self.labels)
+            self.labels.append(label)
+            self.block_counts = np.vstack([self.block_counts, np.zeros((1, self.block_counts.shape[1]), np.int64)])
+            self.counts = np.append(self.counts, 0)
+        return code
+
+    def _codes(self, labels):
+        return np.array([self.code(label) for label in labels], dtype=np.int32)
+
+    def reset(self, labels):
+        """
+        :param labels: label (or None) of every position
+        """
+        self.codes = self._codes(labels)
+        self._recount()
+
+    def append(self, labels):
+        codes = self._codes(labels)
+        start = len(self.codes)
+        self.codes = np.concatenate([self.codes, codes])
+        # the last block is filled up, then new blocks are started
+        first_new = max(start, int(self.block_starts[-1]) + self.block_size)
+        new_starts = np.arange(first_new, len(self.codes), self.block_size, dtype=np.int64)
+        if len(new_starts):
+            self.block_starts = np.concatenate([self.block_starts, new_starts])
+            self.block_counts = np.pad(self.block_counts, ((0, 0), (0, len(new_starts))))
+        self._add_counts(codes, self._blocks(np.arange(start, len(self.codes))), 1)
+
+    def insert(self, positions, labels):
+        """
+        :param positions: positions before which the images are inserted (in the index before the insert)
+        :param labels: labels of the inserted images
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        codes = self._codes(labels)
+        # images are added to the block of the position they are inserted at, later blocks are shifted
+        blocks = self._blocks(positions)
+        self.codes = np.insert(self.codes, positions, codes)
+        self._add_counts(codes, blocks, 1)
+        self._shift_blocks(blocks, 1)
+        if len(self.codes) and self._block_sizes().max() > 2 * self.block_size:
+            self._recount()
+
+    def remove(self, positions):
+        positions = np.unique(np.asarray(positions, dtype=np.int64))
+        blocks = self._blocks(positions)
+        self._add_counts(self.codes[positions], blocks, -1)
+        self.codes = np.delete(self.codes, positions)
+        self._shift_blocks(blocks, -1)
+        if len(self.block_starts) > 4 * max(1, -(-len(self.codes) // self.block_size)):
+            self._recount()
+
+    def _recount(self):
+        num_blocks = max(1, -(-len(self.codes) // self.block_size))
+        self.block_starts = np.arange(num_blocks, dtype=np.int64) * self.block_size
+        blocks = np.arange(len(self.codes)) // self.block_size
+        flat = np.bincount((self.codes.astype(np.int64) + 1) * num_blocks + blocks,
+                           minlength=(len(self.labels) + 1) * num_blocks)
+        self.block_counts = flat.reshape(len(self.labels) + 1, num_blocks)
+        self.counts = self.block_counts.sum(axis=1)
+
+    def _blocks(self, positions):
+        """
+        :return: block of every position (empty blocks are skipped, position past the end is in the last block)
+        """
+        return np.searchsorted(self.block_starts, positions, side='right') - 1
+
+    def _block_end(self, block):
+        return int(self.block_starts[block + 1]) if block + 1 < len(self.block_starts) else len(self.codes)
+
+    def _block_sizes(self):
+        return np.diff(self.block_starts, append=len(self.codes))
+
+    def _add_counts(self, codes, blocks, sign):
+        np.add.at(self.block_counts, (codes + 1, blocks), sign)
+        np.add.at(self.counts, codes + 1, sign)
+
+    def _shift_blocks(self, blocks, sign):
+        """
+        Moves starts of blocks after the blocks where images were inserted (sign 1) or removed (sign -1)
+        """
+        changed = np.bincount(blocks, minlength=len(self.block_starts))
+        self.block_starts[1:] += sign * np.cumsum(changed)[:-1]
+
+    def set(self, positions, label):
+        """
+        Sets the same label (or None) to images at given positions
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        code = self.code(label)
+        old_codes = self.codes[positions]
+        blocks = self._blocks(positions)
+        np.subtract.at(self.block_counts, (old_codes + 1, blocks), 1)
+        np.add.at(self.block_counts, (code + 1, blocks), 1)
+        np.subtract.at(self.counts, old_codes + 1, 1)
+        self.counts[code + 1] += len(positions)
+        self.codes[positions] = code
+
+    def count(self, label):
+        """
+        :return: number of images with the label (None for number of unlabeled images)
+        """
+        code = self._codes_of.get(label, -2) if label is not None else -1
+        return int(self.counts[code + 1]) if code >= -1 else 0
+
+    def count_by_label(self):
+        """
+        :return: dict label -> number of images (all labels are included)
+        """
+        return {label: int(self.counts[code + 1]) for code, label in enumerate(self.labels)}
+
+    def find(self, position, label, step=1):
+        """
+        :param label: label to find (None for unlabeled image)
+        :param step: 1 to find the nearest image after the position, -1 before it
+        :return: position of the nearest image with the label or None if there is no such image
+        """
+        target = self.code(label)
+        row = self.block_counts[target + 1]
+        starts = self.block_starts
+
+        if step > 0:
+            start = position + 1
+            if start >= len(self.codes):
+                return None
+            block = int(self._blocks(start))
+            hits = np.flatnonzero(self.codes[start:self._block_end(block)] == target)
+            if len(hits):
+                return start + int(hits[0])
+            later = np.flatnonzero(row[block + 1:])
+            if not len(later):
+                return None
+            block += 1 + int(later[0])
+            hits = np.flatnonzero(self.codes[starts[block]:self._block_end(block)] == target)
+            return int(starts[block]) + int(hits[0])
+
+        end = min(position, len(self.codes))
+        if end <= 0:
+            return None
+        block = int(self._blocks(end - 1))
+        hits = np.flatnonzero(self.codes[starts[block]:end] == target)
+        if len(hits):
+            return int(starts[block]) + int(hits[-1])
+        earlier = np.flatnonzero(row[:block])
+        if not len(earlier):
+            return None
+        block = int(earlier[-1])
+        hits = np.flatnonzero(self.codes[starts[block]:self._block_end(block)] == target)
+        return int(starts[block]) + int(hits[-1])
+
+
+class Materializer:
+    """
+    Places labeled images into label folders in one batch ("commit"), using the final label of every image.
+
+    What was already placed is recorded in an append-only journal (output/materialized.journal), so
+    commit only touches images whose label changed since the last commit, it can be interrupted and
+    resumed, and running it again does nothing. Every operation is derived from where the image is
+    on disk, so operations interrupted by a crash are safe to repeat.
+
+    In multi-label sessions an image is copied or linked into the folder of each of its labels, every
+    placed file (label/image name) is journaled separately.
+    """
+
+    def __init__(self, input_folder, labels, mode=None, num_threads=8, output_folder=None, multi_label=False):
+        """
+        :param mode: 'move', 'copy' or 'link'. If None, mode of previous commits is used ('move' by default,
+        'copy' in multi-label sessions).
+        :param output_folder: folder for the journal (default: 'output' subfolder of input folder)
+        :param multi_label: if True, images are placed into folders of all their labels ('move' is not possible)
+        """
+        self.input_folder = input_folder
+        self.labels = list(labels)
+        self.num_threads = num_threads
+        self.multi_label = multi_label
+
+        output_folder = output_folder or os.path.join(input_folder, 'output')
+        make_folder(output_folder)
+        self.mode_path = os.path.join(output_folder, 'materialized.json')
+        journal_name = 'materialized_multi.journal' if multi_label else 'materialized.journal'
+        self.journal = LabelJournal(os.path.join(output_folder, journal_name))
+        self.journal.lock()
+        # image name (label/image name in multi-label sessions) -> label folder the image is placed in
+        self.placements = self.journal.replay()
+        self.journal.open()
+        self._lock = threading.Lock()
+
+        self.mode = 'copy' if multi_label else 'move'
+        if os.path.exists(self.mode_path):
+            with open(self.mode_path, encoding='utf8') as f:
+                self.mode = json.load(f)['mode']
+        if mode is not None:
+            try:
+                self.set_mode(mode)
+            except ValueError:
+                self.journal.close()
+                raise
+
+    def set_mode(self, mode):
+        """
+        Sets mode of placing the images. It can't be changed once some images are placed.
+        """
+        if mode not in ('move', 'copy', 'link'):
+            raise ValueError(f'Unknown commit mode: {mode}')
+        if mode == 'move' and self.multi_label:
+            raise ValueError('Images of multi-label sessions can only be copied or linked into label folders')
+        if mode != self.mode and self.placements:
+            raise ValueError(f'Images in {self.input_folder} were already committed in mode {self.mode}')
+        self.mode = mode
+        with open(self.mode_path, 'w', encoding='utf8') as f:
+            json.dump({'mode': mode}, f)
+
+    def placement(self, img_name):
+        """
+        :return: label folder the image was placed into by the last commit (None if it's not placed)
+        """
+        return self.placements.get(img_name)
+
+    def _key(self, img_name, label):
+        """
+        :return: key of the placement in the journal
+        """
+        return f'{label}/{img_name}' if self.multi_label else img_name
+
+    def pending(self, assigned_labels):
+        """
+        :param assigned_labels: dict image name -> label or iterable of (image name, label) pairs
+        (multi-label sessions have a pair for every label of the image)
+        :return: list of (image name, target label, placed label) for images whose placement doesn't match
+        their labels (target None means the image should be removed from the folder of the placed label)
+        """
+        if not self.multi_label:
+            assigned_labels = dict(assigned_labels)
+            pending = [(img_name, label, self.placements.get(img_name))
+                       for img_name, label in assigned_labels.items() if self.placements.get(img_name) != label]
+            pending.extend((img_name, None, label) for img_name, label in self.placements.items()
+                           if img_name not in assigned_labels)
+            return pending
+
+        keys = set()
+        pending = []
+        for img_name, label in assigned_labels:
+            key = self._key(img_name, label)
+            keys.add(key)
+            if key not in self.placements:
+                pending.append((img_name, label, None))
+        pending.extend((key[len(label) + 1:], None, label) for key, label in self.placements.items()
+                       if key not in keys)
+        return pending
+
+    def commit(self, assigned_labels, progress=None, progress_every=100):
+        """
+        Applies final labels to the label folders on a thread pool
+        :param assigned_labels: dict image name -> label or iterable of (image name, label) pairs
+        (a snapshot is taken)
+        :param progress: callback(done, total) called from the calling thread
+        :return: list of failures (image name, target label, error message)
+        """
+        with self._lock:
+            pending = self.pending(assigned_labels)
+            total = len(pending)
+            failed = []
+            done = 0
+            if progress is not None:
+                progress(done, total)
+
+            with ThreadPoolExecutor(self.num_threads) as executor:
+                futures = {executor.submit(place_image, self.input_folder, self.labels, img_name, label, placed,
+                                           self.mode): (img_name, label, placed)
+                           for img_name, label, placed in pending}
+                for future in as_completed(futures):
+                    img_name, label, placed = futures[future]
+                    try:
+                        future.result()
+                    except OSError as e:
+                        failed.append((img_name, label, str(e)))
+                    else:
+                        key = self._key(img_name, placed if label is None else label)
+                        if label is None:
+                            self.placements.pop(key, None)
+                        else:
+                            self.placements[key] = label
+                        self.journal.append(key, label, self.placements)
+
+                    done += 1
+                    if progress is not None and (done % progress_every == 0 or done == total):
+                        progress(done, total)
+
+            self.journal.sync()
+            return failed
+
+    def close(self):
+        self.journal.close()
+
+
+def annotator_folder(input_folder, annotator):
+    """
+    :return: output folder of the annotator in a sharded session
+    """
+    safe_name = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in annotator)
+    return os.path.join(input_folder, 'output', 'annotators', safe_name)
+
+
+class ShardSpec:
+    """
+    Deterministic assignment of images to one of several annotators.
+
+    With 'hash' strategy, image belongs to the shard given by hash of its name, so shards can be computed
+    while the folder is still being scanned and they don't change when images are added. With 'range'
+    strategy, the sorted list of images is split into contiguous blocks. A fraction of images
+    (overlap, chosen by another hash) is given to every annotator, so agreement can be measured.
+    """
+
+    def __init__(self, index, count, strategy='hash', overlap=0.0):
+        """
+        :param index: index of the shard (0 <= index < count)
+        :param count: number of shards (annotators)
+        :param strategy: 'hash' or 'range'
+        :param overlap: fraction of images labeled by all annotators (0 - 1)
+        """
+        if not 0 <= index < count:
+            raise ValueError(f'Shard index has to be between 0 and {count - 1}')
+        if strategy not in ('hash', 'range'):
+            raise ValueError(f'Unknown shard strategy: {strategy}')
+        self.index = index
+        self.count = count
+        self.strategy = strategy
+        self.overlap = overlap
+
+    @staticmethod
+    def _hash(img_name, salt):
+        return int.from_bytes(hashlib.blake2b(f'{salt}:{img_name}'.encode('utf8'), digest_size=8).digest(), 'big')
+
+    def is_overlap(self, img_name):
+        return self.overlap > 0 and self._hash(img_name, 'overlap') % 10000 < self.overlap * 10000
+
+    def contains(self, img_name):
+        """
+        :return: if the image belongs to this shard (only for 'hash' strategy)
+        """
+        return self.is_overlap(img_name) or self._hash(img_name, 'shard') % self.count == self.index
+
+    def select(self, img_names):
+        """
+        :param img_names: sorted list of all image names
+        :return: list of booleans, True for images of this shard
+        """
+        if self.strategy == 'hash':
+            return [self.contains(img_name) for img_name in img_names]
+
+        overlap = [self.is_overlap(img_name) for img_name in img_names]
+        num_other = len(img_names) - sum(overlap)
+        first = self.index * num_other // self.count
+        last = (self.index + 1) * num_other // self.count
+        selected = []
+        position = 0
+        for is_overlap in overlap:
+            if is_overlap:
+                selected.append(True)
+            else:
+                selected.append(first <= position < last)
+                position += 1
+        return selected
+
+
+def cohen_kappa(labels_a, labels_b):
+    """
+    :return: Cohen's kappa of two lists of labels of the same images
+    """
+    n = len(labels_a)
+    if n == 0:
+        return None
+    observed = sum(a == b for a, b in zip(labels_a, labels_b)) / n
+    counts_a = Counter(labels_a)
+    counts_b = Counter(labels_b)
+    expected = sum(counts_a[label] * counts_b[label] for label in counts_a) / (n * n)
+    if expected == 1:
+        return 1.0
+    return (observed - expected) / (1 - expected)
+
+
+def merge_annotators(input_folder, labels=None):
+    """
+    Merges labels of all annotators of a sharded session into the main session of the folder
+    and exports them to 'output/assigned_classes_merged.csv'.
+    Images labeled differently by several annotators get the majority label; ties are left unlabeled.
+    Both are reported in 'output/merge_conflicts.csv'.
+    :return: report dict (number of merged images, conflicts and pairwise agreement of annotators)
+    """
+    annotators_root = os.path.join(input_folder, 'output', 'annotators')
+    annotators = sorted(name for name in (os.listdir(annotators_root) if os.path.isdir(annotators_root) else [])
+                        if os.path.exists(os.path.join(annotators_root, name, 'labels.journal')))
+    if not annotators:
+        raise ValueError(f'{input_folder} has no annotators (no labels in {annotators_root})')
+
+    # image name -> {annotator: label}
+    votes = {}
+    all_labels = list(labels or [])
+    for annotator in annotators:
+        store = LabelStore(labels or [], os.path.join(annotators_root, annotator), read_only=True)
+        if labels is None:
+            session_labels = LabelStore.load_session_labels(os.path.join(annotators_root, annotator)) or []
+            all_labels.extend(label for label in session_labels if label not in all_labels)
+        for img_name, label in store.assigned_labels.items():
+            votes.setdefault(img_name, {})[annotator] = label
+        store.close()
+
+    merged = {}
+    conflicts = []
+    for img_name, image_votes in votes.items():
+        (label, count), *others = Counter(image_votes.values()).most_common()
+        if others and others[0][1] == count:
+            conflicts.append((img_name, image_votes))
+            continue
+        if others:
+            conflicts.append((img_name, image_votes))
+        merged.setdefault(label, []).append(img_name)
+
+    store = LabelStore.open(input_folder, all_labels or None)
+    for label, img_names in merged.items():
+        if label not in store.labels:
+            store.labels.append(label)
+        store.set_labels(img_names, label)
+    store.save_session()
+    store.export_csv(os.path.join(input_folder, 'output', 'assigned_classes_merged.csv'))
+    store.close()
+
+    # agreement of every pair of annotators on images labeled by both
+    agreement = []
+    for annotator_a, annotator_b in itertools.combinations(annotators, 2):
+        pairs = [(image_votes[annotator_a], image_votes[annotator_b]) for image_votes in votes.values()
+                 if annotator_a in image_votes and annotator_b in image_votes]
+        labels_a = [a for a, _ in pairs]
+        labels_b = [b for _, b in pairs]
+        agreement.append({
+            'annotators': [annotator_a, annotator_b],
+            'overlap': len(pairs),
+            'agreement': sum(a == b for a, b in pairs) / len(pairs) if pairs else None,
+            'kappa': cohen_kappa(labels_a, labels_b),
+        })
+
+    conflicts_path = os.path.join(input_folder, 'output', 'merge_conflicts.csv')
+    with open(conflicts_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['img'] + annotators)
+        for img_name, image_votes in conflicts:
+            writer.writerow([img_name] + [image_votes.get(annotator, '') for annotator in annotators])
+
+    report = {
+        'annotators': annotators,
+        'merged': sum(len(img_names) for img_names in merged.values()),
+        'conflicts': len(conflicts),
+        'unresolved': len(votes) - sum(len(img_names) for img_names in merged.values()),
+        'agreement': agreement,
+    }
+    with open(os.path.join(input_folder, 'output', 'merge_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+# maximal number of rows in xlsx worksheet
+XLSX_MAX_ROWS = 1048576
+
+
+def csv_field(value):
+    """
+    Quotes the value the same way as csv.writer with default (minimal) quoting
+    """
+    if any(c in value for c in ',"\r\n'):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+def read_labels_csv(csv_file_path):
+    """
+    Reads csv file saved by export_csv (one-hot or multi-hot rows). Rows are split by hand, only names
+    in quotes are parsed by the csv module.
+    :return: generator of (image name, label) for every label of every image
+    """
+    # the same encoding as export_csv
+    with open(csv_file_path, newline='') as f:
+        header = next(csv.reader([f.readline()]), None)
+        if not header:
+            return
+        labels = header[1:]
+        for line in f:
+            line = line.rstrip('\r\n')
+            if line.startswith('"'):
+                row = next(csv.reader([line]))
+                img_name, digits = row[0], ''.join(row[1:])
+            else:
+                img_name, _, values = line.partition(',')
+                digits = values[::2]
+            position = digits.find('1')
+            while position >= 0:
+                if position < len(labels):
+                    yield img_name, labels[position]
+                position = digits.find('1', position + 1)
+
+
+def read_labels_file(path):
+    """
+    :return: list of labels from text file with one label on each line
+    """
+    with open(path) as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Query and export labels of annotation sessions without the GUI.')
+    parser.add_argument('folder', help='folder with labeled images (its output subfolder contains the session)')
+    parser.add_argument('--labels', help='text file with labels (by default labels saved with the session are used)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('stats', help='print number of images for each label')
+
+    list_parser = subparsers.add_parser('list', help='print labeled images')
+    list_parser.add_argument('--label', help='only images with this label')
+    list_parser.add_argument('--glob', help='only images whose names match the glob')
+
+    export_parser = subparsers.add_parser('export', help='export labels to csv')
+    export_parser.add_argument('--out', help='path of the csv file (default: output/assigned_classes.csv)')
+    export_parser.add_argument('--xlsx', action='store_true', help='also generate .xlsx file')
+    export_parser.add_argument('--npz', help='also save labels to this .npz file')
+    export_parser.add_argument('--npy', help='also save labels to memory-mappable .npy files with this path prefix')
+
+    commit_parser = subparsers.add_parser('commit', help='place labeled images into label folders in one batch')
+    commit_parser.add_argument('--mode', choices=['move', 'copy', 'link'],
+                               help='how images are placed (default: mode of previous commits or move)')
+    commit_parser.add_argument('--threads', type=int, default=8, help='number of parallel file operations')
+
+    subparsers.add_parser('merge-annotators',
+                          help='merge labels of all annotators of a sharded session into the main session')
+
+    merge_parser = subparsers.add_parser('merge', help='merge labels of other sessions into this one')
+    merge_parser.add_argument('others', nargs='+', help='folders of the other sessions')
+
+    args = parser.parse_args(argv)
+
+    labels = read_labels_file(args.labels) if args.labels else None
+    if args.command == 'merge-annotators':
+        try:
+            report = merge_annotators(args.folder, labels)
+        except ValueError as e:
+            print(e)
+            return 1
+        print(f"annotators: {', '.join(report['annotators'])}")
+        print(f"merged {report['merged']} images to output/assigned_classes_merged.csv, {report['conflicts']} "
+              f"conflicts ({report['unresolved']} left unlabeled, see output/merge_conflicts.csv)")
+        for pair in report['agreement']:
+            if pair['overlap']:
+                print(f"{' / '.join(pair['annotators'])}: {pair['overlap']} common images, "
+                      f"agreement {pair['agreement']:.1%}, kappa {pair['kappa']:.3f}")
+        return 0
+
+    # only merge changes labels, other commands can run while the labeler has the session open
+    try:
+        store = open_label_store(args.folder, labels, read_only=args.command != 'merge')
+    except ValueError as e:
+        print(e)
+        return 1
+    multi_label = isinstance(store, MultiLabelStore)
+    try:
+        if args.command == 'stats':
+            for label, count in store.count_by_label().items():
+                print(f'{label}\t{count}')
+            print(f'total\t{len(store)}')
+
+        elif args.command == 'list':
+            for img_name, label in store.filter(args.label, args.glob):
+                print(f"{img_name}\t{','.join(label) if multi_label else label}")
+
+        elif args.command == 'export':
+            csv_file_path = args.out or os.path.join(args.folder, 'output', 'assigned_classes.csv')
+            store.export_csv(csv_file_path)
+            print(f'csv saved to: {csv_file_path}')
+            if args.xlsx:
+                store.export_xlsx(csv_file_path[:-4] + '.xlsx')
+                print(f'xlsx saved to: {csv_file_path[:-4]}.xlsx')
+            if args.npz:
+                store.export_npz(args.npz)
+                print(f'npz saved to: {args.npz}')
+            if args.npy:
+                store.export_npy(args.npy)
+                arrays = ('multi_hot', 'packed') if multi_label else ('one_hot', 'codes')
+                print(f'npy saved to: {args.npy}_{arrays[0]}.npy, {args.npy}_{arrays[1]}.npy')
+
+        elif args.command == 'commit':
+            image_sources.set_index_folder(os.path.join(args.folder, 'output', 'archive_index'))
+            try:
+                materializer = Materializer(args.folder, store.labels, args.mode, args.threads,
+                                            multi_label=multi_label)
+            except ValueError as e:
+                print(e)
+                return 1
+            try:
+                failed = materializer.commit(
+                    store.items() if multi_label else store.assigned_labels,
+                    progress=lambda done, total: print(f'\rcommitted {done} of {total}', end='', flush=True))
+            finally:
+                materializer.close()
+            print()
+            for img_name, label, error in failed:
+                print(f'Failed to place {img_name} into {label or args.folder}: {error}')
+            return 1 if failed else 0
+
+        elif args.command == 'merge':
+            for folder in args.others:
+                other = open_label_store(folder, read_only=True)
+                conflicts = store.merge(other)
+                other.close()
+                print(f'{folder}: {len(other) - len(conflicts)} labels merged, {len(conflicts)} conflicts')
+                for img_name, label, other_label in conflicts:
+                    print(f'  {img_name}: kept {label}, {folder} has {other_label}')
+            store.save_session()
+    finally:
+        store.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,42 +1,2124 @@
-import csv
+import argparse
+import bisect
+import fnmatch
+import hashlib
+import json
+import math
+import multiprocessing
 import os
-import shutil
 import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+
+# time to first image is measured from here
+LAUNCH_TIME = time.perf_counter()
 
-import numpy as np
 from PyQt5 import QtWidgets
-from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QPixmap, QIntValidator, QKeySequence, QColor
+from PyQt5.QtCore import Qt, QObject, QRunnable, QThreadPool, QTimer, QAbstractListModel, QModelIndex, QSize, \
+    QItemSelection, QItemSelectionModel, QBuffer, QIODevice, QFileSystemWatcher, QPointF, QRect, QRectF, pyqtSignal
+from PyQt5.QtGui import QPixmap, QImage, QImageReader, QImageIOHandler, QIntValidator, QKeySequence, QColor, \
+    QPainter
 from PyQt5.QtWidgets import QApplication, QWidget, QLabel, QCheckBox, QFileDialog, QDesktopWidget, QLineEdit, \
-    QRadioButton, QShortcut, QScrollArea, QVBoxLayout, QGroupBox, QFormLayout, QListWidget, QListWidgetItem
-from xlsxwriter.workbook import Workbook
+    QRadioButton, QShortcut, QScrollArea, QVBoxLayout, QGroupBox, QFormLayout, QListView, QFrame, \
+    QProgressBar
+
+import image_sources
+from image_sources import is_archive, member_paths, read_member
+from label_store import (LabelIndex, LabelStore, Materializer, MultiLabelStore, ShardSpec, annotator_folder,
+                         lazy_import, make_folder, place_image, read_labels_csv, read_labels_file)
+
+# numpy is needed only for hashing, ordering and indexes of labels, it's loaded on first use
+np = lazy_import('numpy')
+
+
+def get_img_paths(dir, extensions=('.jpg', '.png', '.jpeg'), recursive=False, ignore=(), archives=True):
+    '''
+    :param dir: folder with files
+    :param extensions: tuple with file endings. e.g. ('.jpg', '.png'). Files with these endings will be added to img_paths
+    :param recursive: if True, images in subfolders are also added
+    :param ignore: glob patterns of files and folders to skip
+    :param archives: if True, images in tar and zip archives are also added (as archive path / member name)
+    :return: list of all filenames
+    '''
+
+    img_paths = []
+    for batch in ImageScanner(dir, extensions, recursive, ignore, archives=archives).scan():
+        img_paths.extend(batch)
+
+    # sort image names
+    img_paths.sort()
+    return img_paths
+
+
+def get_img_name(img_path, folder):
+    """
+    :return: path of the image relative to the folder. It's used as image name in labels and csv
+    (for images directly in the folder it's just the filename).
+    """
+    return img_path[len(folder):].lstrip('/\\')
+
+
+class ImageScanner:
+    """
+    Lists images in a folder tree using os.scandir. Subfolders are scanned in parallel and images
+    are yielded in batches, so the first image can be shown before the whole tree is listed.
+
+    If index_path is given, the listing of every folder is saved there together with the folder's
+    mtime. On the next scan, folders whose mtime didn't change are not listed again.
+
+    If archives is True, tar and zip archives are listed like images and replaced by paths of the images
+    in them (archive path followed by the member name).
+    """
+
+    def __init__(self, root, extensions=('.jpg', '.png', '.jpeg'), recursive=True, ignore=(), index_path=None,
+                 num_threads=8, batch_size=2000, archives=True, excluded=()):
+        """
+        :param ignore: glob patterns of files and folders to skip (at any depth)
+        :param excluded: names of files and folders in the root to skip, matched literally (label folders and
+        output folder, a subfolder with the same name is listed)
+        """
+        self.root = root
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self.recursive = recursive
+        self.ignore = list(ignore)
+        self.excluded = set(excluded)
+        self.index_path = index_path
+        self.archives = archives
+        self.num_threads = num_threads
+        self.batch_size = batch_size
+
+        # relative folder path -> [mtime_ns, image filenames, subfolder names]
+        self._index = self.load_index()
+        self._new_index = {}
+
+    def load_index(self):
+        if self.index_path is None or not os.path.exists(self.index_path):
+            return {}
+        try:
+            with open(self.index_path, encoding='utf8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            print("Can't read scan index, the folder will be scanned again.")
+            return {}
+
+        # index is valid only for the same scan settings
+        if saved.get('settings') != self.settings():
+            return {}
+        return saved.get('folders', {})
+
+    def save_index(self):
+        if self.index_path is None:
+            return
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump({'settings': self.settings(), 'folders': self._new_index}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def settings(self):
+        return {'extensions': list(self.extensions), 'recursive': self.recursive, 'ignore': self.ignore,
+                'archives': self.archives, 'excluded': sorted(self.excluded)}
+
+    def folder_path(self, rel_folder):
+        return os.path.join(self.root, rel_folder) if rel_folder else self.root
+
+    def folders(self):
+        """
+        :return: relative paths of all folders listed by the last scan
+        """
+        return list(self._new_index)
+
+    def listing(self, rel_folder):
+        """
+        :return: (image filenames, subfolder names) of the folder from the last scan (None if it wasn't listed)
+        """
+        entry = self._new_index.get(rel_folder)
+        return None if entry is None else (entry[1], entry[2])
+
+    def stamp(self, rel_folder):
+        """
+        :return: mtime of the folder when it was listed (None if it wasn't listed)
+        """
+        entry = self._new_index.get(rel_folder)
+        return None if entry is None else entry[0]
+
+    def update_listing(self, rel_folder, mtime, files):
+        """
+        Updates listing of the folder by known changes (e.g. images moved by the tool), so it's not listed again
+        :param files: dict filename -> True if the file is in the folder now, False if it was removed
+        """
+        entry = self._new_index.get(rel_folder)
+        if entry is None:
+            return
+        entry[0] = mtime
+        filenames = entry[1]
+        for filename, present in files.items():
+            position = bisect.bisect_left(filenames, filename)
+            found = position < len(filenames) and filenames[position] == filename
+            if present and not found:
+                filenames.insert(position, filename)
+            elif not present and found:
+                del filenames[position]
+
+    def forget(self, rel_folder):
+        """
+        removes the folder from the index (e.g. when it was deleted)
+        """
+        self._new_index.pop(rel_folder, None)
+
+    def is_ignored(self, rel_path, name):
+        # relative path of an entry in the root is its name
+        if rel_path in self.excluded:
+            return True
+        return any(fnmatch.fnmatch(rel_path, pattern) or fnmatch.fnmatch(name, pattern) for pattern in self.ignore)
+
+    def scan_folder(self, rel_folder):
+        """
+        :return: (relative folder path, sorted image filenames, subfolder names)
+        """
+        folder = self.folder_path(rel_folder)
+        mtime = os.stat(folder).st_mtime_ns
+
+        cached = self._index.get(rel_folder)
+        if cached is not None and cached[0] == mtime:
+            _, filenames, subfolders = cached
+        else:
+            filenames = []
+            subfolders = []
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    rel_path = os.path.join(rel_folder, entry.name) if rel_folder else entry.name
+                    if self.is_ignored(rel_path, entry.name):
+                        continue
+                    if entry.is_dir():
+                        if self.recursive:
+                            subfolders.append(entry.name)
+                    elif entry.name.lower().endswith(self.extensions) or (self.archives and is_archive(entry.name)):
+                        filenames.append(entry.name)
+            filenames.sort()
+
+        self._new_index[rel_folder] = [mtime, filenames, subfolders]
+        return rel_folder, filenames, subfolders
+
+    def image_paths(self, folder, filenames):
+        """
+        :return: paths of the listed files, archives are replaced by paths of the images in them
+        """
+        paths = []
+        for filename in filenames:
+            path = os.path.join(folder, filename)
+            if not (self.archives and is_archive(filename)):
+                paths.append(path)
+                continue
+            try:
+                paths.extend(member_paths(path, self.extensions))
+            except (OSError, ValueError) as e:
+                print(f"Can't read archive: {e}")
+        return paths
+
+    def scan(self, rel_folders=('',)):
+        """
+        Generator of lists of image paths. Paths are sorted within every folder, but folders come in
+        the order in which they were scanned.
+        :param rel_folders: folders (relative to the root) whose trees are listed, the whole root by default
+        """
+        self._new_index = {}
+        batch = []
+        first_batch = True
+
+        with ThreadPoolExecutor(self.num_threads) as executor:
+            pending = {executor.submit(self.scan_folder, rel_folder) for rel_folder in rel_folders}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        rel_folder, filenames, subfolders = future.result()
+                    except OSError as e:
+                        print(f"Can't scan folder: {e}")
+                        continue
+
+                    for subfolder in subfolders:
+                        rel_path = os.path.join(rel_folder, subfolder) if rel_folder else subfolder
+                        pending.add(executor.submit(self.scan_folder, rel_path))
+
+                    folder = os.path.join(self.root, rel_folder) if rel_folder else self.root
+                    batch.extend(self.image_paths(folder, filenames))
+
+                    # yield the first images as soon as possible
+                    if batch and (first_batch or len(batch) >= self.batch_size):
+                        yield batch
+                        batch = []
+                        first_batch = False
+        if batch:
+            yield batch
+
+        self.save_index()
+
+
+class ScanWorker(QObject):
+    """
+    Consumes rest of the ImageScanner generator on a background thread and passes batches to the GUI
+    """
+
+    batch_found = pyqtSignal(list)
+    finished = pyqtSignal()
+
+    def __init__(self, batches, parent=None):
+        super().__init__(parent)
+        self.batches = batches
+        self._thread = threading.Thread(target=self._run, name='image-scanner', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        for batch in self.batches:
+            self.batch_found.emit(batch)
+        self.finished.emit()
+
+    def wait(self):
+        self._thread.join()
+
+
+class FolderWatcher(QObject):
+    """
+    Watches folders listed by the ImageScanner and reports images added or removed outside the tool.
+    Only the changed folders are listed again and compared with their previous listing, so changes are
+    found without a full rescan even in trees with millions of images. Changes made by the tool itself
+    (images moved into label folders) update the listing without listing the folder again.
+    """
+
+    # paths of new images, paths of removed images
+    changed = pyqtSignal(list, list)
+
+    def __init__(self, scanner, delay=300, save_interval=60000, parent=None):
+        """
+        :param delay: milliseconds to wait for more changes before the folders are listed (e.g. during a copy)
+        :param save_interval: milliseconds from a change to saving of the scan index (it's also saved on stop)
+        """
+        super().__init__(parent)
+        self.scanner = scanner
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(self.on_directory_changed)
+        # archives are watched as files, their folder doesn't change when they are rewritten or copied in
+        self.watcher.fileChanged.connect(self.on_file_changed)
+        self._changed_folders = set()
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(delay)
+        self._timer.timeout.connect(self.process_changes)
+        self._save_timer = QTimer(self)
+        self._save_timer.setSingleShot(True)
+        self._save_timer.setInterval(save_interval)
+        self._save_timer.timeout.connect(self.scanner.save_index)
+        # relative folder -> [mtime after the last change made by the tool, {filename: True if it's in the folder}]
+        self._own_changes = {}
+        self._own_lock = threading.Lock()
+
+    def start(self):
+        folders = [self.scanner.folder_path(rel_folder) for rel_folder in self.scanner.folders()]
+        if folders:
+            failed = self.watcher.addPaths(folders)
+            if failed:
+                print(f"Can't watch {len(failed)} folders (limit of watched folders?), changes in them are not "
+                      f"detected.")
+        if self.scanner.archives:
+            archives = [os.path.join(self.scanner.folder_path(rel_folder), filename)
+                        for rel_folder in self.scanner.folders()
+                        for filename in self.scanner.listing(rel_folder)[0] if is_archive(filename)]
+            if archives:
+                self.watcher.addPaths(archives)
+
+    def stop(self):
+        self._timer.stop()
+        self._changed_folders.clear()
+        if self._save_timer.isActive():
+            self._save_timer.stop()
+            self.scanner.save_index()
+        if self.watcher.directories():
+            self.watcher.removePaths(self.watcher.directories())
+        if self.watcher.files():
+            self.watcher.removePaths(self.watcher.files())
+
+    def on_directory_changed(self, path):
+        rel_folder = get_img_name(path, self.scanner.root)
+        self._changed_folders.add(rel_folder)
+        self._timer.start()
+
+    def on_file_changed(self, path):
+        self.on_directory_changed(os.path.dirname(path))
+
+    def folder_mtime(self, rel_folder):
+        try:
+            return os.stat(self.scanner.folder_path(rel_folder)).st_mtime_ns
+        except OSError:
+            return None
+
+    @contextmanager
+    def own_change(self, img_name):
+        """
+        Marks changes made inside the block to the folder of the image (and to the root, where label folders
+        are created) as made by the tool, e.g. when the image is moved into a label folder.
+        It can be used from any thread.
+        :param img_name: name of the image (path relative to the root)
+        """
+        rel_folder, filename = os.path.split(img_name)
+        before = {folder: self.folder_mtime(folder) for folder in {rel_folder, ''}
+                  if self.scanner.stamp(folder) is not None}
+        try:
+            yield
+        finally:
+            with self._own_lock:
+                for folder, mtime in before.items():
+                    expected, files = self._own_changes.get(folder) or (self.scanner.stamp(folder), {})
+                    after = self.folder_mtime(folder)
+                    if mtime is None or after is None or mtime != expected:
+                        # the folder was changed also by something else, it has to be listed again
+                        self._own_changes.pop(folder, None)
+                        continue
+                    if folder == rel_folder:
+                        files[filename] = os.path.lexists(os.path.join(self.scanner.folder_path(folder), filename))
+                    self._own_changes[folder] = [after, files]
+
+    def apply_own_changes(self, rel_folder):
+        """
+        Updates listing of the folder by changes made by the tool
+        :return: True if nothing else changed the folder, so it doesn't have to be listed again
+        """
+        with self._own_lock:
+            own = self._own_changes.pop(rel_folder, None)
+        if own is None or self.folder_mtime(rel_folder) != own[0]:
+            return False
+        self.scanner.update_listing(rel_folder, *own)
+        return True
+
+    def process_changes(self):
+        added = []
+        removed = []
+        for rel_folder in sorted(self._changed_folders):
+            if not self.apply_own_changes(rel_folder):
+                self.rescan_folder(rel_folder, added, removed)
+        self._changed_folders.clear()
+        if not self._save_timer.isActive():
+            self._save_timer.start()
+        if added or removed:
+            self.changed.emit(added, removed)
+
+    def rescan_folder(self, rel_folder, added, removed):
+        """
+        Lists the folder again and collects paths of images added to it and removed from it
+        """
+        previous = self.scanner.listing(rel_folder)
+        folder = self.scanner.folder_path(rel_folder)
+        try:
+            _, filenames, subfolders = self.scanner.scan_folder(rel_folder)
+        except OSError:
+            # the folder was deleted or renamed
+            self.forget_folder(rel_folder, removed)
+            return
+
+        old_filenames, old_subfolders = previous or ([], [])
+        old_filenames = set(old_filenames)
+        new_filenames = set(filenames)
+        added.extend(self.scanner.image_paths(folder, [name for name in filenames if name not in old_filenames]))
+        removed.extend(self.scanner.image_paths(folder, [name for name in old_filenames if name not in new_filenames]))
+        if self.scanner.archives:
+            archive_names = [name for name in filenames if is_archive(name)]
+            self.rescan_archives(folder, archive_names, old_filenames, added, removed)
+
+        for subfolder in set(subfolders) - set(old_subfolders):
+            rel_path = os.path.join(rel_folder, subfolder) if rel_folder else subfolder
+            self.watcher.addPath(self.scanner.folder_path(rel_path))
+            self.rescan_folder(rel_path, added, removed)
+        for subfolder in set(old_subfolders) - set(subfolders):
+            self.forget_folder(os.path.join(rel_folder, subfolder) if rel_folder else subfolder, removed)
+
+    def rescan_archives(self, folder, archive_names, old_filenames, added, removed):
+        """
+        Lists images of archives which were rewritten (or finished copying in) under the same name again
+        """
+        watched = set(self.watcher.files())
+        for filename in archive_names:
+            path = os.path.join(folder, filename)
+            # replaced file is not watched anymore
+            if path not in watched:
+                self.watcher.addPath(path)
+            if filename in old_filenames and image_sources.archive_changed(path):
+                old_paths = set(image_sources.opened_member_paths(path, self.scanner.extensions))
+                new_paths = set(self.scanner.image_paths(folder, [filename]))
+                added.extend(sorted(new_paths - old_paths))
+                removed.extend(sorted(old_paths - new_paths))
+
+    def forget_folder(self, rel_folder, removed):
+        """
+        Collects images of the removed folder and its subfolders
+        """
+        listing = self.scanner.listing(rel_folder)
+        if listing is None:
+            return
+        filenames, subfolders = listing
+        self.scanner.forget(rel_folder)
+        folder = self.scanner.folder_path(rel_folder)
+        removed.extend(self.scanner.image_paths(folder, filenames))
+        if folder in self.watcher.directories():
+            self.watcher.removePath(folder)
+        for subfolder in subfolders:
+            self.forget_folder(os.path.join(rel_folder, subfolder) if rel_folder else subfolder, removed)
+
+
+class LatencyHistogram:
+    """
+    Histogram of durations with logarithmic buckets (10 us to ~100 s, 10 % wide).
+    Memory use is constant and percentiles are accurate to the bucket width.
+    """
+
+    min_seconds = 1e-5
+    growth = 1.1
+    num_buckets = 170
+
+    def __init__(self):
+        self.counts = [0] * self.num_buckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        if seconds <= self.min_seconds:
+            bucket = 0
+        else:
+            bucket = min(self.num_buckets - 1, 1 + int(math.log(seconds / self.min_seconds, self.growth)))
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """
+        :param p: percentile (0-100)
+        :return: upper bound of the bucket containing the percentile, in seconds
+        """
+        if self.count == 0:
+            return 0.0
+        threshold = p / 100 * self.count
+        cumulative = 0
+        for bucket, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= threshold and count:
+                return min(self.max, self.min_seconds * self.growth ** bucket)
+        return self.max
+
+    def summary(self):
+        """
+        :return: dict with statistics in milliseconds
+        """
+        return {
+            'count': self.count,
+            'mean_ms': 1000 * self.total / self.count if self.count else 0.0,
+            'p50_ms': 1000 * self.percentile(50),
+            'p95_ms': 1000 * self.percentile(95),
+            'p99_ms': 1000 * self.percentile(99),
+            'max_ms': 1000 * self.max,
+        }
+
+
+class PerfMonitor:
+    """
+    Collects durations of hot paths (set_image, set_label, file operations, exports, ...) into histograms.
+    Optionally every measurement is written to JSON-lines trace file. It can be used from any thread.
+    """
+
+    # seconds of assigned labels kept for labels_per_minute
+    label_window = 60.0
+
+    def __init__(self, trace_path=None):
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._label_times = deque()
+        self._trace = open(trace_path, 'a', encoding='utf8') if trace_path else None
+
+    @contextmanager
+    def measure(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = LatencyHistogram()
+            histogram.record(seconds)
+            if self._trace is not None:
+                self._trace.write(json.dumps({'ts': time.time(), 'name': name, 'ms': seconds * 1000}) + '\n')
+
+    def record_labels(self, num_labels=1):
+        """
+        records assigned labels for labels-per-minute throughput
+        """
+        now = time.monotonic()
+        with self._lock:
+            # trimmed also here, so the history doesn't grow when the rate is never read
+            self._trim_label_times(now)
+            self._label_times.append((now, num_labels))
+            if self._trace is not None:
+                self._trace.write(json.dumps({'ts': time.time(), 'name': 'labels', 'count': num_labels}) + '\n')
+
+    def _trim_label_times(self, now):
+        while self._label_times and now - self._label_times[0][0] > self.label_window:
+            self._label_times.popleft()
+
+    def labels_per_minute(self):
+        """
+        :return: number of labels assigned during the last minute
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._trim_label_times(now)
+            return sum(count for _, count in self._label_times) * 60.0 / self.label_window
+
+    @property
+    def tracing(self):
+        return self._trace is not None
+
+    def summary(self):
+        with self._lock:
+            return {name: histogram.summary() for name, histogram in sorted(self.histograms.items())}
+
+    def report(self):
+        """
+        :return: text with one line for every measured path
+        """
+        lines = [f'labels/min: {self.labels_per_minute():.0f}']
+        for name, stats in self.summary().items():
+            lines.append(f"{name}: n={stats['count']} p50={stats['p50_ms']:.1f} p95={stats['p95_ms']:.1f} "
+                         f"p99={stats['p99_ms']:.1f} max={stats['max_ms']:.1f} ms")
+        return '\n'.join(lines)
+
+    def close(self):
+        with self._lock:
+            if self._trace is not None:
+                self._trace.close()
+                self._trace = None
+
+
+class CommitWorker(QObject):
+    """
+    Runs Materializer.commit on a background thread and reports progress to the GUI
+    """
+
+    # done, total
+    progress = pyqtSignal(int, int)
+    # list of failures
+    finished = pyqtSignal(list)
+
+    def __init__(self, materializer, assigned_labels, parent=None):
+        super().__init__(parent)
+        self.materializer = materializer
+        # snapshot, labels assigned during the commit are placed by the next one
+        self.assigned_labels = list(assigned_labels) if materializer.multi_label else dict(assigned_labels)
+        self._thread = threading.Thread(target=self._run, name='commit', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        failed = self.materializer.commit(self.assigned_labels, progress=self.progress.emit)
+        self.finished.emit(failed)
+
+    def wait(self):
+        self._thread.join()
+
+
+def image_reader(path):
+    """
+    :return: QImageReader of the image. Images in archives are decoded from their bytes, without extracting them.
+    """
+    try:
+        data = read_member(path)
+    except (OSError, ValueError, zlib.error):
+        # the reader fails like for a missing file
+        data = None
+    if data is None:
+        return QImageReader(path)
+    buffer = QBuffer()
+    buffer.setData(data)
+    buffer.open(QIODevice.ReadOnly)
+    reader = QImageReader(buffer, os.path.splitext(path)[1][1:].lower().encode())
+    # the reader doesn't own the device
+    reader.buffer = buffer
+    return reader
+
+
+def load_scaled_image(path, max_width, max_height, perf=None):
+    """
+    Decodes the image and scales it so it fits into the image panel.
+    The target size is passed to the decoder, so formats that can scale while decoding (e.g. JPEG,
+    which uses DCT-domain downscaling) never decode the full resolution. Other formats are decoded
+    fully and scaled afterwards.
+    Only QImage is used here so the function can run on worker threads.
+    :param path: path to the image
+    :param max_width: width available for the image
+    :param max_height: height available for the image
+    :param perf: PerfMonitor to record decode and scale durations
+    :return: scaled QImage (null image if the file can't be decoded)
+    """
+    reader = image_reader(path)
+    size = reader.size()
+
+    if size.isValid() and reader.supportsOption(QImageIOHandler.ScaledSize):
+        if size.width() >= size.height():
+            size.scale(max_width, max(1, round(size.height() * max_width / size.width())), Qt.IgnoreAspectRatio)
+        else:
+            size.scale(max(1, round(size.width() * max_height / size.height())), max_height, Qt.IgnoreAspectRatio)
+        reader.setScaledSize(size)
+        reader.setQuality(100)  # smooth scaling of the result
+        start = time.perf_counter()
+        image = reader.read()
+        if perf is not None:
+            perf.record('set_image.decode_scaled', time.perf_counter() - start)
+        return image
+
+    start = time.perf_counter()
+    image = reader.read()
+    if perf is not None:
+        perf.record('set_image.decode', time.perf_counter() - start)
+    if image.isNull():
+        return image
+
+    start = time.perf_counter()
+    if image.width() >= image.height():
+        image = image.scaledToWidth(max_width, Qt.SmoothTransformation)
+    else:
+        image = image.scaledToHeight(max_height, Qt.SmoothTransformation)
+    if perf is not None:
+        perf.record('set_image.scale', time.perf_counter() - start)
+    return image
+
+
+class ImageCache:
+    """
+    LRU cache of scaled pixmaps bounded by memory budget (in MB)
+    """
+
+    def __init__(self, max_mb=256):
+        self.max_bytes = max_mb * 1024 * 1024
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    @staticmethod
+    def pixmap_size(pixmap):
+        return pixmap.width() * pixmap.height() * max(pixmap.depth(), 8) // 8
+
+    def get(self, key):
+        """
+        :return: cached pixmap or None. The pixmap is marked as most recently used.
+        """
+        pixmap = self._items.get(key)
+        if pixmap is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._items.move_to_end(key)
+        return pixmap
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def put(self, key, pixmap):
+        if key in self._items:
+            self.used_bytes -= self.pixmap_size(self._items.pop(key))
+
+        size = self.pixmap_size(pixmap)
+        if size > self.max_bytes:
+            return
+
+        self._items[key] = pixmap
+        self.used_bytes += size
+
+        # evict least recently used pixmaps
+        while self.used_bytes > self.max_bytes:
+            _, evicted = self._items.popitem(last=False)
+            self.used_bytes -= self.pixmap_size(evicted)
+
+    def clear(self):
+        self._items.clear()
+        self.used_bytes = 0
+
+
+class DecodeSignals(QObject):
+    # key, path, decoded image
+    decoded = pyqtSignal(str, str, QImage)
+
+
+class DecodeTask(QRunnable):
+    """
+    Decodes and scales one image on a QThreadPool worker thread
+    """
+
+    def __init__(self, signals, key, path, max_width, max_height, perf=None):
+        super().__init__()
+        self.signals = signals
+        self.perf = perf
+        self.key = key
+        self.path = path
+        self.max_width = max_width
+        self.max_height = max_height
+        self.started = False
+
+    def run(self):
+        self.started = True
+        start = time.perf_counter()
+        image = load_scaled_image(self.path, self.max_width, self.max_height)
+        if self.perf is not None:
+            self.perf.record('prefetch.decode', time.perf_counter() - start)
+        self.signals.decoded.emit(self.key, self.path, image)
+
+
+class ImagePrefetcher(QObject):
+    """
+    Decodes neighbouring images in background threads and keeps them in ImageCache,
+    so navigation can paint them without decoding on the GUI thread.
+    """
+
+    def __init__(self, max_width, max_height, cache_mb=256, num_threads=2, perf=None, parent=None):
+        super().__init__(parent)
+        self.perf = perf
+        self.max_width = max_width
+        self.max_height = max_height
+        self.cache = ImageCache(cache_mb)
+
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(num_threads)
+        self.signals = DecodeSignals()
+        self.signals.decoded.connect(self.on_decoded)
+        self._pending = {}
+
+    def get(self, key, path):
+        """
+        Returns the scaled pixmap of the image. Decodes it on the calling thread if it isn't cached yet.
+        """
+        pixmap = self.cache.get(key)
+        if pixmap is None:
+            pixmap = QPixmap.fromImage(load_scaled_image(path, self.max_width, self.max_height, self.perf))
+            if not pixmap.isNull():
+                self.cache.put(key, pixmap)
+        return pixmap
+
+    def prefetch(self, items):
+        """
+        Schedules decoding of images which are not cached yet. Tasks that were scheduled earlier and
+        didn't start yet are dropped, so fast navigation doesn't build up a queue of stale work.
+        :param items: list of (key, path) tuples, most important first
+        """
+        self.pool.clear()
+        self._pending = {key: task for key, task in self._pending.items() if task.started}
+
+        for key, path in items:
+            if key in self.cache or key in self._pending:
+                continue
+            task = DecodeTask(self.signals, key, path, self.max_width, self.max_height, self.perf)
+            self._pending[key] = task
+            self.pool.start(task)
+
+    def on_decoded(self, key, path, image):
+        self._pending.pop(key, None)
+        if not image.isNull():
+            self.cache.put(key, QPixmap.fromImage(image))
+
+    def shutdown(self):
+        self.pool.clear()
+        self.pool.waitForDone()
+        self._pending = {}
+
+
+class TileSignals(QObject):
+    # (path, level, column, row), decoded tile
+    decoded = pyqtSignal(object, QImage)
+    # path, scaled image of the whole image
+    preview = pyqtSignal(str, QImage)
+    # serial number of finished PyramidTask
+    pyramid_finished = pyqtSignal(int)
+
+
+class TileTask(QRunnable):
+    """
+    Decodes one tile of a large image on a QThreadPool worker thread. Only the region of the tile is read
+    (clip rect) and it's scaled to the pyramid level while decoding, so it's used only for formats which
+    support clip rect (e.g. JPEG).
+    """
+
+    def __init__(self, signals, key, source_rect, size, perf=None):
+        super().__init__()
+        self.signals = signals
+        self.key = key
+        self.source_rect = source_rect
+        self.size = size
+        self.perf = perf
+        self.started = False
+
+    def run(self):
+        self.started = True
+        start = time.perf_counter()
+        reader = image_reader(self.key[0])
+        reader.setClipRect(self.source_rect)
+        reader.setScaledSize(self.size)
+        image = reader.read()
+        if self.perf is not None:
+            self.perf.record('tile.decode', time.perf_counter() - start)
+        self.signals.decoded.emit(self.key, image)
+
+
+class PreviewTask(QRunnable):
+    """
+    Decodes scaled preview of the whole image on a QThreadPool worker thread
+    """
+
+    def __init__(self, signals, path, size, perf=None):
+        super().__init__()
+        self.signals = signals
+        self.path = path
+        self.size = size
+        self.perf = perf
+
+    def run(self):
+        image = load_scaled_image(self.path, self.size, self.size, self.perf)
+        self.signals.preview.emit(self.path, image)
+
+
+class PyramidTask(QRunnable):
+    """
+    Builds tiles of a large image whose format can't decode a region (e.g. PNG, TIFF). The source is decoded
+    once and every level of the pyramid is scaled down from the previous one, instead of decoding the whole
+    source for every tile. The requested tiles, whole coarse levels and tiles around the requested ones are
+    emitted (up to the memory budget), the preview of the whole image is emitted too.
+    """
+
+    def __init__(self, signals, serial, path, wanted, budget_bytes, tile_size, preview_size, perf=None):
+        """
+        :param wanted: keys (path, level, column, row) of requested tiles, most important first
+        """
+        super().__init__()
+        self.signals = signals
+        self.serial = serial
+        self.path = path
+        self.wanted = list(wanted)
+        self.budget_bytes = budget_bytes
+        self.tile_size = tile_size
+        self.preview_size = preview_size
+        self.perf = perf
+        self.started = False
+        # keys of emitted tiles, known once the source is decoded
+        self.selected = None
+
+    def select_tiles(self, width, height):
+        """
+        :return: set of keys of tiles to emit
+        """
+        tile_size = self.tile_size
+        tile_bytes = tile_size * tile_size * 4
+        # (level, columns, rows, bytes of the level)
+        levels = []
+        level = 0
+        while True:
+            levels.append((level, math.ceil(width / tile_size), math.ceil(height / tile_size), width * height * 4))
+            if max(width, height) <= tile_size:
+                break
+            width, height = math.ceil(width / 2), math.ceil(height / 2)
+            level += 1
+
+        selected = set(self.wanted)
+        budget = self.budget_bytes - len(selected) * tile_bytes
+        # coarse levels are small and cover zooming out
+        for level, columns, rows, level_bytes in reversed(levels):
+            if level_bytes > budget:
+                break
+            selected.update((self.path, level, column, row) for row in range(rows) for column in range(columns))
+            budget -= level_bytes
+
+        # tiles around the requested ones, nearest first (they are needed when panning)
+        if self.wanted and budget > 0:
+            level = self.wanted[0][1]
+            _, columns, rows, _ = levels[min(level, len(levels) - 1)]
+            center_column = sum(key[2] for key in self.wanted) / len(self.wanted)
+            center_row = sum(key[3] for key in self.wanted) / len(self.wanted)
+            around = [(self.path, level, column, row) for row in range(rows) for column in range(columns)]
+            around.sort(key=lambda key: (key[2] - center_column) ** 2 + (key[3] - center_row) ** 2)
+            for key in around[:budget // tile_bytes]:
+                selected.add(key)
+        return selected
+
+    def run(self):
+        self.started = True
+        start = time.perf_counter()
+        image = image_reader(self.path).read()
+        if self.perf is not None:
+            self.perf.record('tile.pyramid_decode', time.perf_counter() - start)
+        if image.isNull():
+            self.selected = set()
+            self.signals.pyramid_finished.emit(self.serial)
+            return
+
+        self.selected = self.select_tiles(image.width(), image.height())
+        tile_size = self.tile_size
+        preview_emitted = False
+        level = 0
+        while True:
+            for key in self.selected:
+                if key[1] == level:
+                    rect = QRect(key[2] * tile_size, key[3] * tile_size, tile_size, tile_size)
+                    self.signals.decoded.emit(key, image.copy(rect.intersected(image.rect())))
+            if not preview_emitted and max(image.width(), image.height()) <= self.preview_size:
+                self.signals.preview.emit(self.path, image)
+                preview_emitted = True
+            if max(image.width(), image.height()) <= tile_size:
+                break
+            image = image.scaled(math.ceil(image.width() / 2), math.ceil(image.height() / 2), Qt.IgnoreAspectRatio,
+                                 Qt.SmoothTransformation)
+            level += 1
+        if self.perf is not None:
+            self.perf.record('tile.pyramid', time.perf_counter() - start)
+        self.signals.pyramid_finished.emit(self.serial)
+
+
+class TiledImageView(QWidget):
+    """
+    Zoomable viewer of very large images. Only tiles of the visible region are decoded, at the level of
+    a resolution pyramid matching the zoom (level n has 1/2^n of the full resolution), so memory and decode
+    time don't depend on the size of the source. Decoded tiles are kept in an LRU ImageCache; until a tile
+    is ready, the preview of the whole image is drawn in its place.
+    Formats which can decode a region (e.g. JPEG) decode every tile separately on the thread pool. Other formats
+    (e.g. PNG, TIFF) are decoded whole once per PyramidTask on a single thread, so only one full-resolution
+    image is in memory.
+    Mouse wheel zooms around the cursor, dragging pans and double click fits the image into the view.
+    """
+
+    TILE_SIZE = 512
+    PREVIEW_SIZE = 1024
+
+    def __init__(self, cache_mb=256, num_threads=4, perf=None, parent=None):
+        super().__init__(parent)
+        self.perf = perf
+        self.cache = ImageCache(cache_mb)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(num_threads)
+        # previews and pyramids decode the whole source, one at a time
+        self.source_pool = QThreadPool(self)
+        self.source_pool.setMaxThreadCount(1)
+        self.signals = TileSignals()
+        self.signals.decoded.connect(self.on_tile_decoded)
+        self.signals.preview.connect(self.on_preview_decoded)
+        self.signals.pyramid_finished.connect(self.on_pyramid_finished)
+        self._pending = {}
+        self._pyramid = None
+        self._pyramid_serial = 0
+
+        self.path = None
+        self.image_size = QSize()
+        self.clip_supported = True
+        self.preview = QPixmap()
+        # screen pixels per source pixel and source position shown in the top left corner
+        self.zoom = 1.0
+        self.offset = QPointF(0, 0)
+        self._drag_start = None
+
+    def set_image(self, path, preview=None):
+        """
+        :param preview: scaled pixmap of the whole image if it's already decoded (e.g. by the prefetcher)
+        """
+        self.path = path
+        reader = image_reader(path)
+        self.image_size = reader.size()
+        self.clip_supported = reader.supportsOption(QImageIOHandler.ClipRect)
+        self.preview = QPixmap() if preview is None else preview
+        self.pool.clear()
+        self.source_pool.clear()
+        self._pending = {key: task for key, task in self._pending.items() if task.started}
+        self._pyramid = None
+        # preview of formats without clip rect comes with their pyramid
+        if self.preview.isNull() and self.clip_supported:
+            self.source_pool.start(PreviewTask(self.signals, path, self.PREVIEW_SIZE, self.perf))
+        self.fit()
+
+    def fit(self):
+        if self.image_size.isValid() and not self.image_size.isEmpty():
+            self.zoom = min(self.width() / self.image_size.width(), self.height() / self.image_size.height())
+            self.offset = QPointF((self.image_size.width() - self.width() / self.zoom) / 2,
+                                  (self.image_size.height() - self.height() / self.zoom) / 2)
+        self.update()
+
+    def level(self):
+        """
+        :return: pyramid level for the current zoom (tiles are decoded at the nearest resolution above the zoom)
+        """
+        if self.zoom >= 1:
+            return 0
+        level = int(math.floor(math.log2(1 / self.zoom)))
+        # the coarsest useful level fits into one tile
+        max_level = max(0, int(math.ceil(math.log2(max(self.image_size.width(), self.image_size.height())
+                                                   / self.TILE_SIZE))))
+        return min(level, max_level)
+
+    def source_to_view(self, rect):
+        return QRectF((rect.x() - self.offset.x()) * self.zoom, (rect.y() - self.offset.y()) * self.zoom,
+                      rect.width() * self.zoom, rect.height() * self.zoom)
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), QColor('#333333'))
+        if self.path is None or not self.image_size.isValid():
+            return
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+
+        width, height = self.image_size.width(), self.image_size.height()
+        if not self.preview.isNull():
+            painter.drawPixmap(self.source_to_view(QRectF(0, 0, width, height)), self.preview,
+                               QRectF(self.preview.rect()))
+
+        level = self.level()
+        scale = 2 ** level
+        tile_source_size = self.TILE_SIZE * scale
+        # visible part of the source
+        left = max(0, int(self.offset.x()))
+        top = max(0, int(self.offset.y()))
+        right = min(width, int(self.offset.x() + self.width() / self.zoom) + 1)
+        bottom = min(height, int(self.offset.y() + self.height() / self.zoom) + 1)
+        if right <= left or bottom <= top:
+            return
+
+        # tiles closest to the center are requested first
+        center_column = (left + right) / 2 / tile_source_size
+        center_row = (top + bottom) / 2 / tile_source_size
+        tiles = [(column, row) for row in range(top // tile_source_size, (bottom - 1) // tile_source_size + 1)
+                 for column in range(left // tile_source_size, (right - 1) // tile_source_size + 1)]
+        tiles.sort(key=lambda tile: (tile[0] + 0.5 - center_column) ** 2 + (tile[1] + 0.5 - center_row) ** 2)
+
+        missing = []
+        for column, row in tiles:
+            source_rect = QRect(column * tile_source_size, row * tile_source_size, tile_source_size,
+                                tile_source_size).intersected(QRect(0, 0, width, height))
+            key = (self.path, level, column, row)
+            pixmap = self.cache.get(key)
+            if pixmap is None:
+                missing.append((key, source_rect))
+            else:
+                painter.drawPixmap(self.source_to_view(QRectF(source_rect)), pixmap, QRectF(pixmap.rect()))
+        painter.end()
+        self.request_tiles(missing, scale)
+
+    def request_tiles(self, missing, scale):
+        """
+        Schedules decoding of visible tiles, queued tiles which are no longer visible are dropped
+        """
+        self.pool.clear()
+        self._pending = {key: task for key, task in self._pending.items() if task.started}
+        if not self.clip_supported:
+            self.request_pyramid([key for key, _ in missing])
+            return
+        for key, source_rect in missing:
+            if key in self._pending:
+                continue
+            size = QSize(max(1, math.ceil(source_rect.width() / scale)), max(1, math.ceil(source_rect.height() / scale)))
+            task = TileTask(self.signals, key, source_rect, size, self.perf)
+            self._pending[key] = task
+            self.pool.start(task)
+
+    def request_pyramid(self, keys):
+        """
+        Schedules PyramidTask for missing tiles unless the current one already emits them
+        """
+        if not keys:
+            return
+        task = self._pyramid
+        if task is not None:
+            covered = task.selected if task.selected is not None else task.wanted
+            if all(key in covered for key in keys):
+                return
+        # a queued task is replaced, a running one finishes first (tiles are not decoded twice in parallel)
+        self.source_pool.clear()
+        self._pyramid_serial += 1
+        budget_bytes = self.cache.max_bytes // 2
+        self._pyramid = PyramidTask(self.signals, self._pyramid_serial, self.path, keys, budget_bytes,
+                                    self.TILE_SIZE, self.PREVIEW_SIZE, self.perf)
+        self.source_pool.start(self._pyramid)
+
+    def on_tile_decoded(self, key, image):
+        self._pending.pop(key, None)
+        if not image.isNull():
+            self.cache.put(key, QPixmap.fromImage(image))
+            if key[0] == self.path:
+                self.update()
+
+    def on_preview_decoded(self, path, image):
+        if path == self.path and not image.isNull() and self.preview.isNull():
+            self.preview = QPixmap.fromImage(image)
+            self.update()
+
+    def on_pyramid_finished(self, serial):
+        # all tiles of the task were delivered, tiles evicted later are requested again
+        if self._pyramid is not None and self._pyramid.serial == serial:
+            self._pyramid = None
+            self.update()
+
+    def wheelEvent(self, event):
+        if self.path is None:
+            return
+        position = QPointF(event.pos())
+        source = self.offset + position / self.zoom
+        fit_zoom = min(self.width() / max(1, self.image_size.width()), self.height() / max(1, self.image_size.height()))
+        self.zoom = min(max(self.zoom * 1.25 ** (event.angleDelta().y() / 120), fit_zoom / 2), 16.0)
+        # the source point under the cursor stays in place
+        self.offset = source - position / self.zoom
+        self.update()
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton:
+            self._drag_start = (QPointF(event.pos()), QPointF(self.offset))
+
+    def mouseMoveEvent(self, event):
+        if self._drag_start is not None:
+            position, offset = self._drag_start
+            self.offset = offset - (QPointF(event.pos()) - position) / self.zoom
+            self.update()
+
+    def mouseReleaseEvent(self, event):
+        self._drag_start = None
+
+    def mouseDoubleClickEvent(self, event):
+        self.fit()
+
+    def shutdown(self):
+        self.pool.clear()
+        self.source_pool.clear()
+        self.pool.waitForDone()
+        self.source_pool.waitForDone()
+        self._pending = {}
+        self._pyramid = None
+
+
+class FileOperationQueue(QObject):
+    """
+    Applies copy/move operations of labeled images on a background thread.
+
+    Only the final label of each image is queued: relabeling an image that is still waiting
+    replaces its target, so A -> B -> C results in a single operation. The operation is derived
+    from where the image currently is on disk, which makes replaying it after a crash safe.
+    Queued and finished operations are appended to a journal in the output folder; operations
+    that didn't finish are queued again on the next start.
+    """
+
+    # number of pending operations, number of failed operations
+    status_changed = pyqtSignal(int, int)
+
+    def __init__(self, input_folder, labels, mode, perf=None, output_folder=None, locations=None, folder_watcher=None,
+                 parent=None):
+        """
+        :param locations: dict image name -> label folder of images which are already in label folders
+        :param folder_watcher: FolderWatcher which is told about changes of folders made by the operations
+        """
+        super().__init__(parent)
+        self.perf = perf
+        self.folder_watcher = folder_watcher
+        self.input_folder = input_folder
+        self.labels = labels
+        self.mode = mode
+        self.failed = []
+
+        # image name -> target label (None means the image goes back to the input folder)
+        self._targets = OrderedDict()
+        # image name -> label folder the image is in right now
+        self._on_disk = dict(locations or {})
+        self._in_progress = None
+        self._stopped = False
+        self._condition = threading.Condition()
+
+        output_folder = output_folder or os.path.join(input_folder, 'output')
+        make_folder(output_folder)
+        self.journal_path = os.path.join(output_folder, 'file_operations.journal')
+        self._journal_lock = threading.Lock()
+        unfinished = self.read_journal(self.journal_path)
+        self._journal = open(self.journal_path, 'a', encoding='utf8')
+
+        self._thread = threading.Thread(target=self._run, name='file-operations', daemon=True)
+        self._thread.start()
+
+        for img_name, label in unfinished.items():
+            print(f'Resuming unfinished file operation: {img_name} -> {label or self.input_folder}')
+            self.enqueue(img_name, label)
+
+    @staticmethod
+    def read_journal(journal_path):
+        """
+        :return: dict of image name -> target label for operations that were queued but not finished
+        """
+        unfinished = {}
+        if not os.path.exists(journal_path):
+            return unfinished
+
+        with open(journal_path, encoding='utf8') as f:
+            for line in f:
+                parts = line.rstrip('\n').split('\t')
+                if len(parts) != 3:
+                    continue  # partially written line
+                state, img_name, label = parts
+                label = label or None
+                if state == 'queued':
+                    unfinished[img_name] = label
+                elif state == 'done' and img_name in unfinished and unfinished[img_name] == label:
+                    del unfinished[img_name]
+        return unfinished
+
+    def _write_journal(self, state, img_names, label):
+        with self._journal_lock:
+            self._journal.write(''.join(f'{state}\t{img_name}\t{label or ""}\n' for img_name in img_names))
+            self._journal.flush()
+
+    def enqueue(self, img_name, label):
+        """
+        Queues the image to be placed into the folder of the label
+        :param img_name: name of the image in the input folder
+        :param label: target label or None if the image should not be in any label folder
+        """
+        self.enqueue_many([img_name], label)
+
+    def enqueue_many(self, img_names, label):
+        """
+        Queues many images to be placed into the folder of the same label (with one journal write)
+        """
+        self._write_journal('queued', img_names, label)
+        with self._condition:
+            for img_name in img_names:
+                self._targets.pop(img_name, None)
+                self._targets[img_name] = label
+            self._condition.notify()
+        self.emit_status()
+
+    def location(self, img_name):
+        """
+        :return: label folder the image is in (or None if it's in the input folder)
+        """
+        with self._condition:
+            return self._on_disk.get(img_name)
+
+    @property
+    def num_pending(self):
+        with self._condition:
+            return len(self._targets) + (self._in_progress is not None)
+
+    def emit_status(self):
+        self.status_changed.emit(self.num_pending, len(self.failed))
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._targets and not self._stopped:
+                    self._condition.wait()
+                if not self._targets:
+                    return
+                img_name, label = self._targets.popitem(last=False)
+                self._in_progress = img_name
+                current = self._on_disk.get(img_name)
+
+            start = time.perf_counter()
+            own_change = self.folder_watcher.own_change(img_name) if self.folder_watcher is not None else nullcontext()
+            try:
+                with own_change:
+                    place_image(self.input_folder, self.labels, img_name, label, current, self.mode)
+                location = label
+            except OSError as e:
+                location = current
+                self.failed.append((img_name, label, str(e)))
+                print(f'File operation failed: {img_name} -> {label or self.input_folder}: {e}')
+            else:
+                self._write_journal('done', [img_name], label)
+            if self.perf is not None:
+                self.perf.record('file_op', time.perf_counter() - start)
+
+            with self._condition:
+                if location is None:
+                    self._on_disk.pop(img_name, None)
+                else:
+                    self._on_disk[img_name] = location
+                self._in_progress = None
+                self._condition.notify_all()
+            self.emit_status()
+
+    def drain(self):
+        """
+        Waits until all queued operations are applied and stops the worker thread.
+        The journal is removed if all operations succeeded.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._thread.join()
+
+        with self._journal_lock:
+            self._journal.close()
+        if not self.failed:
+            os.remove(self.journal_path)
+
+
+class FileListModel(QAbstractListModel):
+    """
+    Virtual model of the file navigation bar. Names and colors are computed only for rows
+    that are painted, so the list opens instantly even with millions of images.
+    """
+
+    # number of inserts and removals of blocks of rows after which the name map is built again
+    max_edits = 64
+
+    def __init__(self, input_folder, img_paths, assigned_labels, label_colors, parent=None):
+        super().__init__(parent)
+        self.input_folder = input_folder
+        self.img_paths = img_paths
+        self.assigned_labels = assigned_labels
+        self.label_colors = label_colors
+        # image name -> (row, number of edits when the row was recorded). It's built lazily on first lookup,
+        # so it doesn't slow down opening of the window. Rows shifted by later inserts and removals
+        # (edits are (first shifted row, shift)) are corrected on lookup instead of building the map again.
+        self._name_to_index = None
+        self._edits = []
+        # groups of near-duplicate images (lists of names), image name -> index of its group
+        self.duplicate_groups = []
+        self.duplicate_group_of = {}
+
+    def reset(self, img_paths, assigned_labels):
+        self.beginResetModel()
+        self.img_paths = img_paths
+        self.assigned_labels = assigned_labels
+        self._name_to_index = None
+        self._edits = []
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.img_paths)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        if role == Qt.DisplayRole:
+            img_name = get_img_name(self.img_paths[index.row()], self.input_folder)
+            group = self.duplicate_group_of.get(img_name)
+            if group is not None:
+                # near-duplicate images are marked with their group and its size
+                return f'{img_name}  [dup {group + 1}: {len(self.duplicate_groups[group])}]'
+            return img_name
+        if role == Qt.ForegroundRole:
+            label = self.assigned_labels.get(get_img_name(self.img_paths[index.row()], self.input_folder))
+            if label is None:
+                # unlabeled
+                return QColor(Qt.white)
+            return self.label_colors.get(label, QColor(Qt.white))
+        return None
+
+    def index_of(self, img_name):
+        """
+        :return: row of the image with given name (-1 if there is no such image)
+        """
+        if self._name_to_index is None or len(self._edits) > self.max_edits:
+            self._name_to_index = {get_img_name(path, self.input_folder): (idx, 0)
+                                   for idx, path in enumerate(self.img_paths)}
+            self._edits = []
+        entry = self._name_to_index.get(img_name)
+        if entry is None:
+            return -1
+        idx, num_edits = entry
+        if num_edits < len(self._edits):
+            for first, shift in self._edits[num_edits:]:
+                if idx >= first:
+                    idx += shift
+            self._name_to_index[img_name] = (idx, len(self._edits))
+        return idx
+
+    def append(self, img_paths):
+        """
+        Appends rows of newly found images
+        """
+        first = len(self.img_paths)
+        self.beginInsertRows(QModelIndex(), first, first + len(img_paths) - 1)
+        self.img_paths.extend(img_paths)
+        if self._name_to_index is not None:
+            for idx, path in enumerate(img_paths, first):
+                self._name_to_index[get_img_name(path, self.input_folder)] = (idx, len(self._edits))
+        self.endInsertRows()
+
+    def insert_sorted(self, img_paths):
+        """
+        Inserts rows of new images at their sorted positions (images have to be sorted by path).
+        Images that fall into the same gap are inserted as one block.
+        :return: positions at which the images were inserted (indices before the insert)
+        """
+        img_paths = sorted(img_paths)
+        positions = [bisect.bisect_left(self.img_paths, path) for path in img_paths]
+        runs = []
+        for position, path in zip(positions, img_paths):
+            if runs and runs[-1][0] == position:
+                runs[-1][1].append(path)
+            else:
+                runs.append((position, [path]))
+
+        # from the end, so positions of the remaining runs don't move
+        for position, run in reversed(runs):
+            self.beginInsertRows(QModelIndex(), position, position + len(run) - 1)
+            self.img_paths[position:position] = run
+            self.endInsertRows()
+            self._edits.append((position, len(run)))
+        if self._name_to_index is not None:
+            # positions are indices before the insert, every earlier image moves the image by one
+            for i, (position, path) in enumerate(zip(positions, img_paths)):
+                self._name_to_index[get_img_name(path, self.input_folder)] = (position + i, len(self._edits))
+        return positions
+
+    def remove(self, indices):
+        """
+        Removes rows of images, consecutive rows are removed as one block
+        :param indices: indices of the images
+        """
+        runs = []
+        for idx in sorted(set(indices)):
+            if runs and runs[-1][1] == idx - 1:
+                runs[-1][1] = idx
+            else:
+                runs.append([idx, idx])
+
+        for first, last in reversed(runs):
+            if self._name_to_index is not None:
+                for path in self.img_paths[first:last + 1]:
+                    self._name_to_index.pop(get_img_name(path, self.input_folder), None)
+            self.beginRemoveRows(QModelIndex(), first, last)
+            del self.img_paths[first:last + 1]
+            self.endRemoveRows()
+            self._edits.append((last + 1, first - last - 1))
+
+    def set_duplicate_groups(self, groups):
+        """
+        :param groups: lists of names of near-duplicate images
+        """
+        self.duplicate_groups = groups
+        self.duplicate_group_of = {img_name: group for group, img_names in enumerate(groups) for img_name in img_names}
+        if self.img_paths:
+            self.dataChanged.emit(self.index(0), self.index(len(self.img_paths) - 1), [Qt.DisplayRole])
+
+    def refresh_row(self, row):
+        self.refresh_rows(row, row)
+
+    def refresh_rows(self, first, last):
+        self.dataChanged.emit(self.index(first), self.index(last), [Qt.ForegroundRole])
+
+
+def generate_thumbnail(img_path, img_name, cache_folder, size):
+    """
+    Creates thumbnail of the image in the cache folder unless it already exists.
+    Thumbnails are keyed by image name, mtime and file size, so moving the image into a label folder
+    doesn't invalidate its thumbnail, but changing the file does.
+    It runs in a process pool, so it must not use anything but QImage/QImageReader.
+    :return: (image name, path to the thumbnail or None if the image can't be decoded)
+    """
+    mtime_ns, file_size = image_sources.stat(img_path)
+    key = hashlib.sha1(f'{img_name}|{mtime_ns}|{file_size}|{size}'.encode('utf8')).hexdigest()
+    thumb_path = os.path.join(cache_folder, key[:2], key + '.jpg')
+    if os.path.exists(thumb_path):
+        return img_name, thumb_path
+
+    image = load_scaled_image(img_path, size, size)
+    if image.isNull():
+        return img_name, None
+
+    make_folder(os.path.dirname(thumb_path))
+    tmp_path = f'{thumb_path}.{os.getpid()}.tmp'
+    image.save(tmp_path, 'JPG', 85)
+    os.replace(tmp_path, thumb_path)
+    return img_name, thumb_path
+
+
+class ThumbnailCache(QObject):
+    """
+    Persistent on-disk thumbnail cache. Missing thumbnails are generated by a process pool,
+    loaded thumbnails are kept in memory in ImageCache.
+    """
+
+    # image name
+    thumbnail_ready = pyqtSignal(str)
+    # image name, path to the thumbnail
+    _generated = pyqtSignal(str, str)
+
+    def __init__(self, cache_folder, size=160, memory_mb=64, num_processes=None, parent=None):
+        super().__init__(parent)
+        self.cache_folder = cache_folder
+        self.size = size
+        self.pixmaps = ImageCache(memory_mb)
+        # image name -> future of thumbnail generation
+        self._requested = {}
+        self._executor = None
+        self.num_processes = num_processes or max(1, (os.cpu_count() or 2) - 1)
+        self._generated.connect(self.on_generated)
+
+    def get(self, img_name, img_path):
+        """
+        :return: thumbnail pixmap, or None if it's not ready yet (it's generated in the background then)
+        """
+        pixmap = self.pixmaps.get(img_name)
+        if pixmap is None and img_name not in self._requested:
+            if self._executor is None:
+                # spawn keeps the workers independent from the Qt state of the GUI process,
+                # they read indexes of archives cached by the GUI process
+                self._executor = ProcessPoolExecutor(self.num_processes,
+                                                     mp_context=multiprocessing.get_context('spawn'),
+                                                     initializer=image_sources.set_index_folder,
+                                                     initargs=(image_sources.get_index_folder(),))
+            future = self._executor.submit(generate_thumbnail, img_path, img_name, self.cache_folder, self.size)
+            self._requested[img_name] = future
+            future.add_done_callback(self._on_future_done)
+        return pixmap
+
+    def _on_future_done(self, future):
+        # called on executor thread, result is passed to the GUI thread by queued signal
+        if future.cancelled():
+            return
+        try:
+            img_name, thumb_path = future.result()
+        except Exception as e:
+            print(f'Generating thumbnail failed: {e}')
+            return
+        self._generated.emit(img_name, thumb_path or '')
+
+    def on_generated(self, img_name, thumb_path):
+        self._requested.pop(img_name, None)
+        if thumb_path:
+            self.pixmaps.put(img_name, QPixmap(thumb_path))
+            self.thumbnail_ready.emit(img_name)
+
+    def cancel_pending(self):
+        """
+        drops requests which didn't start yet (e.g. after changing page of the grid)
+        """
+        for img_name, future in list(self._requested.items()):
+            if future.cancel():
+                del self._requested[img_name]
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+
+class ThumbnailGridModel(QAbstractListModel):
+    """
+    One page of images shown as thumbnails in the grid view
+    """
+
+    def __init__(self, labeler, thumbnails, page_size=120, parent=None):
+        super().__init__(parent)
+        self.labeler = labeler
+        self.thumbnails = thumbnails
+        self.page_size = page_size
+        self.page_start = 0
+        self.placeholder = QPixmap(thumbnails.size, thumbnails.size)
+        self.placeholder.fill(QColor('#555555'))
+        self.thumbnails.thumbnail_ready.connect(self.on_thumbnail_ready)
+
+    def set_page_start(self, page_start):
+        self.beginResetModel()
+        self.page_start = page_start
+        self.thumbnails.cancel_pending()
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return max(0, min(self.page_size, self.labeler.num_images - self.page_start))
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        idx = self.page_start + index.row()
+        if role == Qt.DisplayRole:
+            return self.labeler.get_image_name(idx)
+        if role == Qt.DecorationRole:
+            pixmap = self.thumbnails.get(self.labeler.get_image_name(idx), self.labeler.get_image_path(idx))
+            return self.placeholder if pixmap is None else pixmap
+        if role == Qt.ForegroundRole:
+            label = self.labeler.assigned_labels.get(self.labeler.get_image_name(idx))
+            if label is None:
+                return QColor(Qt.white)
+            return self.labeler.label_colors.get(label, QColor(Qt.white))
+        return None
+
+    def image_index(self, row):
+        return self.page_start + row
+
+    def refresh_image(self, idx):
+        self.refresh_images(idx, idx)
+
+    def refresh_images(self, first, last):
+        """
+        refreshes rows of images between indices first and last (if they are on the current page)
+        """
+        first_row = max(first - self.page_start, 0)
+        last_row = min(last - self.page_start, self.rowCount() - 1)
+        if first_row <= last_row:
+            self.dataChanged.emit(self.index(first_row), self.index(last_row))
+
+    def on_thumbnail_ready(self, img_name):
+        idx = self.labeler.file_list_model.index_of(img_name)
+        if idx >= 0:
+            self.refresh_image(idx)
+
+
+# size of images the perceptual hashes are computed from
+HASH_IMAGE_SIZE = 32
+
+
+def dct_matrix(n):
+    """
+    :return: orthonormal DCT-II matrix of size n x n
+    """
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+def pack_bits(bits):
+    """
+    :param bits: bool array of shape (n, 64)
+    :return: uint64 array of shape (n,)
+    """
+    return np.packbits(bits, axis=1).view('>u8').ravel().astype(np.uint64)
+
+
+def perceptual_hashes(pixels):
+    """
+    Computes dHash and pHash of many images at once.
+    :param pixels: float array (n, 32, 32) of grayscale images
+    :return: (dhashes, phashes), uint64 arrays of shape (n,)
+    """
+    n = len(pixels)
+
+    # dHash: 8 x 9 image, bit is set when pixel is brighter than its left neighbour
+    rows = pixels.reshape(n, 8, HASH_IMAGE_SIZE // 8, HASH_IMAGE_SIZE).mean(axis=2)
+    positions = np.linspace(0, HASH_IMAGE_SIZE - 1, 9)
+    left = np.floor(positions).astype(int)
+    right = np.minimum(left + 1, HASH_IMAGE_SIZE - 1)
+    weights = positions - left
+    small = rows[:, :, left] * (1 - weights) + rows[:, :, right] * weights
+    dhashes = pack_bits((small[:, :, 1:] > small[:, :, :-1]).reshape(n, 64))
+
+    # pHash: lowest 8 x 8 DCT coefficients compared with their median (DC coefficient is left out of the median)
+    dct = dct_matrix(HASH_IMAGE_SIZE)
+    coefficients = (dct @ pixels @ dct.T)[:, :8, :8].reshape(n, 64)
+    medians = np.median(coefficients[:, 1:], axis=1)
+    phashes = pack_bits(coefficients > medians[:, None])
+    return dhashes, phashes
+
+
+def decode_small_images(img_paths, image_format, channels):
+    """
+    Decodes images at 32 x 32 pixels (aspect ratio is ignored), JPEG images are scaled while decoding.
+    It runs in a process pool, so it must not use anything but QImage/QImageReader.
+    :param image_format: QImage.Format_Grayscale8 or QImage.Format_RGB888
+    :param channels: number of bytes per pixel of the format
+    :return: (uint8 array (n, 32, 32, channels), valid), valid is False for images that can't be decoded
+    """
+    size = HASH_IMAGE_SIZE
+    pixels = np.zeros((len(img_paths), size, size, channels), dtype=np.uint8)
+    valid = np.zeros(len(img_paths), dtype=bool)
+    for i, img_path in enumerate(img_paths):
+        reader = image_reader(img_path)
+        if reader.supportsOption(QImageIOHandler.ScaledSize):
+            reader.setScaledSize(QSize(size, size))
+        image = reader.read()
+        if image.isNull():
+            continue
+        if image.width() != size or image.height() != size:
+            image = image.scaled(size, size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        image = image.convertToFormat(image_format)
+        data = image.constBits()
+        data.setsize(image.sizeInBytes())
+        rows = np.frombuffer(data, np.uint8).reshape(size, image.bytesPerLine())[:, :size * channels]
+        pixels[i] = rows.reshape(size, size, channels)
+        valid[i] = True
+    return pixels, valid
+
+
+def compute_perceptual_hashes(img_paths):
+    """
+    Decodes images at 32 x 32 pixels and computes their hashes (runs in a process pool)
+    :return: (dict with 'dhashes' and 'phashes', valid), valid is False for images that can't be decoded
+    """
+    pixels, valid = decode_small_images(img_paths, QImage.Format_Grayscale8, 1)
+    dhashes, phashes = perceptual_hashes(pixels[..., 0].astype(np.float32))
+    return {'dhashes': dhashes, 'phashes': phashes}, valid
+
+
+def image_features(pixels):
+    """
+    Compact colour and layout descriptors of many images at once
+    :param pixels: uint8 array (n, 32, 32, 3) of RGB images
+    :return: float32 array (n, 128): colour histogram with 4 x 4 x 4 bins and 8 x 8 grayscale thumbnail,
+    both with unit norm
+    """
+    n = len(pixels)
+    bins = pixels.astype(np.int64) // 64
+    codes = (bins[..., 0] * 16 + bins[..., 1] * 4 + bins[..., 2]).reshape(n, -1) + np.arange(n)[:, None] * 64
+    histograms = np.bincount(codes.ravel(), minlength=n * 64).reshape(n, 64).astype(np.float32)
+    # square root of frequencies has unit norm (Hellinger distance)
+    histograms = np.sqrt(histograms / (HASH_IMAGE_SIZE * HASH_IMAGE_SIZE))
+
+    gray = pixels.astype(np.float32).mean(axis=3).reshape(n, 8, HASH_IMAGE_SIZE // 8, 8, HASH_IMAGE_SIZE // 8)
+    gray = gray.mean(axis=(2, 4)).reshape(n, 64)
+    gray -= gray.mean(axis=1, keepdims=True)
+    gray /= np.linalg.norm(gray, axis=1, keepdims=True) + 1e-6
+    return np.hstack([histograms, gray]).astype(np.float32)
+
+
+def compute_image_features(img_paths):
+    """
+    Decodes images at 32 x 32 pixels and computes their features (runs in a process pool)
+    :return: (dict with 'features', valid), valid is False for images that can't be decoded
+    """
+    pixels, valid = decode_small_images(img_paths, QImage.Format_RGB888, 3)
+    return {'features': image_features(pixels)}, valid
+
+
+def popcount(values):
+    """
+    :return: number of set bits of every uint64 value
+    """
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    return np.unpackbits(values.view(np.uint8).reshape(*values.shape, 8), axis=-1).sum(axis=-1)
+
+
+def group_near_duplicates(hashes, max_distance=4, block_size=512):
+    """
+    Groups images whose hashes differ in at most max_distance bits (connected components of the "near" relation).
+    Hashes are split into max_distance + 1 chunks; two hashes within the distance have at least one chunk
+    equal (pigeonhole principle), so only hashes sharing a chunk value are compared. With well spread
+    hashes this is close to linear, so it scales to millions of images.
+    :param hashes: uint64 array of hashes
+    :return: int array with group of every hash (equal for images in the same group)
+    """
+    unique, inverse = np.unique(np.asarray(hashes, dtype=np.uint64), return_inverse=True)
+    parent = list(range(len(unique)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    bounds = np.linspace(0, 64, max_distance + 2).astype(int)
+    for low, high in zip(bounds[:-1], bounds[1:]):
+        chunks = (unique >> np.uint64(low)) & np.uint64((1 << int(high - low)) - 1)
+        order = np.argsort(chunks, kind='stable')
+        sorted_chunks = chunks[order]
+        starts = np.flatnonzero(np.r_[True, sorted_chunks[1:] != sorted_chunks[:-1]])
+        ends = np.r_[starts[1:], len(order)]
+        for start, end in zip(starts, ends):
+            if end - start < 2:
+                continue
+            members = order[start:end]
+            member_hashes = unique[members]
+            for block_start in range(0, len(members), block_size):
+                block = member_hashes[block_start:block_start + block_size]
+                distances = popcount(block[:, None] ^ member_hashes[None, :])
+                rows, columns = np.nonzero(distances <= max_distance)
+                for row, column in zip(rows + block_start, columns):
+                    if row < column:
+                        root_a, root_b = find(members[row]), find(members[column])
+                        if root_a != root_b:
+                            parent[root_b] = root_a
+
+    roots = np.array([find(i) for i in range(len(unique))], dtype=np.int64)
+    return roots[inverse.ravel()]
+
+
+class ImageAnalysisWorker(QObject):
+    """
+    Computes values of every image (hashes, features) by a process pool on a background thread.
+    Values are cached on disk keyed by image name, mtime and size, so only new or changed images
+    are computed next time. Subclasses turn the values into the result in process().
+    """
 
+    # done, total
+    progress = pyqtSignal(int, int)
+    # result of process()
+    finished = pyqtSignal(list)
+    # error message when a worker process fails (finished is not emitted)
+    failed = pyqtSignal(str)
 
-def get_img_paths(dir, extensions=('.jpg', '.png', '.jpeg')):
-    '''
-    :param dir: folder with files
-    :param extensions: tuple with file endings. e.g. ('.jpg', '.png'). Files with these endings will be added to img_paths
-    :return: list of all filenames
-    '''
+    # name of the computed array -> dtype it's cached with
+    fields = {}
+    # name of the measurement of process() in PerfMonitor
+    perf_name = None
 
-    img_paths = []
+    def __init__(self, cache_path, compute_function, chunk_size=256, num_processes=None, perf=None, parent=None):
+        """
+        :param compute_function: function (list of paths) -> (dict of arrays, valid), it runs in worker processes
+        """
+        super().__init__(parent)
+        self.cache_path = cache_path
+        self.compute_function = compute_function
+        self.chunk_size = chunk_size
+        self.num_processes = num_processes or max(1, (os.cpu_count() or 2) - 1)
+        self.perf = perf
+        self._executor = None
+        self._stopped = False
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, items):
+        """
+        :param items: list of (image name, path to the image)
+        """
+        if self.running:
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, args=(items,), name=type(self).__name__, daemon=True)
+        self._thread.start()
 
-    for filename in os.listdir(dir):
-        if filename.lower().endswith(extensions):
-            img_paths.append(os.path.join(dir, filename))
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
 
-    # sort image names
-    img_paths.sort()
-    return img_paths
+    def load_cache(self):
+        """
+        :return: image name -> (mtime, size, tuple of values in order of fields)
+        """
+        if not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with np.load(self.cache_path) as data:
+                columns = [data[field] for field in self.fields]
+                return {img_name: (mtime, size, tuple(values)) for img_name, mtime, size, *values in
+                        zip(data['names'].tolist(), data['mtimes'].tolist(), data['sizes'].tolist(), *columns)}
+        except (OSError, ValueError, KeyError) as e:
+            print(f'Cache {self.cache_path} is not readable, it is computed again: {e}')
+            return {}
+
+    def save_cache(self, cache):
+        entries = list(cache.values())
+        arrays = {field: np.array([entry[2][i] for entry in entries], dtype=dtype)
+                  for i, (field, dtype) in enumerate(self.fields.items())}
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, names=np.array(list(cache), dtype=str),
+                     mtimes=np.array([entry[0] for entry in entries], dtype=np.int64),
+                     sizes=np.array([entry[1] for entry in entries], dtype=np.int64), **arrays)
+        os.replace(tmp_path, self.cache_path)
+
+    def _run(self, items):
+        cache = self.load_cache()
+        stamps = {}
+        missing = []
+        for img_name, img_path in items:
+            try:
+                stamps[img_name] = image_sources.stat(img_path)
+            except (OSError, ValueError):
+                continue
+            cached = cache.get(img_name)
+            if cached is None or cached[:2] != stamps[img_name]:
+                missing.append((img_name, img_path))
+
+        done = len(stamps) - len(missing)
+        self.progress.emit(done, len(stamps))
+        if missing:
+            # spawn keeps the workers independent from the Qt state of the GUI process,
+            # they read indexes of archives cached by the GUI process
+            self._executor = ProcessPoolExecutor(self.num_processes, mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=image_sources.set_index_folder,
+                                                 initargs=(image_sources.get_index_folder(),))
+            futures = {}
+            for start in range(0, len(missing), self.chunk_size):
+                chunk = missing[start:start + self.chunk_size]
+                futures[self._executor.submit(self.compute_function, [path for _, path in chunk])] = chunk
+            error = None
+            for future in as_completed(futures):
+                if self._stopped:
+                    break
+                chunk = futures[future]
+                try:
+                    arrays, valid = future.result()
+                except Exception as e:
+                    # e.g. BrokenProcessPool when a worker process was killed
+                    error = f'{type(e).__name__}: {e}'
+                    break
+                for i, (img_name, _) in enumerate(chunk):
+                    if valid[i]:
+                        cache[img_name] = stamps[img_name] + (tuple(arrays[field][i] for field in self.fields),)
+                done += len(chunk)
+                self.progress.emit(done, len(stamps))
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+            # values computed before the failure are kept for the next run
+            self.save_cache(cache)
+            if error is not None:
+                self.failed.emit(error)
+                return
+        if self._stopped:
+            return
+
+        start = time.perf_counter()
+        img_names = [img_name for img_name in stamps if img_name in cache]
+        arrays = {field: np.array([cache[img_name][2][i] for img_name in img_names], dtype=dtype)
+                  for i, (field, dtype) in enumerate(self.fields.items())}
+        result = self.process(img_names, arrays)
+        if self.perf is not None:
+            self.perf.record(self.perf_name, time.perf_counter() - start)
+        self.finished.emit(result)
+
+    def process(self, img_names, arrays):
+        """
+        :param img_names: names of all images that could be decoded
+        :param arrays: field -> array of values of the images
+        :return: list passed to the finished signal
+        """
+        raise NotImplementedError
+
+    def shutdown(self):
+        self._stopped = True
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        self.wait()
+
+
+class DuplicateFinder(ImageAnalysisWorker):
+    """
+    Finds groups of near-duplicate images (burst shots, almost identical frames) by perceptual hashes
+    """
+
+    fields = {'dhashes': 'uint64', 'phashes': 'uint64'}
+    perf_name = 'duplicates.group'
+
+    def __init__(self, cache_path, max_distance=4, hash_type='phash', **kwargs):
+        """
+        :param hash_type: 'phash' or 'dhash'
+        """
+        super().__init__(cache_path, compute_perceptual_hashes, **kwargs)
+        self.max_distance = max_distance
+        self.hash_type = hash_type
+
+    def process(self, img_names, arrays):
+        """
+        :return: groups (lists of image names, only groups with more than one image)
+        """
+        hashes = arrays['phashes'] if self.hash_type == 'phash' else arrays['dhashes']
+        group_ids = group_near_duplicates(hashes, self.max_distance)
+        groups = {}
+        for img_name, group_id in zip(img_names, group_ids.tolist()):
+            groups.setdefault(group_id, []).append(img_name)
+        return sorted(sorted(group) for group in groups.values() if len(group) > 1)
 
 
-def make_folder(directory):
+def nearest_centroids(features, centroids, chunk_size=65536):
     """
-    Make folder if it doesn't already exist
-    :param directory: The folder destination path
+    :return: index of the nearest centroid of every feature vector
     """
-    if not os.path.exists(directory):
-        os.makedirs(directory)
+    nearest = np.empty(len(features), dtype=np.int64)
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    for start in range(0, len(features), chunk_size):
+        chunk = features[start:start + chunk_size]
+        nearest[start:start + chunk_size] = (centroid_norms[None, :] - 2 * chunk @ centroids.T).argmin(axis=1)
+    return nearest
+
+
+def kmeans(features, num_clusters, iterations, rng):
+    """
+    :return: centroids of k-means clustering of the features
+    """
+    centroids = features[rng.choice(len(features), num_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest_centroids(features, centroids)
+        order = np.argsort(assignment, kind='stable')
+        sorted_assignment = assignment[order]
+        starts = np.flatnonzero(np.r_[True, sorted_assignment[1:] != sorted_assignment[:-1]])
+        counts = np.diff(np.r_[starts, len(order)])
+        centroids[sorted_assignment[starts]] = np.add.reduceat(features[order], starts) / counts[:, None]
+    return centroids
+
+
+def similarity_order(features, max_clusters=256, sample_size=50000, iterations=15, seed=0):
+    """
+    Orders images so that similar ones come one after another. Features are clustered by k-means
+    (fitted on a sample, so it scales to millions of images), clusters are chained by greedy nearest
+    neighbour of their centroids and images in every cluster are sorted along the direction
+    to the next cluster, so the transitions between clusters are smooth too.
+    :param features: float array (n, d)
+    :return: permutation of image indices
+    """
+    features = np.asarray(features, dtype=np.float32)
+    n = len(features)
+    if n < 3:
+        return np.arange(n)
+
+    rng = np.random.default_rng(seed)
+    num_clusters = int(min(max_clusters, max(1, round(math.sqrt(n)))))
+    sample = features if n <= sample_size else features[rng.choice(n, sample_size, replace=False)]
+    centroids = kmeans(sample, num_clusters, iterations, rng)
+    assignment = nearest_centroids(features, centroids)
+
+    # chain of clusters, starting with the largest one
+    counts = np.bincount(assignment, minlength=num_clusters)
+    current = int(counts.argmax())
+    chain = [current]
+    remaining = set(np.flatnonzero(counts).tolist()) - {current}
+    while remaining:
+        candidates = np.array(sorted(remaining))
+        current = int(candidates[((centroids[candidates] - centroids[current]) ** 2).sum(axis=1).argmin()])
+        chain.append(current)
+        remaining.discard(current)
+
+    members_order = np.argsort(assignment, kind='stable')
+    starts = np.r_[0, np.cumsum(counts)]
+    order = []
+    for position, cluster in enumerate(chain):
+        members = members_order[starts[cluster]:starts[cluster + 1]]
+        if position + 1 < len(chain):
+            direction = centroids[chain[position + 1]] - centroids[cluster]
+        elif position > 0:
+            direction = centroids[cluster] - centroids[chain[position - 1]]
+        else:
+            direction = np.zeros(features.shape[1], dtype=np.float32)
+        order.append(members[np.argsort(features[members] @ direction, kind='stable')])
+    return np.concatenate(order)
+
+
+class SimilarityOrderer(ImageAnalysisWorker):
+    """
+    Orders images by visual similarity (colour histograms and downsampled pixels)
+    """
+
+    fields = {'features': 'float16'}
+    perf_name = 'similarity.order'
+
+    def __init__(self, cache_path, **kwargs):
+        super().__init__(cache_path, compute_image_features, **kwargs)
+
+    def process(self, img_names, arrays):
+        """
+        :return: image names in similarity order
+        """
+        if not img_names:
+            return []
+        order = similarity_order(arrays['features'].reshape(len(img_names), -1))
+        return [img_names[i] for i in order.tolist()]
 
 
 class SetupWindow(QWidget):
@@ -73,6 +2155,12 @@ class SetupWindow(QWidget):
 
         # Inputs
         self.numLabelsInput = QLineEdit(self)
+        self.annotator_input = QLineEdit(self)
+        self.shard_input = QLineEdit(self)
+        self.shard_strategy_combo = QtWidgets.QComboBox(self)
+        self.overlap_input = QLineEdit(self)
+        self.multi_label_checkbox = QCheckBox(
+            'label keys add or remove labels, images can have any number of labels (csv or deferred mode)', self)
 
         # Validation
         self.onlyInt = QIntValidator()
@@ -104,7 +2192,7 @@ class SetupWindow(QWidget):
         self.browse_button.clicked.connect(self.pick_new)
 
         # Input number of labels
-        top_margin_num_labels = 260
+        top_margin_num_labels = 300
         self.headline_num_labels.move(20, top_margin_num_labels)
         self.headline_num_labels.setObjectName("headline")
 
@@ -121,19 +2209,25 @@ class SetupWindow(QWidget):
         self.confirm_num_labels.clicked.connect(self.generate_label_inputs)
 
         # Next Button
-        self.next_button.move(360, 530)
+        self.next_button.move(360, 570)
         self.next_button.clicked.connect(self.continue_app)
         self.next_button.setObjectName("blueButton")
 
         # Error message
-        self.error_message.setGeometry(20, 560, self.width - 20, 20)
+        self.error_message.setGeometry(20, 600, self.width - 20, 20)
         self.error_message.setAlignment(Qt.AlignCenter)
         self.error_message.setStyleSheet('color: red; font-weight: bold')
 
         self.init_radio_buttons()
+        self.init_shard_inputs()
+
+        headline = QLabel('6. Multi-label session (optional)', self)
+        headline.setObjectName("headline")
+        headline.move(900, 490)
+        self.multi_label_checkbox.move(900, 525)
 
         # initiate the ScrollArea
-        self.scroll.setGeometry(20, 400, 300, 100)
+        self.scroll.setGeometry(20, 440, 300, 100)
 
         # apply custom styles
         try:
@@ -174,9 +2268,60 @@ class SetupWindow(QWidget):
         radiobutton.toggled.connect(self.mode_changed)
         radiobutton.move(20, top_margin + 95)
 
+        radiobutton = QRadioButton(
+            "link (Creates folder for each label. Labeled images are linked into these folders without copying "
+            "(hardlink, reflink or symlink). Csv is also generated)",
+            self)
+        radiobutton.mode = "link"
+        radiobutton.toggled.connect(self.mode_changed)
+        radiobutton.move(20, top_margin + 125)
+
+        radiobutton = QRadioButton(
+            "deferred (Images are only labeled. \"Commit\" button moves/copies/links them to label folders in one "
+            "batch. Csv is also generated)",
+            self)
+        radiobutton.mode = "deferred"
+        radiobutton.toggled.connect(self.mode_changed)
+        radiobutton.move(20, top_margin + 155)
+
+    def init_shard_inputs(self):
+        """
+        Creates optional section for sharded sessions, where several annotators label disjoint parts of the folder
+        """
+        left_margin = 900
+        top_margin = 300
+        headline = QLabel('5. Sharded session (optional)', self)
+        headline.setObjectName("headline")
+        headline.move(left_margin, top_margin)
+
+        QLabel('annotator name:', self).move(left_margin, top_margin + 35)
+        self.annotator_input.setGeometry(left_margin + 150, top_margin + 30, 200, 26)
+
+        QLabel('shard (e.g. 1/3):', self).move(left_margin, top_margin + 70)
+        self.shard_input.setGeometry(left_margin + 150, top_margin + 65, 60, 26)
+
+        QLabel('partitioning:', self).move(left_margin, top_margin + 105)
+        self.shard_strategy_combo.addItems(['hash', 'range'])
+        self.shard_strategy_combo.setGeometry(left_margin + 150, top_margin + 100, 100, 26)
+
+        QLabel('overlap (%):', self).move(left_margin, top_margin + 140)
+        self.overlap_input.setGeometry(left_margin + 150, top_margin + 135, 60, 26)
+        self.overlap_input.setValidator(self.onlyInt)
+
+    def shard_spec(self):
+        """
+        :return: ShardSpec from the inputs of the sharded session section (None if shard is not specified)
+        """
+        shard = self.shard_input.text().strip()
+        if not shard:
+            return None
+        index, count = (int(part) for part in shard.split('/'))
+        overlap = int(self.overlap_input.text() or 0) / 100
+        return ShardSpec(index - 1, count, self.shard_strategy_combo.currentText(), overlap)
+
     def mode_changed(self):
         """
-        Sets new mode (one of: csv, copy, move)
+        Sets new mode (one of: csv, copy, move, link, deferred)
         """
         radioButton = self.sender()
         if radioButton.isChecked():
@@ -191,6 +2336,15 @@ class SetupWindow(QWidget):
 
         self.selected_folder_label.setText(folder_path)
         self.selected_folder = folder_path
+        # kind of the session can't change
+        saved_multi_label = LabelStore.load_session_multi_label(os.path.join(folder_path, 'output'))
+        if saved_multi_label is not None:
+            self.multi_label_checkbox.setChecked(saved_multi_label)
+        # mode of the saved session is selected, so it isn't switched by accident
+        saved_mode = LabelStore.load_session_mode(os.path.join(folder_path, 'output'))
+        for radiobutton in self.findChildren(QRadioButton):
+            if saved_mode is not None and getattr(radiobutton, 'mode', None) == saved_mode:
+                radiobutton.setChecked(True)
 
     def pick_labels_file(self):
         options = QFileDialog.Options()
@@ -272,6 +2426,28 @@ class SetupWindow(QWidget):
             if label.text().strip() == '':
                 return False, 'All label fields has to be filled (step 4).'
 
+        if self.shard_input.text().strip():
+            try:
+                shard = self.shard_spec()
+            except ValueError:
+                return False, 'Shard has to be in format "index/count", e.g. 1/3 (step 5).'
+            if not self.annotator_input.text().strip():
+                return False, 'Annotator name is required for sharded session (step 5).'
+            if shard.overlap and self.mode not in ('csv', 'deferred'):
+                return False, 'Images shared by annotators can be labeled only in csv or deferred mode (step 5).'
+
+        saved_multi_label = LabelStore.load_session_multi_label(os.path.join(self.selected_folder, 'output'))
+        if saved_multi_label is not None and saved_multi_label != self.multi_label_checkbox.isChecked():
+            kind = 'multi' if saved_multi_label else 'single'
+            return False, f'The folder has a {kind}-label session, it has to be opened as {kind}-label session ' \
+                          f'(step 6).'
+
+        if self.multi_label_checkbox.isChecked():
+            if self.mode not in ('csv', 'deferred'):
+                return False, 'Multi-label session can be labeled only in csv or deferred mode (step 6).'
+            if self.annotator_input.text().strip():
+                return False, 'Labels of annotators can be merged only in single-label sessions (step 6).'
+
         return True, 'Form ok'
 
     def continue_app(self):
@@ -287,15 +2463,36 @@ class SetupWindow(QWidget):
 
             self.close()
             # show window in full-screen mode (window is maximized)
-            LabelerWindow(label_values, self.selected_folder, self.mode).showMaximized()
+            LabelerWindow(label_values, self.selected_folder, self.mode,
+                          annotator=self.annotator_input.text().strip() or None,
+                          shard=self.shard_spec(),
+                          multi_label=self.multi_label_checkbox.isChecked()).showMaximized()
         else:
             self.error_message.setText(message)
 
 
 class LabelerWindow(QWidget):
-    def __init__(self, labels, input_folder, mode):
+    def __init__(self, labels, input_folder, mode, prefetch_count=4, cache_mb=256,
+                 extensions=('.jpg', '.png', '.jpeg'), recursive=True, ignore=(), trace_path=None, annotator=None,
+                 shard=None, duplicate_distance=4, watch=False, multi_label=False, archives=True):
+        """
+        :param annotator: name of the annotator in a sharded session; labels are saved to own output folder
+        :param shard: ShardSpec, only images of this shard are shown
+        :param duplicate_distance: maximal number of different bits of perceptual hashes of near-duplicate images
+        :param watch: if True, images added to or removed from the folder during the session are added to
+        or removed from the navigator
+        :param multi_label: if True, label keys add or remove labels and images can have any number of labels
+        ('csv' and 'deferred' modes only)
+        :param archives: if True, images in tar and zip archives in the folder are labeled without extracting them
+        (they are extracted only into label folders)
+        """
         super().__init__()
 
+        # timing of hot paths (shown in overlay, optionally written to JSON-lines trace file)
+        self.perf = PerfMonitor(trace_path)
+        self.start_time = time.perf_counter()
+        self.time_to_first_image = None
+
         # init UI state
         self.title = 'PyQt5 - Annotation tool for assigning image classes'
         self.left = 200
@@ -305,46 +2502,189 @@ class LabelerWindow(QWidget):
         # img panel size should be square-like to prevent some problems with different aspect ratios
         self.img_panel_width = 1100
         self.img_panel_height = 1100
+        self.img_margin = 20
 
         # state variables
         self.counter = 0
         self.input_folder = input_folder
-        self.img_paths = get_img_paths(input_folder)
         self.labels = labels
         self.num_labels = len(self.labels)
-        self.num_images = len(self.img_paths)
-        self.assigned_labels = {}
         self.mode = mode
+        self.multi_label = multi_label
+        if multi_label and mode not in ('csv', 'deferred'):
+            raise ValueError(f'Multi-label session can be labeled only in csv or deferred mode, not {mode}')
+
+        path_to_save = os.path.join(self.input_folder, 'output')
+        make_folder(path_to_save)
+        # offsets of images in archives are indexed once per archive
+        image_sources.set_index_folder(os.path.join(path_to_save, 'archive_index'))
+
+        # in a sharded session every annotator has own journal and csv, scan index and thumbnails are shared
+        self.annotator = annotator
+        self.shard = shard
+        self.output_folder = annotator_folder(input_folder, annotator) if annotator else path_to_save
+        make_folder(self.output_folder)
+
+        # the other kind of store would start empty and overwrite the session
+        saved_multi_label = LabelStore.load_session_multi_label(self.output_folder)
+        if saved_multi_label is not None and saved_multi_label != multi_label:
+            raise ValueError(f'{input_folder} has a {"multi" if saved_multi_label else "single"}-label session, '
+                             f'it can\'t be opened as {"multi" if multi_label else "single"}-label session')
+
+        # resume labels from the journal of previous session
+        if multi_label:
+            self.label_store = MultiLabelStore(labels, self.output_folder)
+        else:
+            self.label_store = LabelStore(labels, self.output_folder)
+        # mode is the default when the session is opened again
+        self.label_store.mode = mode
+        self.label_store.save_session()
+        self.assigned_labels = self.label_store.assigned_labels
+
+        # labels missing in the journal are restored from label folders and from the csv of the last session
+        locations, conflicts = self.reconstruct_session(extensions, recursive, ignore)
+
+        # in 'deferred' mode images are placed into label folders only by "Commit". Images shared by annotators
+        # would be placed by every one of them, so with overlap only the merged session is committed.
+        self.materializer = None
+        self.commit_worker = None
+        if mode == 'deferred' and not (shard is not None and shard.overlap):
+            self.materializer = Materializer(self.input_folder, self.labels, output_folder=self.output_folder,
+                                             multi_label=multi_label)
+
+        # list images in background, the window is shown as soon as the first batch is found.
+        # Label folders and output folder are skipped.
+        self.scanner = ImageScanner(input_folder, extensions, recursive, ignore,
+                                    index_path=os.path.join(path_to_save, 'scan_index.json'), archives=archives,
+                                    excluded=['output'] + list(labels))
+        batches = self.scanner.scan()
+        moved = mode == 'move' or (self.materializer is not None and self.materializer.mode == 'move')
+        if moved and locations:
+            # images moved into label folders by previous sessions (or commits) are listed too (images in
+            # archives are only extracted into label folders, so they are listed from their archives)
+            restored = [os.path.join(input_folder, img_name) for img_name in locations]
+            batches = self.restored_batches(batches, [path for path in restored if not image_sources.is_member(path)])
+        if shard is not None:
+            batches = self.shard_batches(batches)
+        self.img_paths = next(batches, [])
+        self.num_images = len(self.img_paths)
+        self.scan_worker = ScanWorker(batches, self)
+        self.scan_finished = False
+        self.counter = self.first_unlabeled_index()
+        # labels by position in navigation order (built when it's needed for the first time)
+        self._label_index = None
+
+        # fsync journal at least once per second even when no more labels are assigned
+        self.journal_timer = QTimer(self)
+        self.journal_timer.timeout.connect(self.label_store.sync)
+        self.journal_timer.start(1000)
 
         # initialize list to save all label buttons
         self.label_buttons = []
 
         # Initialize Labels
-        self.image_box = QLabel(self)
+        self.image_box = QLabel()
+        self.image_scroll = QScrollArea(self)
         self.img_name_label = QLabel(self)
         self.progress_bar = QLabel(self)
         self.curr_image_headline = QLabel('Current image', self)
         self.csv_note = QLabel('(csv will be also generated automatically after closing the app)', self)
         self.csv_generated_message = QLabel(self)
         self.show_next_checkbox = QCheckBox("Automatically show next image when labeled", self)
+        self.full_resolution_checkbox = QCheckBox("Show image in full resolution (F)", self)
+        self.grid_checkbox = QCheckBox("Grid view (G) - select thumbnails and press label key", self)
+        self.tiled_checkbox = QCheckBox("Zoomable viewer (Z) - wheel zooms, drag pans", self)
         self.generate_xlsx_checkbox = QCheckBox("Also generate .xlsx file", self)
+        self.generate_npz_checkbox = QCheckBox("Also generate .npz file", self)
+        self.file_ops_status = QLabel(self)
+        self.perf_overlay = QLabel(self)
+        self.perf_overlay_timer = QTimer(self)
+        # timings are printed on close only when they were looked at (overlay) or traced
+        self.perf_overlay_shown = False
+        self.file_ops_progress = QProgressBar(self)
+        self.select_glob_input = QLineEdit(self)
+        self.select_glob_button = QtWidgets.QPushButton("Select", self)
+        self.commit_button = QtWidgets.QPushButton("Commit", self)
+        self.commit_mode_combo = QtWidgets.QComboBox(self)
+        self.find_duplicates_button = QtWidgets.QPushButton("Find duplicates", self)
+        self.group_duplicates_checkbox = QCheckBox("Show and label duplicate groups at once (D)", self)
+        self.duplicates_status = QLabel(self)
+        self.order_combo = QtWidgets.QComboBox(self)
+        self.order_status = QLabel(self)
+        self.watch_checkbox = QCheckBox("Watch folder for new and deleted images", self)
+        self.navigation_filter_combo = QtWidgets.QComboBox(self)
+        self.class_counts = QLabel(self)
+        self.class_counts_scroll = QScrollArea(self)
+
+        self.label_colors = self.assign_label_colors()
 
-        self.file_list_widget = QListWidget(self)
-        self.file_list_widget.itemClicked.connect(self.on_file_item_clicked)
+        self.file_list_model = FileListModel(self.input_folder, self.img_paths, self.assigned_labels,
+                                             self.label_colors, self)
+        self.file_list_view = QListView(self)
+        self.file_list_view.setUniformItemSizes(True)
+        self.file_list_view.setSelectionMode(QListView.ExtendedSelection)
+        self.file_list_view.setModel(self.file_list_model)
+        self.file_list_view.clicked.connect(self.on_file_item_clicked)
 
-        self.file_list_widget.setStyleSheet("background-color: #333333; color: white;")
+        self.file_list_view.setStyleSheet("background-color: #333333; color: white;")
 
-        self.label_colors = self.assign_label_colors()
+        # decode neighbouring images in the background
+        self.prefetch_count = prefetch_count
+        self.prefetcher = ImagePrefetcher(self.img_panel_width - self.img_margin,
+                                          self.img_panel_height - self.img_margin, cache_mb, perf=self.perf,
+                                          parent=self)
+
+        # zoomable viewer for very large images (decodes only visible tiles)
+        self.tiled_view = TiledImageView(cache_mb, perf=self.perf, parent=self)
+
+        # thumbnails for the grid view are cached on disk across sessions
+        self.thumbnails = ThumbnailCache(os.path.join(path_to_save, 'thumbnails'), parent=self)
+        self.grid_model = ThumbnailGridModel(self, self.thumbnails, parent=self)
+        self.grid_view = QListView(self)
+
+        # groups of near-duplicate images by perceptual hashes (cached on disk across sessions)
+        self.duplicate_finder = DuplicateFinder(os.path.join(path_to_save, 'perceptual_hashes.npz'),
+                                                duplicate_distance, perf=self.perf, parent=self)
+
+        # changes made in the folder during the session (watched once the whole tree is listed)
+        self.folder_watcher = FolderWatcher(self.scanner, parent=self)
+        self.folder_watcher.changed.connect(self.on_folder_changed)
+        self.watch_checkbox.setChecked(watch)
+
+        # optional navigation order by visual similarity (features are cached on disk across sessions)
+        self.similarity_orderer = SimilarityOrderer(os.path.join(path_to_save, 'image_features.npz'),
+                                                    perf=self.perf, parent=self)
 
         # create label folders
-        if mode == 'copy' or mode == 'move':
+        self.file_ops = None
+        if mode == 'copy' or mode == 'move' or mode == 'link':
             self.create_label_folders(labels, self.input_folder)
 
+            # copy/move images in the background
+            self.file_ops = FileOperationQueue(self.input_folder, self.labels, mode, perf=self.perf,
+                                               output_folder=self.output_folder, locations=locations,
+                                               folder_watcher=self.folder_watcher, parent=self)
+            # images found in folders of other labels are placed according to the journal
+            for img_name, label, _ in conflicts:
+                self.file_ops.enqueue(img_name, label)
+            self.file_ops.status_changed.connect(self.update_file_ops_status)
+
         # init UI
         self.init_ui()
 
+        # add rest of the images to the navigator while they are found
+        self.scan_worker.batch_found.connect(self.add_image_paths)
+        self.scan_worker.finished.connect(self.on_scan_finished)
+        self.scan_worker.start()
+
     def init_ui(self):
 
+        if self.annotator:
+            self.title += f' - {self.annotator}'
+            if self.shard is not None:
+                self.title += f' (shard {self.shard.index + 1}/{self.shard.count})'
+        if self.multi_label:
+            self.title += ' - multi-label'
         self.setWindowTitle(self.title)
         self.setMinimumSize(self.width, self.height)  # minimum size of the window
 
@@ -355,9 +2695,43 @@ class LabelerWindow(QWidget):
         self.show_next_checkbox.setChecked(False)
         self.show_next_checkbox.setGeometry(self.img_panel_width + 220, 10, 400, 20)
 
+        # 'full resolution' checkbox (images are decoded only at the panel size by default)
+        self.full_resolution_checkbox.setChecked(False)
+        self.full_resolution_checkbox.setGeometry(self.img_panel_width + 220, 28, 400, 20)
+        self.full_resolution_checkbox.toggled.connect(self.show_current_image)
+
+        # grid view with thumbnails, shown instead of the single image
+        self.grid_checkbox.setChecked(False)
+        self.grid_checkbox.setGeometry(self.img_panel_width + 220, 88, 400, 20)
+        self.grid_checkbox.toggled.connect(self.set_grid_visible)
+
+        self.grid_view.setGeometry(220, 100, self.img_panel_width, self.img_panel_height)
+        self.grid_view.setViewMode(QListView.IconMode)
+        self.grid_view.setMovement(QListView.Static)
+        self.grid_view.setResizeMode(QListView.Adjust)
+        self.grid_view.setUniformItemSizes(True)
+        self.grid_view.setIconSize(QSize(self.thumbnails.size, self.thumbnails.size))
+        self.grid_view.setGridSize(QSize(self.thumbnails.size + 20, self.thumbnails.size + 40))
+        self.grid_view.setSelectionMode(QListView.ExtendedSelection)
+        self.grid_view.setStyleSheet("background-color: #333333; color: white;")
+        self.grid_view.setModel(self.grid_model)
+        self.grid_view.doubleClicked.connect(self.on_grid_item_double_clicked)
+        self.grid_view.hide()
+
+        # zoomable tiled viewer, shown instead of the scaled image
+        self.tiled_checkbox.setChecked(False)
+        self.tiled_checkbox.setGeometry(self.img_panel_width + 620, 28, 400, 20)
+        self.tiled_checkbox.toggled.connect(self.set_tiled_view)
+        self.tiled_view.setGeometry(220, 100, self.img_panel_width, self.img_panel_height)
+        self.tiled_view.hide()
+
         # "create xlsx" checkbox
         self.generate_xlsx_checkbox.setChecked(False)
-        self.generate_xlsx_checkbox.setGeometry(self.img_panel_width + 340, 606, 300, 20)
+        self.generate_xlsx_checkbox.setGeometry(self.img_panel_width + 340, 606, 170, 20)
+
+        # "create npz" checkbox
+        self.generate_npz_checkbox.setChecked(False)
+        self.generate_npz_checkbox.setGeometry(self.img_panel_width + 520, 606, 200, 20)
 
         # image headline
         self.curr_image_headline.setGeometry(220, 10, 300, 20)
@@ -376,16 +2750,102 @@ class LabelerWindow(QWidget):
         self.csv_generated_message.setGeometry(self.img_panel_width + 220, 660, 800, 20)
         self.csv_generated_message.setStyleSheet('color: #43A047')
 
-        # show image
-        self.set_image(self.img_paths[0])
-        self.image_box.setGeometry(220, 100, self.img_panel_width, self.img_panel_height)
-        self.image_box.setAlignment(Qt.AlignTop)
+        # pending/failed file operations
+        self.file_ops_status.setGeometry(self.img_panel_width + 220, 690, 800, 20)
+        self.file_ops_progress.setGeometry(self.img_panel_width + 220, 715, 300, 20)
+        self.file_ops_progress.hide()
+        self._file_ops_batch_size = 0
+
+        # select images in the navigator by filename glob (label keys then label all selected images)
+        self.select_glob_input.setGeometry(self.img_panel_width + 220, 745, 200, 26)
+        self.select_glob_input.setPlaceholderText('e.g. *_night_*.jpg')
+        self.select_glob_input.returnPressed.connect(self.select_by_glob)
+        self.select_glob_button.move(self.img_panel_width + 425, 744)
+        self.select_glob_button.clicked.connect(self.select_by_glob)
+
+        # "Commit" places labeled images into label folders ('deferred' mode only)
+        self.commit_button.move(self.img_panel_width + 220, 785)
+        self.commit_button.setObjectName("blueButton")
+        self.commit_button.clicked.connect(self.commit_labels)
+        # images with several labels can't be moved into all their label folders
+        self.commit_mode_combo.addItems(['copy', 'link'] if self.multi_label else ['move', 'copy', 'link'])
+        self.commit_mode_combo.setGeometry(self.img_panel_width + 340, 788, 80, 26)
+        if self.materializer is not None and self.materializer.placements:
+            # the folder was already committed, the same mode has to be used
+            self.commit_mode_combo.setCurrentText(self.materializer.mode)
+            self.commit_mode_combo.setEnabled(False)
+        if self.materializer is None:
+            self.commit_button.hide()
+            self.commit_mode_combo.hide()
+        if self.mode == 'deferred' and self.materializer is None:
+            self.file_ops_status.setText('images shared by annotators are committed from the merged session '
+                                         '(label_store.py merge-annotators, then commit)')
+
+        # near-duplicate groups: the first image of a group is shown with the whole group selected in the navigator,
+        # so the label key labels all of them, other images of the group are skipped
+        self.find_duplicates_button.move(self.img_panel_width + 220, 830)
+        self.find_duplicates_button.clicked.connect(self.find_duplicates)
+        self.duplicates_status.setGeometry(self.img_panel_width + 340, 833, 500, 20)
+        self.group_duplicates_checkbox.setChecked(False)
+        self.group_duplicates_checkbox.setGeometry(self.img_panel_width + 220, 865, 400, 20)
+        self.group_duplicates_checkbox.toggled.connect(lambda: self.select_file_list_row(self.counter))
+        self.duplicate_finder.progress.connect(self.on_duplicates_progress)
+        self.duplicate_finder.finished.connect(self.on_duplicates_found)
+        self.duplicate_finder.failed.connect(self.on_duplicates_failed)
+
+        # navigation order (by file name or by visual similarity), it can be switched at any time
+        order_label = QLabel('Order:', self)
+        order_label.move(self.img_panel_width + 220, 900)
+        self.order_combo.addItems(['name', 'similarity'])
+        self.order_combo.setGeometry(self.img_panel_width + 280, 895, 100, 26)
+        self.order_combo.currentTextChanged.connect(self.set_order)
+        self.order_status.setGeometry(self.img_panel_width + 390, 900, 450, 20)
+        self.similarity_orderer.progress.connect(self.on_similarity_progress)
+        self.similarity_orderer.finished.connect(self.on_similarity_order)
+        self.similarity_orderer.failed.connect(self.on_similarity_failed)
+
+        # watching the folder
+        self.watch_checkbox.setGeometry(self.img_panel_width + 220, 935, 400, 20)
+        self.watch_checkbox.toggled.connect(self.set_watching)
+
+        # "Next" and "Prev" show only unlabeled images or images of one label if the filter is set
+        navigate_label = QLabel('Navigate:', self)
+        navigate_label.move(self.img_panel_width + 640, 55)
+        # the label index keeps only the first label of every image, so multi-label sessions can't filter by label
+        self.navigation_filter_combo.addItems(['all images', 'unlabeled']
+                                              + ([] if self.multi_label else list(self.labels)))
+        self.navigation_filter_combo.setGeometry(self.img_panel_width + 720, 50, 160, 26)
+        self.navigation_filter_combo.setFocusPolicy(Qt.NoFocus)
+
+        # number of images of every label
+        self.class_counts.setAlignment(Qt.AlignTop | Qt.AlignLeft)
+        self.class_counts.setStyleSheet('font-family: monospace')
+        self.class_counts_scroll.setGeometry(self.img_panel_width + 640, 120, 300, 460)
+        self.class_counts_scroll.setWidgetResizable(True)
+        self.class_counts_scroll.setWidget(self.class_counts)
+        self.update_class_counts()
+
+        # show image (scroll area is used to pan full resolution images)
+        self.image_scroll.setGeometry(220, 100, self.img_panel_width, self.img_panel_height)
+        self.image_scroll.setAlignment(Qt.AlignTop | Qt.AlignLeft)
+        self.image_scroll.setFrameShape(QFrame.NoFrame)
+        self.image_scroll.setWidget(self.image_box)
+        self.set_image(self.get_image_path(self.counter), self.get_image_name(self.counter))
 
         # image name
-        self.img_name_label.setText(self.img_paths[self.counter])
+        self.img_name_label.setText(self.get_image_path(self.counter))
 
         # progress bar
-        self.progress_bar.setText(f'image 1 of {self.num_images}')
+        self.progress_bar.setText(f'image {self.counter + 1} of {self.num_images}')
+        self.set_button_color(self.get_image_name(self.counter))
+
+        # performance overlay over the image (toggled by P)
+        self.perf_overlay.setGeometry(230, 110, 720, 260)
+        self.perf_overlay.setAlignment(Qt.AlignTop | Qt.AlignLeft)
+        self.perf_overlay.setStyleSheet('background-color: rgba(0, 0, 0, 180); color: #7CFC00; '
+                                        'font-family: monospace; padding: 6px')
+        self.perf_overlay.hide()
+        self.perf_overlay_timer.timeout.connect(self.update_perf_overlay)
 
         # draw line for better UX
         ui_line = QLabel(self)
@@ -393,7 +2853,7 @@ class LabelerWindow(QWidget):
         ui_line.setStyleSheet('background-color: black')
 
         # file Navigation Bar
-        self.file_list_widget.setGeometry(10, 10, 200, self.height - 20)
+        self.file_list_view.setGeometry(10, 10, 200, self.height - 20)
         self.populate_file_list()
 
         # apply custom styles
@@ -423,6 +2883,33 @@ class LabelerWindow(QWidget):
         next_im_kbs = QShortcut(QKeySequence("right"), self)
         next_im_kbs.activated.connect(self.show_next_image)
 
+        # Add "full resolution" keyboard shortcut
+        full_resolution_kbs = QShortcut(QKeySequence("f"), self)
+        full_resolution_kbs.activated.connect(self.toggle_full_resolution)
+
+        # Add "performance overlay" keyboard shortcut
+        perf_kbs = QShortcut(QKeySequence("p"), self)
+        perf_kbs.activated.connect(self.toggle_perf_overlay)
+
+        # Add "grid view" keyboard shortcut
+        grid_kbs = QShortcut(QKeySequence("g"), self)
+        grid_kbs.activated.connect(lambda: self.grid_checkbox.setChecked(not self.grid_checkbox.isChecked()))
+
+        # Add "zoomable viewer" keyboard shortcut
+        tiled_kbs = QShortcut(QKeySequence("z"), self)
+        tiled_kbs.activated.connect(lambda: self.tiled_checkbox.setChecked(not self.tiled_checkbox.isChecked()))
+
+        # Add "next/previous unlabeled image" keyboard shortcuts
+        next_unlabeled_kbs = QShortcut(QKeySequence("u"), self)
+        next_unlabeled_kbs.activated.connect(lambda: self.show_unlabeled_image(1))
+        prev_unlabeled_kbs = QShortcut(QKeySequence("shift+u"), self)
+        prev_unlabeled_kbs.activated.connect(lambda: self.show_unlabeled_image(-1))
+
+        # Add "duplicate groups" keyboard shortcut
+        duplicates_kbs = QShortcut(QKeySequence("d"), self)
+        duplicates_kbs.activated.connect(
+            lambda: self.group_duplicates_checkbox.setChecked(not self.group_duplicates_checkbox.isChecked()))
+
         # Add "generate csv file" button
         next_im_btn = QtWidgets.QPushButton("Generate csv", self)
         next_im_btn.move(self.img_panel_width + 220, 600)
@@ -483,119 +2970,501 @@ class LabelerWindow(QWidget):
 
     def set_label(self, label):
         """
-        Sets the label for just loaded image
+        Sets the label for just loaded image (or for all selected images in the grid view or navigator)
         :param label: selected label
         """
+        if self.multi_label:
+            # the label is added or removed, the image stays shown, so more labels can be toggled
+            if self.grid_view.isVisible():
+                indices = [self.grid_model.image_index(index.row())
+                           for index in self.grid_view.selectionModel().selectedIndexes()]
+            else:
+                indices = self.selected_file_list_indices()
+                if len(indices) <= 1:
+                    indices = [self.counter]
+            self.toggle_label(indices, label)
+            return
+
+        if self.grid_view.isVisible():
+            self.set_label_for_grid_selection(label)
+            return
+
+        selected = self.selected_file_list_indices()
+        if len(selected) > 1:
+            self.label_images(selected, label)
+            if self.group_duplicates_checkbox.isChecked() and self.show_next_checkbox.isChecked():
+                # the whole duplicate group was labeled
+                self.show_next_image()
+            return
+
+        img_name = self.get_image_name(self.counter)
+
+        if self.assigned_labels.get(img_name) == label:
+            # selecting the same label again removes it
+            label = None
+        with self.perf.measure('set_label'):
+            self.assign_label(self.counter, label)
+
+        if self.show_next_checkbox.isChecked():
+            self.show_next_image()
+        else:
+            self.set_button_color(img_name)
+
+    def assign_label(self, idx, label):
+        """
+        Assigns label to the image, journals it and queues the file operation
+        :param idx: index of the image
+        :param label: label or None to remove the label
+        """
+        self.label_images([idx], label)
+
+    def label_images(self, indices, label):
+        """
+        Assigns the same label to many images at once. Labels are updated in one pass, journaled with
+        one write, file operations are queued as one batch and affected rows are refreshed once.
+        :param indices: iterable of image indices
+        :param label: label or None to remove the labels
+        """
+        indices = sorted(set(indices))
+        if not indices:
+            return
+        self.perf.record_labels(len(indices))
+        img_names = [self.get_image_name(idx) for idx in indices]
+
+        self.label_store.set_labels(img_names, label)
 
-        img_path = self.img_paths[self.counter]
-        img_name = os.path.split(img_path)[-1]
+        # images are copied/moved in the background
+        if self.file_ops is not None:
+            self.file_ops.enqueue_many(img_names, label)
 
-        if img_name in self.assigned_labels:
-            previous_label = self.assigned_labels[img_name]
+        self.refresh_labels(indices, label)
 
-            if label == previous_label:
-                del self.assigned_labels[img_name]
+    def toggle_label(self, indices, label):
+        """
+        Multi-label mode: adds the label to the images, or removes it if all of them already have it
+        :param indices: iterable of image indices
+        """
+        indices = sorted(set(indices))
+        if not indices:
+            return
+        self.perf.record_labels(len(indices))
+        img_names = [self.get_image_name(idx) for idx in indices]
+
+        with self.perf.measure('set_label'):
+            self.label_store.toggle(img_names, label)
+
+        self.refresh_labels(indices)
 
-                if self.mode == 'copy':
-                    os.remove(os.path.join(self.input_folder, label, img_name))
-                elif self.mode == 'move':
-                    shutil.move(os.path.join(self.input_folder, label, img_name), self.input_folder)
+    def refresh_labels(self, indices, label=None):
+        """
+        Updates the navigator, the grid, label buttons, the label index and class counts once labels
+        of the images changed
+        :param indices: sorted list of image indices
+        :param label: new label of all the images (not used in multi-label mode)
+        """
+        with self.perf.measure('update_file_list_item'):
+            self.file_list_model.refresh_rows(indices[0], indices[-1])
+            self.grid_model.refresh_images(indices[0], indices[-1])
+        self.set_button_color(self.get_image_name(self.counter))
+
+        if self._label_index is not None:
+            if self.multi_label:
+                # the index keeps the first label of every image
+                first_labels = [self.assigned_labels.get(self.get_image_name(idx)) for idx in indices]
+                for first_label in set(first_labels):
+                    self._label_index.set([idx for idx, image_label in zip(indices, first_labels)
+                                           if image_label == first_label], first_label)
             else:
-                if self.mode == 'copy':
-                    os.remove(os.path.join(self.input_folder, previous_label, img_name))
-                    shutil.copy(img_path, os.path.join(self.input_folder, label))
-                elif self.mode == 'move':
-                    shutil.move(os.path.join(self.input_folder, previous_label, img_name),
-                                os.path.join(self.input_folder, label, img_name))
-                self.assigned_labels[img_name] = label
-        else:
-            self.assigned_labels[img_name] = label
-            if self.mode == 'copy':
-                shutil.copy(img_path, os.path.join(self.input_folder, label))
-            elif self.mode == 'move':
-                shutil.move(img_path, os.path.join(self.input_folder, label))
+                self._label_index.set(indices, label)
+        self.update_class_counts()
 
-        self.update_file_list_item(self.counter)
+    def set_label_for_grid_selection(self, label):
+        """
+        Assigns the label to all images selected in the grid view
+        """
+        rows = [index.row() for index in self.grid_view.selectionModel().selectedIndexes()]
+        self.label_images([self.grid_model.image_index(row) for row in rows], label)
 
-        if self.show_next_checkbox.isChecked():
-            self.show_next_image()
-        else:
-            self.set_button_color(img_name)
+    def selected_file_list_indices(self):
+        """
+        :return: indices of images selected in the navigator (selection ranges are expanded without creating
+        model index for each row)
+        """
+        indices = []
+        for selection_range in self.file_list_view.selectionModel().selection():
+            indices.extend(range(selection_range.top(), selection_range.bottom() + 1))
+        return indices
 
-    def show_next_image(self):
+    def select_by_glob(self):
         """
-        loads and shows next image in dataset
+        Selects images in the navigator whose names match the glob from the input field
         """
-        if self.counter < self.num_images - 1:
-            self.counter += 1
+        pattern = self.select_glob_input.text().strip()
+        if not pattern:
+            return
 
-            path = self.img_paths[self.counter]
-            filename = os.path.split(path)[-1]
+        self.select_file_list_indices(idx for idx, img_path in enumerate(self.img_paths)
+                                      if fnmatch.fnmatch(get_img_name(img_path, self.input_folder), pattern))
+        self.csv_generated_message.setText(f'{len(self.selected_file_list_indices())} images selected, '
+                                           f'press label key to label all of them')
 
-            # If we have already assigned label to this image and mode is 'move', change the input path.
-            if self.mode == 'move' and filename in self.assigned_labels:
-                label = self.assigned_labels[filename]
-                path = os.path.join(self.input_folder, label, filename)
+    def select_file_list_indices(self, indices):
+        """
+        Selects rows of the navigator (the current row doesn't change)
+        :param indices: sorted iterable of image indices
+        """
+        selection = QItemSelection()
+        first = None
+        for idx in indices:
+            # merge consecutive rows into one range
+            if first is None:
+                first = last = idx
+            elif idx == last + 1:
+                last = idx
+            else:
+                selection.select(self.file_list_model.index(first), self.file_list_model.index(last))
+                first = last = idx
+        if first is not None:
+            selection.select(self.file_list_model.index(first), self.file_list_model.index(last))
 
-            self.set_image(path)
-            self.img_name_label.setText(path)
-            self.progress_bar.setText(f'image {self.counter + 1} of {self.num_images}')
-            self.set_button_color(filename)
-            self.csv_generated_message.setText('')
+        self.file_list_view.selectionModel().select(selection, QItemSelectionModel.ClearAndSelect)
+
+    def set_grid_visible(self, visible):
+        """
+        switches between single image and grid of thumbnails (the grid shows page with the current image)
+        """
+        if visible:
+            page_size = self.grid_model.page_size
+            self.grid_model.set_page_start(self.counter - self.counter % page_size)
+            self.image_view().hide()
+            self.grid_view.show()
+            self.grid_view.setFocus()
+        else:
+            self.thumbnails.cancel_pending()
+            self.grid_view.hide()
+            self.image_view().show()
+            self.show_current_image()
+
+    def image_view(self):
+        """
+        :return: widget showing the single image (scroll area with scaled image or the zoomable tiled viewer)
+        """
+        return self.tiled_view if self.tiled_checkbox.isChecked() else self.image_scroll
+
+    def set_tiled_view(self, enabled):
+        """
+        switches between the scaled image and the zoomable tiled viewer
+        """
+        if self.grid_view.isVisible():
+            return
+        (self.image_scroll if enabled else self.tiled_view).hide()
+        self.image_view().show()
+        self.show_current_image()
+
+    def show_grid_page(self, page_start):
+        self.grid_model.set_page_start(page_start)
+        self.counter = page_start
+        self.progress_bar.setText(f'images {page_start + 1}-{page_start + self.grid_model.rowCount()} '
+                                  f'of {self.num_images}')
+        self.select_file_list_row(self.counter)
+
+    def on_grid_item_double_clicked(self, index):
+        """
+        opens double-clicked thumbnail in the single image view
+        """
+        self.counter = self.grid_model.image_index(index.row())
+        self.grid_checkbox.setChecked(False)
+        self.select_file_list_row(self.counter)
+
+    def show_next_image(self):
+        """
+        loads and shows next image in dataset
+        """
+        if self.grid_view.isVisible():
+            page_start = self.grid_model.page_start + self.grid_model.page_size
+            if page_start < self.num_images:
+                self.show_grid_page(page_start)
+            return
 
-            self.file_list_widget.setCurrentRow(self.counter)
+        next_idx = self.step_index(1)
+        if next_idx is not None:
+            self.show_image_at(next_idx)
 
         # change button color if this is last image in dataset
-        elif self.counter == self.num_images - 1:
-            path = self.img_paths[self.counter]
-            self.set_button_color(os.path.split(path)[-1])
+        else:
+            self.set_button_color(self.get_image_name(self.counter))
 
     def show_prev_image(self):
         """
         loads and shows previous image in dataset
         """
-        if self.counter > 0:
-            self.counter -= 1
+        if self.grid_view.isVisible():
+            if self.grid_model.page_start > 0:
+                self.show_grid_page(max(0, self.grid_model.page_start - self.grid_model.page_size))
+            return
 
-            if self.counter < self.num_images:
-                path = self.img_paths[self.counter]
-                filename = os.path.split(path)[-1]
+        prev_idx = self.step_index(-1)
+        if prev_idx is not None:
+            self.show_image_at(prev_idx)
 
-                # If we have already assigned label to this image and mode is 'move', change the input path.
-                if self.mode == 'move' and filename in self.assigned_labels:
-                    label = self.assigned_labels[filename]
-                    path = os.path.join(self.input_folder, label, filename)
+    def show_image_at(self, idx):
+        """
+        shows the image with given index and selects it in the navigator
+        """
+        self.counter = idx
+        path = self.get_image_path(self.counter)
+        filename = self.get_image_name(self.counter)
 
-                self.set_image(path)
-                self.img_name_label.setText(path)
-                self.progress_bar.setText(f'image {self.counter + 1} of {self.num_images}')
+        self.set_image(path, filename)
+        self.img_name_label.setText(path)
+        self.progress_bar.setText(f'image {self.counter + 1} of {self.num_images}')
+        self.set_button_color(filename)
+        self.csv_generated_message.setText('')
 
-                self.set_button_color(filename)
-                self.csv_generated_message.setText('')
+        self.select_file_list_row(self.counter)
 
-                self.file_list_widget.setCurrentRow(self.counter)
+    def step_index(self, step):
+        """
+        :param step: 1 for the next image, -1 for the previous one
+        :return: index of the next/previous image to show or None if there is none. Images which don't pass
+        the navigation filter and other images of duplicate groups are skipped.
+        """
+        filter_index = self.navigation_filter_combo.currentIndex()
+        idx = self.counter
+        while True:
+            if filter_index <= 0:
+                idx += step
+                if not 0 <= idx < self.num_images:
+                    return None
+            else:
+                # filter is 'unlabeled' (None) or one of labels
+                label = None if filter_index == 1 else self.navigation_filter_combo.currentText()
+                idx = self.label_index.find(idx, label, step)
+                if idx is None:
+                    return None
+            if not self.is_hidden_duplicate(idx):
+                return idx
+
+    def show_unlabeled_image(self, step):
+        """
+        shows the next (step=1) or previous (step=-1) unlabeled image, the search continues from the other end
+        """
+        idx = self.label_index.find(self.counter, None, step)
+        if idx is None:
+            idx = self.label_index.find(-1 if step > 0 else self.num_images, None, step)
+        if idx is None:
+            self.csv_generated_message.setText('All images are labeled')
+            return
+        if self.grid_view.isVisible():
+            self.grid_checkbox.setChecked(False)
+        self.show_image_at(idx)
+
+    @property
+    def label_index(self):
+        if self._label_index is None:
+            with self.perf.measure('label_index.build'):
+                self._label_index = LabelIndex(self.labels)
+                self._label_index.reset([self.assigned_labels.get(get_img_name(img_path, self.input_folder))
+                                         for img_path in self.img_paths])
+        return self._label_index
+
+    def update_class_counts(self):
+        """
+        updates panel with number of images of every label (counts are kept by the label index)
+        """
+        if not self.scan_finished and self._label_index is None:
+            # the index is built once all images are found
+            counts = self.label_store.count_by_label()
+            unlabeled = None
+        else:
+            counts = self.label_index.count_by_label()
+            unlabeled = self.label_index.count(None)
 
-    def set_image(self, path):
+        if self.multi_label:
+            # images can have several labels, so labels are counted by the store
+            counts = self.label_store.count_by_label()
+            labeled = len(self.label_store) if unlabeled is None else self.num_images - unlabeled
+        else:
+            labeled = sum(counts.values())
+        lines = [f'labeled {labeled} of {self.num_images}'
+                 + (f' ({labeled / self.num_images:.1%})' if self.num_images else '')]
+        if unlabeled is not None:
+            lines.append(f'unlabeled: {unlabeled}')
+        lines.extend(f'{label}: {count}' for label, count in counts.items())
+        self.class_counts.setText('\n'.join(lines))
+
+    def set_image(self, path, img_name):
         """
         displays the image in GUI
         :param path: relative path to the image that should be show
+        :param img_name: name of the image (see get_img_name)
+        """
+
+        with self.perf.measure('set_image'):
+            if self.tiled_checkbox.isChecked():
+                # scaled image from the prefetcher (if it's cached) is shown until tiles of the visible region
+                # are decoded, otherwise the view decodes its preview in background
+                self.tiled_view.set_image(path, self.prefetcher.cache.get(img_name))
+            else:
+                if self.full_resolution_checkbox.isChecked():
+                    pixmap = QPixmap.fromImage(image_reader(path).read())
+                else:
+                    # cache is keyed by image name, so the pixmap stays valid when the image is moved to a label
+                    # folder
+                    pixmap = self.prefetcher.get(img_name, path)
+                self.image_box.setPixmap(pixmap)
+                self.image_box.adjustSize()
+
+        if self.time_to_first_image is None:
+            # reported once the event loop runs, i.e. after the window with the image is painted
+            self.time_to_first_image = 0
+            QTimer.singleShot(0, self.report_first_image)
+        self.prefetch_neighbours()
+
+    def report_first_image(self):
         """
+        records and prints time to first image (since the application was launched and since the window was created)
+        """
+        now = time.perf_counter()
+        self.time_to_first_image = now - self.start_time
+        self.perf.record('startup.first_image', self.time_to_first_image)
+        print(f'first image shown {(now - LAUNCH_TIME) * 1000:.0f} ms after launch '
+              f'({self.time_to_first_image * 1000:.0f} ms after opening the window)')
+
+    def show_current_image(self):
+        path = self.get_image_path(self.counter)
+        filename = self.get_image_name(self.counter)
+
+        self.set_image(path, filename)
+        self.img_name_label.setText(path)
+        self.progress_bar.setText(f'image {self.counter + 1} of {self.num_images}')
+        self.set_button_color(filename)
+
+    def find_duplicates(self):
+        """
+        Computes perceptual hashes of all images in the background and groups near-duplicates
+        """
+        if self.duplicate_finder.running:
+            return
+        self.duplicates_status.setText('hashing images..')
+        self.duplicate_finder.start([(self.get_image_name(idx), self.get_image_path(idx))
+                                     for idx in range(self.num_images)])
+
+    def on_duplicates_progress(self, done, total):
+        self.duplicates_status.setText(f'hashing images.. {done} of {total}')
 
-        pixmap = QPixmap(path)
+    def on_duplicates_found(self, groups):
+        self.file_list_model.set_duplicate_groups(groups)
+        self.duplicates_status.setText(f'{len(groups)} groups of near-duplicates '
+                                       f'({sum(len(group) for group in groups)} images)')
+        self.select_file_list_row(self.counter)
 
-        # get original image dimensions
-        img_width = pixmap.width()
-        img_height = pixmap.height()
+    def on_duplicates_failed(self, error):
+        self.duplicates_status.setText(f'hashing images failed: {error}')
+
+    def duplicate_group_indices(self, idx):
+        """
+        :return: sorted indices of images in the duplicate group of the image (just the image if it's not in a group)
+        """
+        group = self.file_list_model.duplicate_group_of.get(self.get_image_name(idx))
+        if group is None:
+            return [idx]
+        indices = (self.file_list_model.index_of(img_name) for img_name in self.file_list_model.duplicate_groups[group])
+        return sorted(index for index in indices if index >= 0)
 
-        # scale the image properly so it fits into the image window ()
-        margin = 20
-        if img_width >= img_height:
-            pixmap = pixmap.scaledToWidth(self.img_panel_width - margin, Qt.SmoothTransformation)
+    def is_hidden_duplicate(self, idx):
+        """
+        :return: if the image is skipped by navigation (only first image of each duplicate group is shown
+        when duplicate groups are enabled)
+        """
+        if not self.group_duplicates_checkbox.isChecked():
+            return False
+        img_name = self.get_image_name(idx)
+        group = self.file_list_model.duplicate_group_of.get(img_name)
+        return group is not None and self.file_list_model.duplicate_groups[group][0] != img_name
 
+    def set_order(self, order):
+        """
+        Switches navigation order, the current image stays selected
+        :param order: 'name' or 'similarity' (features are computed in the background, images are reordered
+        when they are ready)
+        """
+        if order == 'similarity':
+            self.order_status.setText('computing image features..')
+            self.similarity_orderer.start([(self.get_image_name(idx), self.get_image_path(idx))
+                                           for idx in range(self.num_images)])
         else:
-            pixmap = pixmap.scaledToHeight(self.img_panel_height - margin, Qt.SmoothTransformation)
+            self.order_status.setText('')
+            self.reorder_images(sorted(self.img_paths))
+
+    def on_similarity_progress(self, done, total):
+        self.order_status.setText(f'computing image features.. {done} of {total}')
+
+    def on_similarity_order(self, img_names):
+        if self.order_combo.currentText() != 'similarity':
+            return
+        # images which couldn't be decoded or were found in the meantime go last
+        paths = {get_img_name(img_path, self.input_folder): img_path for img_path in self.img_paths}
+        ordered = [paths.pop(img_name) for img_name in img_names if img_name in paths]
+        ordered.extend(sorted(paths.values()))
+        self.reorder_images(ordered)
+        self.order_status.setText(f'{len(img_names)} images ordered by similarity')
+
+    def on_similarity_failed(self, error):
+        self.order_status.setText(f'computing image features failed: {error}')
+
+    def toggle_full_resolution(self):
+        self.full_resolution_checkbox.setChecked(not self.full_resolution_checkbox.isChecked())
+
+    def first_unlabeled_index(self):
+        """
+        :return: index of the first image without label (0 if all images are labeled)
+        """
+        for idx, img_path in enumerate(self.img_paths):
+            if get_img_name(img_path, self.input_folder) not in self.assigned_labels:
+                return idx
+        return 0
+
+    def get_image_name(self, idx):
+        return get_img_name(self.img_paths[idx], self.input_folder)
+
+    def get_image_path(self, idx):
+        """
+        :return: current location of the image (labeled images are in label folders in 'move' mode)
+        """
+        path = self.img_paths[idx]
+        filename = self.get_image_name(idx)
+
+        # In 'move' mode, labeled images are in label folders once the file operation is finished
+        if self.mode == 'move':
+            label = self.file_ops.location(filename)
+            if label is not None:
+                path = os.path.join(self.input_folder, label, filename)
+        # In 'deferred' mode, they are there once they are committed (by moving)
+        elif self.materializer is not None and self.materializer.mode == 'move':
+            label = self.materializer.placement(filename)
+            if label is not None:
+                path = os.path.join(self.input_folder, label, filename)
+        return path
+
+    def prefetch_neighbours(self):
+        """
+        schedules background decoding of next and previous images (next ones first)
+        """
+        items = []
+        for offset in range(1, self.prefetch_count + 1):
+            for idx in (self.counter + offset, self.counter - offset):
+                if 0 <= idx < self.num_images:
+                    items.append((self.get_image_name(idx), self.get_image_path(idx)))
+        self.prefetcher.prefetch(items)
+
+    @property
+    def cache_hits(self):
+        return self.prefetcher.cache.hits
 
-        self.image_box.setPixmap(pixmap)
+    @property
+    def cache_misses(self):
+        return self.prefetcher.cache.misses
 
     def generate_csv(self, out_filename):
         """
@@ -603,62 +3472,128 @@ class LabelerWindow(QWidget):
         Assigned label is represented as one-hot vector.
         :param out_filename: name of csv file to be generated
         """
-        path_to_save = os.path.join(self.input_folder, 'output')
-        make_folder(path_to_save)
-        csv_file_path = os.path.join(path_to_save, out_filename) + '.csv'
-
-        with open(csv_file_path, "w", newline='') as csv_file:
-            writer = csv.writer(csv_file, delimiter=',')
-
-            # write header
-            writer.writerow(['img'] + self.labels)
+        make_folder(self.output_folder)
+        csv_file_path = os.path.join(self.output_folder, out_filename) + '.csv'
 
-            # write one-hot labels
-            for img_name, label in self.assigned_labels.items():
-                labels_one_hot = self.labels_to_zero_one(label)
-                writer.writerow([img_name] + list(labels_one_hot))
+        with self.perf.measure('export.csv'):
+            self.label_store.export_csv(csv_file_path)
 
         message = f'csv saved to: {csv_file_path}'
         self.csv_generated_message.setText(message)
+        self.csv_generated_message.setStyleSheet('color: #43A047')
         print(message)
 
         if self.generate_xlsx_checkbox.isChecked():
             try:
                 self.csv_to_xlsx(csv_file_path)
-            except:
-                print('Generating xlsx file failed.')
+            except Exception as e:
+                message = f'Generating xlsx file failed: {e}'
+                self.csv_generated_message.setText(message)
+                self.csv_generated_message.setStyleSheet('color: red')
+                print(message)
+
+        if self.generate_npz_checkbox.isChecked():
+            with self.perf.measure('export.npz'):
+                self.label_store.export_npz(csv_file_path[:-4] + '.npz')
 
     def csv_to_xlsx(self, csv_file_path):
         """
-        converts csv file to xlsx file
-        :param csv_file_path: path to csv file which we want to convert to xlsx
+        generates xlsx file next to the csv file (written directly from assigned labels, the csv is not read)
+        :param csv_file_path: path to csv file, the xlsx file gets the same name
         """
-        workbook = Workbook(csv_file_path[:-4] + '.xlsx')
-        worksheet = workbook.add_worksheet()
+        with self.perf.measure('export.xlsx'):
+            self.label_store.export_xlsx(csv_file_path[:-4] + '.xlsx')
 
-        with open(csv_file_path, 'rt', encoding='utf8') as f:
-            reader = csv.reader(f)
-            for r, row in enumerate(reader):
-                for c, col in enumerate(row):
-                    worksheet.write(r, c, col)
+    def update_file_ops_status(self, num_pending, num_failed):
+        """
+        shows number of pending and failed file operations
+        """
+        message = f'file operations: {num_pending} pending'
 
-        workbook.close()
+        # progress of the current batch of operations (since the queue was empty last time)
+        if num_pending == 0:
+            self._file_ops_batch_size = 0
+            self.file_ops_progress.hide()
+        else:
+            self._file_ops_batch_size = max(self._file_ops_batch_size, num_pending)
+            if self._file_ops_batch_size > 1:
+                self.file_ops_progress.setRange(0, self._file_ops_batch_size)
+                self.file_ops_progress.setValue(self._file_ops_batch_size - num_pending)
+                self.file_ops_progress.show()
+
+        if num_failed:
+            message += f', {num_failed} failed (see console)'
+            self.file_ops_status.setStyleSheet('color: red')
+        self.file_ops_status.setText(message)
+
+    def commit_labels(self):
+        """
+        Places labeled images into label folders in background ('deferred' mode). Only images whose label
+        changed since the last commit are touched.
+        """
+        if self.commit_worker is not None:
+            return
+
+        self.materializer.set_mode(self.commit_mode_combo.currentText())
+        self.commit_mode_combo.setEnabled(False)
+        self.commit_button.setEnabled(False)
+        self.file_ops_progress.setValue(0)
+        self.file_ops_progress.show()
+
+        self.commit_worker = CommitWorker(self.materializer,
+                                          self.label_store.items() if self.multi_label else self.assigned_labels, self)
+        self.commit_worker.progress.connect(self.on_commit_progress)
+        self.commit_worker.finished.connect(self.on_commit_finished)
+        self.commit_worker.start()
+
+    def on_commit_progress(self, done, total):
+        self.file_ops_progress.setRange(0, max(total, 1))
+        self.file_ops_progress.setValue(done)
+        self.file_ops_status.setText(f'commit: {done} of {total} images placed')
+
+    def on_commit_finished(self, failed):
+        self.commit_worker = None
+        self.commit_button.setEnabled(True)
+        self.file_ops_progress.hide()
+        if failed:
+            self.file_ops_status.setStyleSheet('color: red')
+            self.file_ops_status.setText(f'commit: {len(failed)} images failed (see console)')
+            for img_name, label, error in failed:
+                print(f'Failed to place {img_name} into {label or self.input_folder}: {error}')
+        else:
+            self.file_ops_status.setStyleSheet('')
+            self.file_ops_status.setText('commit: all labels are placed in label folders')
 
     def set_button_color(self, filename):
         """
         update colors
         """
 
-        if filename in self.assigned_labels:
-            assigned_label = self.assigned_labels[filename]
+        with self.perf.measure('set_button_color'):
+            if self.multi_label:
+                assigned = set(self.label_store.get(filename))
+            else:
+                assigned = {self.assigned_labels.get(filename)}
+
+            for button in self.label_buttons:
+                if button.text() in assigned:
+                    button.setStyleSheet('border: 1px solid #43A047; background-color: #4CAF50; color: white')
+                else:
+                    button.setStyleSheet('background-color: None')
+
+    def toggle_perf_overlay(self):
+        if self.perf_overlay.isVisible():
+            self.perf_overlay_timer.stop()
+            self.perf_overlay.hide()
         else:
-            assigned_label = None
+            self.update_perf_overlay()
+            self.perf_overlay_shown = True
+            self.perf_overlay.show()
+            self.perf_overlay.raise_()
+            self.perf_overlay_timer.start(500)
 
-        for button in self.label_buttons:
-            if button.text() == assigned_label:
-                button.setStyleSheet('border: 1px solid #43A047; background-color: #4CAF50; color: white')
-            else:
-                button.setStyleSheet('background-color: None')
+    def update_perf_overlay(self):
+        self.perf_overlay.setText(self.perf.report())
 
     def closeEvent(self, event):
         """
@@ -666,17 +3601,34 @@ class LabelerWindow(QWidget):
         It automatically generates csv file in case the user forgot to do that
         """
         print("closing the App..")
+        self.journal_timer.stop()
+        self.label_store.close()
+        self.prefetcher.shutdown()
+        self.tiled_view.shutdown()
+        self.thumbnails.shutdown()
+        self.duplicate_finder.shutdown()
+        self.similarity_orderer.shutdown()
+        self.folder_watcher.stop()
+        if self.commit_worker is not None:
+            print('waiting for commit to finish..')
+            self.commit_worker.wait()
+        if self.materializer is not None:
+            self.materializer.close()
+        if self.file_ops is not None:
+            print(f'waiting for {self.file_ops.num_pending} file operations..')
+            self.file_ops.drain()
+            for img_name, label, error in self.file_ops.failed:
+                print(f'Failed to place {img_name} into {label or self.input_folder}: {error}')
         self.generate_csv('assigned_classes_automatically_generated')
+        if self.perf.tracing or self.perf_overlay_shown:
+            print(self.perf.report())
+        self.perf.close()
 
     def labels_to_zero_one(self, label):
         """
         change the label to one-hot vector
         """
-        label_to_int = dict((c, i) for i, c in enumerate(self.labels))
-        zero_one_arr = np.zeros([self.num_labels], dtype=int)
-        if label in label_to_int:
-            zero_one_arr[label_to_int[label]] = 1
-        return zero_one_arr
+        return self.label_store.labels_to_zero_one(label)
 
     @staticmethod
     def create_label_folders(labels, folder):
@@ -687,55 +3639,223 @@ class LabelerWindow(QWidget):
         """
         populate file list
         """
-        for idx, img_path in enumerate(self.img_paths):
-            img_name = os.path.split(img_path)[-1]
-            item = QListWidgetItem(img_name)
-            self.file_list_widget.addItem(item)
-            self.update_file_list_item(idx)
+        self._label_index = None
+        self.file_list_model.reset(self.img_paths, self.assigned_labels)
+        self.select_file_list_row(self.counter)
 
-        self.file_list_widget.setCurrentRow(self.counter)
+    def select_file_list_row(self, row):
+        index = self.file_list_model.index(row)
+        self.file_list_view.setCurrentIndex(index)
+        self.file_list_view.scrollTo(index)
 
-    def update_file_list_item(self, idx):
+        # whole duplicate group is selected, so the label key labels all of its images
+        if self.group_duplicates_checkbox.isChecked() and 0 <= row < self.num_images:
+            self.select_file_list_indices(self.duplicate_group_indices(row))
+
+    def shard_batches(self, batches):
+        """
+        Filters batches of the scanner to images of the shard of this annotator.
+        With 'range' strategy the whole tree has to be listed first, because blocks are taken from the sorted list.
+        """
+        if self.shard.strategy == 'range':
+            img_paths = sorted(path for batch in batches for path in batch)
+            selected = self.shard.select([get_img_name(path, self.input_folder) for path in img_paths])
+            img_paths = [path for path, is_selected in zip(img_paths, selected) if is_selected]
+            if img_paths:
+                yield img_paths
+            return
+
+        for batch in batches:
+            batch = [path for path in batch if self.shard.contains(get_img_name(path, self.input_folder))]
+            if batch:
+                yield batch
+
+    def reconstruct_session(self, extensions, recursive, ignore):
+        """
+        Lists label folders of previous sessions (in parallel, with os.scandir) and reconciles the images found
+        there and the csv generated when the last session was closed with the journal. Labels missing in
+        the journal are restored, so the session is complete even if the journal was lost.
+        :return: (dict image name -> label folder of images found in label folders, list of conflicts
+        (image name, label, label folder) of images which are in a folder of another label)
+        """
+        label_folders = [label for label in self.labels if os.path.isdir(os.path.join(self.input_folder, label))]
+        locations = {}
+        folder_labels = []
+        if label_folders:
+            with self.perf.measure('startup.scan_label_folders'):
+                # listings of label folders are cached like the listing of the input folder
+                scanner = ImageScanner(self.input_folder, extensions, recursive, ignore,
+                                       index_path=os.path.join(self.input_folder, 'output', 'label_scan_index.json'),
+                                       archives=False)
+                for batch in scanner.scan(label_folders):
+                    for path in batch:
+                        label, _, img_name = get_img_name(path, self.input_folder).partition(os.sep)
+                        folder_labels.append((img_name, label))
+                        locations[img_name] = label
+
+        csv_file_path = os.path.join(self.output_folder, 'assigned_classes_automatically_generated.csv')
+        csv_labels = read_labels_csv(csv_file_path) if os.path.exists(csv_file_path) else ()
+        with self.perf.measure('startup.reconcile'):
+            from_folders, from_csv, conflicts = self.label_store.reconcile(folder_labels, csv_labels)
+
+        if from_folders or from_csv:
+            print(f'Restored labels of {from_folders} images from label folders and of {from_csv} images '
+                  f'from {csv_file_path}')
+        if conflicts:
+            print(f'{len(conflicts)} images are in other label folders than their labels, labels from the journal '
+                  f'are kept (e.g. {conflicts[0][0]} is labeled {conflicts[0][1]}, found in {conflicts[0][2]})')
+        return locations, conflicts
+
+    @staticmethod
+    def restored_batches(batches, img_paths):
+        """
+        Adds images found in label folders after the first batch of the scanner, so the first batch still
+        contains unlabeled images to start with
         """
-        update file list item
+        first_batch = next(batches, None)
+        if first_batch is not None:
+            yield first_batch
+        if img_paths:
+            yield img_paths
+        yield from batches
+
+    def add_image_paths(self, img_paths):
         """
-        item = self.file_list_widget.item(idx)
-        img_path = self.img_paths[idx]
-        img_name = os.path.split(img_path)[-1]
+        adds images found by the scanner after the window was opened
+        """
+        self.file_list_model.append(img_paths)
+        if self._label_index is not None:
+            self._label_index.append([self.assigned_labels.get(get_img_name(img_path, self.input_folder))
+                                      for img_path in img_paths])
+        self.num_images = len(self.img_paths)
+        self.progress_bar.setText(f'image {self.counter + 1} of {self.num_images} (scanning..)')
 
-        if img_name in self.assigned_labels:
-            # labeled
-            label = self.assigned_labels[img_name]
-            color = self.label_colors.get(label, Qt.white)
-            item.setForeground(color)
+    def on_scan_finished(self):
+        """
+        Folders are scanned in parallel, so images are sorted once the whole tree is listed.
+        The current image stays selected.
+        """
+        if self.order_combo.currentText() == 'similarity':
+            # only features of newly found images are computed
+            self.set_order('similarity')
         else:
-            # unlabeled
-            item.setForeground(Qt.white)
+            self.reorder_images(sorted(self.img_paths))
+        self.progress_bar.setText(f'image {self.counter + 1} of {self.num_images}')
+
+        self.scan_finished = True
+        self.set_watching(self.watch_checkbox.isChecked())
+        self.update_class_counts()
 
-    def on_file_item_clicked(self, item):
+    def set_watching(self, enabled):
         """
-        When clicking on an item in the file list, the corresponding image is displayed
+        starts or stops watching of the folder (it starts after the whole tree is listed)
         """
-        img_name = item.text()
-        img_path = os.path.join(self.input_folder, img_name)
-        if not os.path.exists(img_path):
-            if img_name in self.assigned_labels:
-                label = self.assigned_labels[img_name]
-                img_path = os.path.join(self.input_folder, label, img_name)
-            else:
+        if enabled and self.scan_finished:
+            self.folder_watcher.start()
+        else:
+            self.folder_watcher.stop()
+
+    def image_exists(self, idx):
+        """
+        :return: if the image is still on disk (in the input folder or in the folder of its label)
+        """
+        if image_sources.exists(self.img_paths[idx]) or os.path.exists(self.get_image_path(idx)):
+            return True
+        label = self.assigned_labels.get(self.get_image_name(idx))
+        return label is not None and os.path.exists(os.path.join(self.input_folder, label, self.get_image_name(idx)))
+
+    def on_folder_changed(self, added, removed):
+        """
+        Adds images created and removes images deleted outside the tool. The navigator is updated
+        incrementally (new images are inserted at their sorted positions), labels of removed images
+        stay in the journal.
+        :param added: paths of new images
+        :param removed: paths of removed images
+        """
+        with self.perf.measure('folder_watcher.update'):
+            # images moved by the tool into label folders and back are not removed nor added
+            added = [path for path in added if self.file_list_model.index_of(get_img_name(path, self.input_folder)) < 0]
+            if self.shard is not None:
+                # new images are assigned to shards by hash of their names also with 'range' strategy
+                added = [path for path in added if self.shard.contains(get_img_name(path, self.input_folder))]
+            removed_indices = [self.file_list_model.index_of(get_img_name(path, self.input_folder)) for path in removed]
+            removed_indices = sorted(idx for idx in removed_indices if idx >= 0 and not self.image_exists(idx))
+            if not added and not removed_indices:
                 return
 
-        self.counter = self.img_paths.index(os.path.join(self.input_folder, img_name))
+            current_removed = self.counter in removed_indices
+            if removed_indices:
+                self.counter -= bisect.bisect_left(removed_indices, self.counter)
+                self.file_list_model.remove(removed_indices)
+                if self._label_index is not None:
+                    self._label_index.remove(removed_indices)
+            if added:
+                added.sort()
+                added_labels = [self.assigned_labels.get(get_img_name(path, self.input_folder)) for path in added]
+                if self.order_combo.currentText() == 'name':
+                    positions = self.file_list_model.insert_sorted(added)
+                    self.counter += sum(position <= self.counter for position in positions)
+                    if self._label_index is not None:
+                        self._label_index.insert(positions, added_labels)
+                else:
+                    # in similarity order new images go last until the order is computed again
+                    self.file_list_model.append(added)
+                    if self._label_index is not None:
+                        self._label_index.append(added_labels)
+            self.num_images = len(self.img_paths)
+            self.counter = max(0, min(self.counter, self.num_images - 1))
+
+        if self.grid_view.isVisible():
+            self.grid_model.set_page_start(self.grid_model.page_start)
+        if self.num_images:
+            if current_removed:
+                self.show_current_image()
+            self.select_file_list_row(self.counter)
+            self.progress_bar.setText(f'image {self.counter + 1} of {self.num_images}')
+        self.csv_generated_message.setText(f'folder changed: {len(added)} images added, '
+                                           f'{len(removed_indices)} images removed')
+        self.update_class_counts()
+
+    def reorder_images(self, img_paths):
+        """
+        Changes order of images (the current image stays selected)
+        :param img_paths: the same paths as self.img_paths in new order
+        """
+        current_path = self.img_paths[self.counter] if self.img_paths else None
+        if img_paths != self.img_paths:
+            self.img_paths[:] = img_paths
+            self.populate_file_list()
+            self.grid_model.set_page_start(self.grid_model.page_start)
+            if current_path is not None:
+                self.counter = self.file_list_model.index_of(get_img_name(current_path, self.input_folder))
+                self.select_file_list_row(self.counter)
+
+    def update_file_list_item(self, idx):
+        """
+        update file list item (its color is computed by the model from assigned labels)
+        """
+        with self.perf.measure('update_file_list_item'):
+            self.file_list_model.refresh_row(idx)
+
+    def on_file_item_clicked(self, index):
+        """
+        When clicking on an item in the file list, the corresponding image is displayed
+        """
+        self.counter = index.row()
+        img_name = self.get_image_name(self.counter)
+        img_path = self.get_image_path(self.counter)
 
-        self.set_image(img_path)
+        self.set_image(img_path, img_name)
         self.img_name_label.setText(img_path)
         self.progress_bar.setText(f'image {self.counter + 1} of {self.num_images}')
         self.set_button_color(img_name)
         self.csv_generated_message.setText('')
+        if self.group_duplicates_checkbox.isChecked():
+            self.select_file_list_indices(self.duplicate_group_indices(self.counter))
 
     def keyPressEvent(self, event):
         """
-        Handle keyboard events and make sure shortcuts are still valid when focus is on a QListWidget
+        Handle keyboard events and make sure shortcuts are still valid when focus is on a QListView
         """
         if event.key() == Qt.Key_Left:
             self.show_prev_image()
@@ -745,9 +3865,99 @@ class LabelerWindow(QWidget):
             super().keyPressEvent(event)
 
 
+def parse_args(argv=None):
+    """
+    Parses command line. Options can be also given in JSON config file (--config), command line options win.
+    """
+    parser = argparse.ArgumentParser(description='Annotation tool for assigning image classes. If folder is given, '
+                                                 'labeling starts right away, otherwise the setup window is shown.')
+    parser.add_argument('folder', nargs='?', help='folder with images to label')
+    parser.add_argument('--config', help='JSON file with options, e.g. {"labels": "labels.txt", "mode": "csv"}')
+    parser.add_argument('--labels', help='text file with labels, one on each line (default: labels of the session)')
+    parser.add_argument('--mode', choices=['csv', 'copy', 'move', 'link', 'deferred'],
+                        help='how labeled images are placed (default: mode of the saved session or move)')
+    parser.add_argument('--multi-label', action='store_true',
+                        help='images can have any number of labels (default: kind of the saved session)')
+    parser.add_argument('--annotator', help='name of the annotator in a sharded session')
+    parser.add_argument('--shard', help='shard of the annotator, e.g. 2/3')
+    parser.add_argument('--shard-strategy', choices=['hash', 'range'], default='hash')
+    parser.add_argument('--overlap', type=int, default=0, help='percent of images shown to all annotators')
+    parser.add_argument('--extensions', nargs='+', default=['.jpg', '.png', '.jpeg'])
+    parser.add_argument('--no-recursive', dest='recursive', action='store_false',
+                        help="don't label images in subfolders")
+    parser.add_argument('--no-archives', dest='archives', action='store_false',
+                        help="don't label images in tar and zip archives")
+    parser.add_argument('--ignore', nargs='+', default=[], help='glob patterns of files and folders to skip')
+    parser.add_argument('--prefetch', type=int, default=4, help='number of images decoded ahead in each direction')
+    parser.add_argument('--cache-mb', type=int, default=256, help='size of the cache of decoded images')
+    parser.add_argument('--duplicate-distance', type=int, default=4,
+                        help='maximal number of different bits of perceptual hashes of near-duplicates')
+    parser.add_argument('--watch', action='store_true', help='watch the folder for new and deleted images')
+    parser.add_argument('--trace', help='JSON-lines file for timings of hot paths')
+
+    args, _ = parser.parse_known_args(argv)
+    if args.config:
+        with open(args.config, encoding='utf8') as f:
+            config = {key.replace('-', '_'): value for key, value in json.load(f).items()}
+        unknown = set(config) - set(vars(args))
+        if unknown:
+            parser.error(f"unknown options in {args.config}: {', '.join(sorted(unknown))}")
+        parser.set_defaults(**config)
+    args = parser.parse_args(argv)
+    if args.folder is None:
+        return args
+
+    output_folder = (annotator_folder(args.folder, args.annotator) if args.annotator
+                     else os.path.join(args.folder, 'output'))
+    if args.mode is None:
+        args.mode = LabelStore.load_session_mode(output_folder) or 'move'
+
+    if args.shard:
+        try:
+            index, count = (int(part) for part in args.shard.split('/'))
+            args.shard = ShardSpec(index - 1, count, args.shard_strategy, args.overlap / 100)
+        except ValueError:
+            parser.error('--shard has to be in format "index/count", e.g. 1/3')
+        if not args.annotator:
+            parser.error('--annotator is required for sharded session')
+        if args.shard.overlap and args.mode not in ('csv', 'deferred'):
+            parser.error('images shared by annotators can be labeled only in csv or deferred mode')
+    # kind of the session is taken from the saved session, it can't change
+    saved_multi_label = LabelStore.load_session_multi_label(os.path.join(args.folder, 'output'))
+    if saved_multi_label:
+        args.multi_label = True
+    elif saved_multi_label is False and args.multi_label:
+        parser.error(f'{args.folder} has a single-label session, it can\'t be opened with --multi-label')
+    if args.multi_label and (args.mode not in ('csv', 'deferred') or args.annotator):
+        parser.error('multi-label session can be labeled only in csv or deferred mode and without annotators')
+
+    if args.labels:
+        args.labels = read_labels_file(args.labels)
+    else:
+        args.labels = LabelStore.load_session_labels(output_folder)
+        if not args.labels:
+            parser.error(f'--labels is required, {args.folder} has no saved session')
+    return args
+
+
+def main(argv=None):
+    # Qt removes its own options (e.g. -platform) from the arguments
+    app = QApplication(sys.argv if argv is None else [sys.argv[0]] + argv)
+    args = parse_args(app.arguments()[1:])
+
+    if args.folder is None:
+        window = SetupWindow()
+        window.show()
+    else:
+        window = LabelerWindow(args.labels, args.folder, args.mode, args.prefetch, args.cache_mb,
+                               tuple(args.extensions), args.recursive, args.ignore, args.trace, args.annotator,
+                               args.shard or None, args.duplicate_distance, args.watch, args.multi_label,
+                               args.archives)
+        # show window in full-screen mode (window is maximized)
+        window.showMaximized()
+    return app.exec_()
+
+
 if __name__ == '__main__':
     # run the application
-    app = QApplication(sys.argv)
-    ex = SetupWindow()
-    ex.show()
-    sys.exit(app.exec_())
+    sys.exit(main())
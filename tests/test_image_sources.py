@@ -0,0 +1,78 @@
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+import image_sources
+
+
+@pytest.fixture(autouse=True)
+def index_folder(tmp_path):
+    image_sources.set_index_folder(str(tmp_path / 'archive_index'))
+    yield
+    image_sources.set_index_folder(None)
+
+
+def write_zip(path, members):
+    with zipfile.ZipFile(path, 'w') as archive:
+        for name, data in members.items():
+            archive.writestr(name, data, zipfile.ZIP_DEFLATED if name.endswith('.png') else zipfile.ZIP_STORED)
+
+
+def write_tar(path, members):
+    with tarfile.open(path, 'w') as archive:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+
+
+@pytest.mark.parametrize('extension', ['.zip', '.tar'])
+def test_read_members(tmp_path, extension):
+    path = str(tmp_path / ('shard' + extension))
+    members = {'a.jpg': b'jpeg data', 'sub/b.png': b'png data' * 100, 'notes.txt': b'text'}
+    (write_zip if extension == '.zip' else write_tar)(path, members)
+
+    assert image_sources.member_paths(path, ('.jpg', '.png')) == [os.path.join(path, 'a.jpg'),
+                                                                  os.path.join(path, 'sub', 'b.png')]
+    for name, data in members.items():
+        member_path = os.path.join(path, *name.split('/'))
+        assert image_sources.split_member_path(member_path) == (path, name)
+        assert image_sources.read_member(member_path) == data
+        assert image_sources.exists(member_path)
+    assert not image_sources.exists(os.path.join(path, 'missing.jpg'))
+    assert image_sources.read_member(str(tmp_path / 'a.jpg')) is None
+
+
+def test_unsafe_member_names(tmp_path):
+    path = str(tmp_path / 'shard.zip')
+    write_zip(path, {'../evil.jpg': b'x', '/abs.jpg': b'x', 'ok/./a.jpg': b'x', 'c:/win.jpg': b'x'})
+    assert image_sources.member_paths(path, ('.jpg',)) == [os.path.join(path, 'ok', 'a.jpg')]
+
+    label_folder = str(tmp_path / 'cat')
+    image_sources.extract(os.path.join(path, 'ok', 'a.jpg'), os.path.join(label_folder, 'shard.zip', 'ok', 'a.jpg'),
+                          label_folder)
+    with pytest.raises(OSError):
+        image_sources.extract(os.path.join(path, 'ok', 'a.jpg'), str(tmp_path / 'evil.jpg'), label_folder)
+
+
+def test_rewritten_archive(tmp_path):
+    path = str(tmp_path / 'shard.zip')
+    write_zip(path, {'a.jpg': b'first'})
+    first = image_sources.open_archive(path)
+    assert not image_sources.archive_changed(path)
+
+    write_zip(path, {'a.jpg': b'second version', 'b.jpg': b'new'})
+    os.utime(path, ns=(first.stamp[0] + 10 ** 9, first.stamp[0] + 10 ** 9))
+    assert image_sources.archive_changed(path)
+    # images are listed again when the archive changes, the old version is closed once it's replaced
+    assert len(image_sources.member_paths(path, ('.jpg',))) == 2
+    assert first.closed
+    assert image_sources.read_member(os.path.join(path, 'a.jpg')) == b'second version'
+
+    # the index is read from the cache instead of the archive
+    image_sources._archives.clear()
+    archive = image_sources.ImageArchive(path)
+    assert archive.load_index() == archive.members
@@ -0,0 +1,301 @@
+import json
+import os
+import random
+
+import numpy as np
+import pytest
+
+from label_store import (LabelIndex, LabelStore, Materializer, MultiLabelStore, ShardSpec, annotator_folder,
+                         main, merge_annotators, open_label_store, read_labels_csv)
+
+
+def make_images(folder, img_names):
+    for img_name in img_names:
+        path = os.path.join(folder, img_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(img_name.encode('utf8'))
+
+
+def test_journal_replay(tmp_path):
+    store = LabelStore.open(str(tmp_path), ['zebra', 'cat', 'dog'])
+    store.set_label('a.jpg', 'dog')
+    store.set_labels(['b.jpg', 'c, "quoted".jpg'], 'cat')
+    store.set_label('b.jpg', 'zebra')
+    store.set_label('d.jpg', 'cat')
+    store.set_label('d.jpg', None)
+    store.close()
+
+    store = LabelStore.open(str(tmp_path))
+    assert store.labels == ['zebra', 'cat', 'dog']
+    assert store.assigned_labels == {'a.jpg': 'dog', 'b.jpg': 'zebra', 'c, "quoted".jpg': 'cat'}
+    store.close()
+
+
+def test_journal_compaction(tmp_path):
+    store = LabelStore.open(str(tmp_path), ['a', 'b'])
+    store.journal.compact_min_records = 5
+    for i in range(50):
+        store.set_label(f'{i % 3}.jpg', 'ab'[i % 2])
+    expected = dict(store.assigned_labels)
+    store.close()
+
+    # the journal was compacted while labeling, labels stay the same
+    store = LabelStore.open(str(tmp_path))
+    assert store.assigned_labels == expected
+    assert store.journal.num_records < 10
+    store.close()
+
+
+def test_export_csv_round_trip(tmp_path):
+    store = LabelStore.open(str(tmp_path), ['zebra', 'cat', 'dog'])
+    labels = {'a.jpg': 'dog', 'b,c.jpg': 'cat', 'sub/d.jpg': 'dog'}
+    for img_name, label in labels.items():
+        store.set_label(img_name, label)
+    csv_path = str(tmp_path / 'labels.csv')
+    store.export_csv(csv_path)
+    store.close()
+
+    with open(csv_path) as f:
+        assert f.readline().strip() == 'img,zebra,cat,dog'
+    assert dict(read_labels_csv(csv_path)) == labels
+
+
+def test_export_npz(tmp_path):
+    store = LabelStore(['a', 'b'])
+    store.set_labels(['x.jpg', 'y.jpg'], 'b')
+    store.set_label('z.jpg', 'a')
+    npz_path = str(tmp_path / 'labels.npz')
+    store.export_npz(npz_path)
+
+    with np.load(npz_path) as data:
+        labels = {img_name: data['labels'][code] for img_name, code in zip(data['img'], data['codes'])}
+        assert labels == {'x.jpg': 'b', 'y.jpg': 'b', 'z.jpg': 'a'}
+        assert data['one_hot'].sum(axis=0).tolist() == [1, 2]
+
+
+def test_read_only_keeps_session_labels(tmp_path):
+    store = LabelStore.open(str(tmp_path), ['zebra', 'cat', 'dog'])
+    store.set_label('a.jpg', 'dog')
+    store.set_label('b.jpg', 'cat')
+    store.close()
+
+    store = open_label_store(str(tmp_path), read_only=True)
+    assert store.labels == ['zebra', 'cat', 'dog']
+    assert store.count_by_label() == {'zebra': 0, 'cat': 1, 'dog': 1}
+    csv_path = str(tmp_path / 'export.csv')
+    store.export_csv(csv_path)
+    with open(csv_path) as f:
+        assert f.readline().strip() == 'img,zebra,cat,dog'
+
+
+def test_read_only_with_open_writer(tmp_path):
+    writer = LabelStore.open(str(tmp_path), ['a', 'b'], read_only=False)
+    writer.set_label('x.jpg', 'a')
+    writer.sync()
+    journal_path = tmp_path / 'output' / 'labels.journal'
+    size = journal_path.stat().st_size
+
+    # queries don't need the lock of the writer and don't change the journal or the session
+    reader = LabelStore.open(str(tmp_path), read_only=True)
+    assert reader.assigned_labels == {'x.jpg': 'a'}
+    reader.close()
+    assert journal_path.stat().st_size == size
+
+    # another writer is refused
+    with pytest.raises(ValueError):
+        LabelStore.open(str(tmp_path), ['a', 'b'])
+    writer.close()
+    LabelStore.open(str(tmp_path), ['a', 'b']).close()
+
+
+def test_read_only_missing_session(tmp_path):
+    store = LabelStore.open(str(tmp_path), read_only=True)
+    assert store.labels == [] and store.assigned_labels == {}
+    assert not os.path.exists(tmp_path / 'output')
+
+
+def test_session_mode(tmp_path):
+    output_folder = str(tmp_path / 'output')
+    store = LabelStore.open(str(tmp_path), ['a'])
+    assert LabelStore.load_session_mode(output_folder) is None
+    store.mode = 'csv'
+    store.save_session()
+    store.close()
+
+    # the mode is kept when the session is saved by other tools (e.g. merge)
+    LabelStore.open(str(tmp_path), ['a', 'b']).close()
+    assert LabelStore.load_session_mode(output_folder) == 'csv'
+
+
+def test_multi_label_round_trip(tmp_path):
+    store = MultiLabelStore.open(str(tmp_path), ['red', 'round', 'small'])
+    store.set_labels(['a.jpg', 'b.jpg', 'c.jpg'], 'red')
+    store.set_label('a.jpg', 'round')
+    store.toggle(['b.jpg'], 'red')
+    store.set_label('c.jpg', 'small')
+    store.close()
+
+    store = open_label_store(str(tmp_path), read_only=True)
+    assert isinstance(store, MultiLabelStore)
+    assert store.labels == ['red', 'round', 'small']
+    assert sorted(store.items()) == [('a.jpg', 'red'), ('a.jpg', 'round'), ('c.jpg', 'red'), ('c.jpg', 'small')]
+    assert not store.get('b.jpg')
+
+    csv_path = str(tmp_path / 'labels.csv')
+    store.export_csv(csv_path)
+    assert sorted(read_labels_csv(csv_path)) == sorted(store.items())
+    npz_path = str(tmp_path / 'labels.npz')
+    store.export_npz(npz_path)
+    with np.load(npz_path) as data:
+        assert data['img'].tolist() == ['a.jpg', 'c.jpg']
+        assert data['multi_hot'].tolist() == [[1, 1, 0], [1, 0, 1]]
+        assert (np.unpackbits(data['packed'], axis=1)[:, :3] == data['multi_hot']).all()
+
+
+def test_multi_label_many_images(tmp_path):
+    store = MultiLabelStore([f'l{i}' for i in range(20)], str(tmp_path / 'output'), capacity=4)
+    rng = random.Random(0)
+    expected = {}
+    for i in range(5000):
+        img_name = f'{rng.randrange(3000):05d}.jpg'
+        label = f'l{rng.randrange(20)}'
+        store.set_label(img_name, label)
+        expected.setdefault(img_name, set()).add(label)
+    store.close()
+
+    store = MultiLabelStore([], str(tmp_path / 'output'), read_only=True)
+    items = {}
+    for img_name, label in store.items():
+        items.setdefault(img_name, set()).add(label)
+    assert items == expected
+    assert store.find_row('missing.jpg') is None
+
+
+def test_label_index_matches_labels():
+    labels = ['a', 'b', 'c']
+    rng = random.Random(1)
+    index = LabelIndex(labels, block_size=4)
+    expected = []
+    for _ in range(500):
+        operation = rng.random()
+        if operation < 0.3:
+            new = [rng.choice(labels + [None]) for _ in range(rng.randint(1, 6))]
+            index.append(new)
+            expected.extend(new)
+        elif operation < 0.55:
+            position = rng.randint(0, len(expected))
+            label = rng.choice(labels + [None])
+            index.insert([position], [label])
+            expected.insert(position, label)
+        elif operation < 0.75 and expected:
+            positions = rng.sample(range(len(expected)), min(3, len(expected)))
+            index.remove(positions)
+            expected = [label for i, label in enumerate(expected) if i not in positions]
+        elif expected:
+            position = rng.randrange(len(expected))
+            label = rng.choice(labels + [None])
+            index.set([position], label)
+            expected[position] = label
+
+        for label in labels + [None]:
+            assert index.count(label) == expected.count(label)
+        position = rng.randint(-1, len(expected))
+        label = rng.choice(labels + [None])
+        after = [i for i in range(position + 1, len(expected)) if expected[i] == label]
+        before = [i for i in range(min(position, len(expected))) if expected[i] == label]
+        assert index.find(position, label) == (after[0] if after else None)
+        assert index.find(position, label, step=-1) == (before[-1] if before else None)
+
+
+@pytest.mark.parametrize('mode', ['move', 'copy', 'link'])
+def test_parallel_commit(tmp_path, mode):
+    labels = [f'label_{i}' for i in range(20)]
+    img_names = [f'img_{i:03d}.jpg' for i in range(40)] + ['sub/img_040.jpg']
+    make_images(str(tmp_path), img_names)
+    assigned = {img_name: labels[i % len(labels)] for i, img_name in enumerate(img_names)}
+
+    materializer = Materializer(str(tmp_path), labels, mode, num_threads=16)
+    assert materializer.commit(assigned) == []
+    for img_name, label in assigned.items():
+        assert os.path.exists(tmp_path / label / img_name)
+        assert os.path.exists(tmp_path / img_name) == (mode != 'move')
+
+    # nothing to do the second time, changed labels are moved between label folders
+    assert materializer.pending(assigned) == []
+    assigned['img_000.jpg'] = 'label_1'
+    del assigned['img_001.jpg']
+    assert materializer.commit(assigned) == []
+    assert os.path.exists(tmp_path / 'label_1' / 'img_000.jpg')
+    assert not os.path.exists(tmp_path / 'label_0' / 'img_000.jpg')
+    assert not os.path.exists(tmp_path / 'label_1' / 'img_001.jpg')
+    assert os.path.exists(tmp_path / 'img_001.jpg')
+    materializer.close()
+
+    # placements are resumed from the journal
+    materializer = Materializer(str(tmp_path), labels)
+    assert materializer.mode == mode
+    assert materializer.pending(assigned) == []
+    materializer.close()
+
+
+def test_multi_label_commit(tmp_path):
+    make_images(str(tmp_path), ['a.jpg', 'b.jpg', 'c.jpg'])
+    store = MultiLabelStore(['red', 'round'])
+    store.set_labels(['a.jpg', 'b.jpg', 'c.jpg'], 'red')
+    store.set_label('a.jpg', 'round')
+
+    materializer = Materializer(str(tmp_path), store.labels, 'copy', multi_label=True)
+    assert materializer.commit(store.items()) == []
+    assert sorted(os.listdir(tmp_path / 'red')) == ['a.jpg', 'b.jpg', 'c.jpg']
+    assert os.listdir(tmp_path / 'round') == ['a.jpg']
+    materializer.close()
+
+    with pytest.raises(ValueError):
+        Materializer(str(tmp_path), store.labels, 'move', multi_label=True)
+
+
+def test_shards_cover_images():
+    img_names = [f'img_{i:04d}.jpg' for i in range(1000)]
+    for strategy in ('hash', 'range'):
+        shards = [ShardSpec(index, 3, strategy, overlap=0.1).select(img_names) for index in range(3)]
+        counts = [sum(selected) for selected in zip(*shards)]
+        assert all(count in (1, 3) for count in counts)
+        assert 50 < counts.count(3) < 150
+
+
+def test_merge_annotators(tmp_path):
+    votes = {'alice': {'a.jpg': 'cat', 'b.jpg': 'dog', 'c.jpg': 'cat'},
+             'bob': {'a.jpg': 'cat', 'b.jpg': 'cat', 'd.jpg': 'dog'},
+             'carol': {'b.jpg': 'dog', 'c.jpg': 'dog'}}
+    for annotator, labels in votes.items():
+        store = LabelStore(['cat', 'dog'], annotator_folder(str(tmp_path), annotator))
+        store.save_session()
+        for img_name, label in labels.items():
+            store.set_label(img_name, label)
+        store.close()
+
+    report = merge_annotators(str(tmp_path))
+    assert report['annotators'] == ['alice', 'bob', 'carol']
+    assert report['conflicts'] == 2 and report['unresolved'] == 1
+
+    store = LabelStore.open(str(tmp_path), read_only=True)
+    assert store.labels == ['cat', 'dog']
+    assert store.assigned_labels == {'a.jpg': 'cat', 'b.jpg': 'dog', 'd.jpg': 'dog'}
+
+
+def test_merge_annotators_without_annotators(tmp_path):
+    with pytest.raises(ValueError):
+        merge_annotators(str(tmp_path))
+    assert main([str(tmp_path), 'merge-annotators']) == 1
+
+
+def test_cli_stats(tmp_path, capsys):
+    store = LabelStore.open(str(tmp_path), ['zebra', 'cat', 'dog'])
+    store.set_label('a.jpg', 'dog')
+    store.close()
+
+    assert main([str(tmp_path), 'stats']) == 0
+    assert capsys.readouterr().out.split() == ['zebra', '0', 'cat', '0', 'dog', '1', 'total', '1']
+    with open(tmp_path / 'output' / 'session.json') as f:
+        assert json.load(f)['labels'] == ['zebra', 'cat', 'dog']